@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""Offline benchmarks of the G-code hook and the scrape path.
+
+Replays a recorded or synthetic G-code stream through the plugin's sent hook, with stubbed settings and
+printer so no OctoPrint server is needed (the octoprint package still has to be installed), and scrapes
+the metrics from concurrent threads at growing series counts.
+
+	python benchmarks/bench.py --stream mixed --lines 200000
+	python benchmarks/bench.py --file print.gcode --scrapers 8 --series 10 100 1000
+	python benchmarks/bench.py --stream g1 --lines 5000 --skip-scrape --serial-rate 500
+	python benchmarks/bench.py --file print.gcode --lines 0 --skip-scrape
+"""
+import argparse
+import logging
+import math
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import octoprint_prometheus_exporter  # noqa: E402
+from octoprint_prometheus_exporter.gcodeparser import Gcode_parser  # noqa: E402
+from baseline_gcodeparser import Gcode_parser as BaselineParser  # noqa: E402
+
+# commands only the tokenizing parser accounts for, the baseline's totals differ on streams with them
+BASELINE_UNKNOWN = frozenset(('G2', 'G3', 'G10', 'G11', 'G20'))
+
+
+class StubSettings:
+	"""Plugin settings backed by a dict of the defaults."""
+
+	def __init__(self, values) -> None:
+		self._values = values
+
+	def get(self, path):
+		return self._values.get(path[0])
+
+	get_int = get_float = get_boolean = get
+
+
+class StubPrinter:
+	def get_current_data(self):
+		return {
+			'progress': {'printTime': 120.0, 'printTimeLeft': 3600.0},
+			'job': {'estimatedPrintTime': 3720.0}
+		}
+
+
+def make_plugin(data_folder, **settings):
+	plugin = octoprint_prometheus_exporter.PrometheusExporterPlugin()
+	plugin._logger = logging.getLogger('benchmark')
+	plugin._printer = StubPrinter()
+	plugin._identifier = 'prometheus_exporter'
+	plugin._plugin_version = 'benchmark'
+	plugin._data_folder = data_folder
+	values = plugin.get_settings_defaults()
+	values.update(settings)
+	plugin._settings = StubSettings(values)
+	plugin.initialize()
+	return plugin
+
+
+# streams
+
+def g1_stream(n, rng):
+	"""Long runs of short extruding G1 moves, like a detailed perimeter."""
+	lines = ['G90', 'M82', 'G92 E0', 'G1 Z0.2 F600', 'G1 F1800']
+	(x, y, e, z) = (100.0, 100.0, 0.0, 0.2)
+	for i in range(n):
+		if i % 2000 == 1999:
+			z += 0.2
+			lines.append('G1 Z{:.3f}'.format(z))
+			continue
+		angle = i * 0.05
+		(nx, ny) = (100 + 40 * math.cos(angle), 100 + 40 * math.sin(angle))
+		e += math.hypot(nx - x, ny - y) * 0.033
+		lines.append('G1 X{:.3f} Y{:.3f} E{:.5f}'.format(nx, ny, e))
+		(x, y) = (nx, ny)
+	return lines
+
+
+def arc_stream(n, rng):
+	"""Arc-welded output, G2/G3 with I/J in between straight moves."""
+	lines = ['G90', 'M83', 'G92 X100 Y100 Z0.2 E0', 'G1 F2400']
+	for i in range(n):
+		if i % 3:
+			command = 'G2' if rng.random() < 0.5 else 'G3'
+			lines.append('{} X{:.3f} Y{:.3f} I{:.3f} J{:.3f} E{:.5f}'.format(
+				command, rng.uniform(60, 140), rng.uniform(60, 140), rng.uniform(-5, 5), rng.uniform(-5, 5),
+				rng.uniform(0.01, 0.5)))
+		else:
+			lines.append('G1 X{:.3f} Y{:.3f} E{:.5f}'.format(rng.uniform(60, 140), rng.uniform(60, 140), rng.uniform(0.01, 0.5)))
+	return lines
+
+
+def retract_stream(n, rng):
+	"""Dense retract patterns of a stringy model, explicit and firmware retracts."""
+	lines = ['G90', 'M83', 'G92 E0', 'G1 Z0.2 F600']
+	for i in range(n):
+		step = i % 6
+		if step == 0:
+			lines.append('G1 E-0.8 F2400' if i % 12 else 'G10')
+		elif step == 1:
+			lines.append('G0 X{:.3f} Y{:.3f} F9000'.format(rng.uniform(0, 200), rng.uniform(0, 200)))
+		elif step == 2:
+			lines.append('G1 E0.8 F2400' if i % 12 != 2 else 'G11')
+		else:
+			lines.append('G1 X{:.3f} Y{:.3f} E{:.5f} F1800'.format(
+				rng.uniform(0, 200), rng.uniform(0, 200), rng.uniform(0.01, 0.2)))
+	return lines
+
+
+def mixed_stream(n, rng):
+	"""Moves, travels, retracts, fan changes, temperature polls and progress reports."""
+	lines = ['M82', 'G90', 'M106 S127', 'G92 E0', 'G1 Z0.2 F3000']
+	(x, y, z, e) = (100.0, 100.0, 0.2, 0.0)
+	for i in range(n):
+		r = rng.random()
+		if r < 0.7:
+			(nx, ny) = (x + rng.uniform(-5, 5), y + rng.uniform(-5, 5))
+			e += math.hypot(nx - x, ny - y) * 0.033
+			lines.append('G1 X{:.3f} Y{:.3f} E{:.5f}'.format(nx, ny, e))
+			(x, y) = (nx, ny)
+		elif r < 0.8:
+			lines.append('G0 F7200 X{:.3f} Y{:.3f}'.format(x + 10, y - 3))
+			(x, y) = (x + 10, y - 3)
+		elif r < 0.85:
+			e -= 0.8
+			lines.append('G1 E{:.5f} F2400'.format(e))
+		elif r < 0.9:
+			lines.append('M105')
+		elif r < 0.92:
+			z += 0.2
+			lines.append('G1 Z{:.3f} F600'.format(z))
+		elif r < 0.94:
+			lines.append('M106 S{}'.format(rng.randint(0, 255)))
+		elif r < 0.95:
+			lines.append('G92 E0')
+			e = 0.0
+		else:
+			lines.append('M73 P{}'.format(i * 100 // n))
+	return lines
+
+
+STREAMS = {
+	'g1': g1_stream,
+	'arcs': arc_stream,
+	'retracts': retract_stream,
+	'mixed': mixed_stream,
+}
+
+
+def read_file(path, limit):
+	"""The lines of a recorded file as OctoPrint sends them, without comments and blank lines."""
+	lines = []
+	with open(path, encoding='latin-1') as f:
+		for line in f:
+			line = line.split(';', 1)[0].strip()
+			if line:
+				lines.append(line)
+				if limit and len(lines) >= limit:
+					break
+	return lines
+
+
+# benchmarks
+
+def percentiles(samples):
+	samples = sorted(samples)
+	return (samples[len(samples) // 2], samples[min(int(len(samples) * 0.99), len(samples) - 1)])
+
+
+def bench_hook(lines, data_folder, self_metrics=False):
+	# a queue big enough for the whole stream, so the hook is measured rather than the worker's batch interval
+	plugin = make_plugin(data_folder, gcode_queue_size=len(lines) + 1, self_metrics=self_metrics)
+	plugin.gcode_worker.start()
+	hook = plugin.gcodephase_hook
+	latencies = []
+	clock = time.perf_counter_ns
+
+	start = time.perf_counter()
+	for line in lines:
+		before = clock()
+		hook(None, 'sent', line, None, None)
+		latencies.append(clock() - before)
+	sent = time.perf_counter() - start
+	plugin.gcode_worker.stop()
+	total = time.perf_counter() - start
+
+	(p50, p99) = percentiles(latencies)
+	print('hook: {:.0f} lines/s sent, {:.0f} lines/s accounted, latency p50 {:.2f} us p99 {:.2f} us, {} dropped'.format(
+		len(lines) / sent, len(lines) / total, p50 / 1000.0, p99 / 1000.0, plugin.metrics.gcode_queue_dropped))
+	print('      extrusion {:.1f} mm, x/y/z travel {:.1f}/{:.1f}/{:.1f} mm, {} layers'.format(
+		plugin.metrics.extrusion_total, plugin.metrics.x_travel_total, plugin.metrics.y_travel_total,
+		plugin.metrics.z_travel_total, plugin.metrics.layer_times.layer))
+
+
+def bench_serial(lines, data_folder, rate, window):
+	"""Sends the lines to a simulated printer that acknowledges rate lines per second, with at most window
+	lines in flight like a firmware's command buffer."""
+	plugin = make_plugin(data_folder, gcode_queue_size=len(lines) + 1, serial_max_in_flight=window + 1)
+	plugin.gcode_worker.start()
+	received = queue.Queue()
+	slots = threading.Semaphore(window)
+
+	def printer():
+		start = time.monotonic()
+		for i in range(len(lines)):
+			received.get()
+			delay = start + (i + 1) / rate - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+			plugin.gcode_received_hook(None, 'ok')
+			slots.release()
+
+	thread = threading.Thread(target=printer)
+	thread.start()
+	start = time.perf_counter()
+	for line in lines:
+		slots.acquire()
+		plugin.gcodephase_hook(None, 'sent', line, None, None)
+		received.put(line)
+	thread.join()
+	elapsed = time.perf_counter() - start
+	plugin.gcode_worker.stop()
+
+	link = plugin.serial_link
+	latencies = link._latencies
+	count = sum(latencies.counts)
+	print('serial: {} lines at {:.0f} lines/s, window {}: {:.0f} lines/s, {:.0f} bytes/s, {} acks, {} unmatched'.format(
+		len(lines), rate, window, link.lines / elapsed, link.bytes / elapsed, link.acks, link.unmatched))
+	print('        ok latency mean {:.2f} ms, expected {:.2f} ms once the window is full'.format(
+		latencies.sum / count * 1000.0, window / rate * 1000.0))
+
+
+def bench_parser(lines):
+	parser = Gcode_parser()
+	process_line = parser.process_line
+
+	start = time.perf_counter()
+	for line in lines:
+		process_line(line)
+	elapsed = time.perf_counter() - start
+
+	parser.reset()
+	tracemalloc.start()
+	before = tracemalloc.take_snapshot()
+	for line in lines:
+		process_line(line)
+	after = tracemalloc.take_snapshot()
+	(_, peak) = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+	print('parser: {:.0f} lines/s, {} blocks still allocated after {} lines, peak traced {:.1f} KiB'.format(
+		len(lines) / elapsed, blocks, len(lines), peak / 1024.0))
+
+
+def totals(parser):
+	return (parser.extrusion_counter, parser.x_travel, parser.y_travel, parser.z_travel)
+
+
+def bench_baseline(lines):
+	"""Replays the lines through the regex parser the plugin had before and checks both end with the same
+	extrusion and X/Y/Z travel totals."""
+	times = []
+	for parser in (BaselineParser(), Gcode_parser()):
+		process_line = parser.process_line
+		start = time.perf_counter()
+		for line in lines:
+			process_line(line)
+		times.append(time.perf_counter() - start)
+	print('baseline: {:.0f} lines/s, the tokenizing parser {:.0f} lines/s, {:.2f}x'.format(
+		len(lines) / times[0], len(lines) / times[1], times[0] / times[1]))
+
+	if any(line.split()[0] in BASELINE_UNKNOWN for line in lines if line.strip()):
+		print('          totals not compared, the stream has arcs, firmware retracts or inch units')
+		return
+	(baseline, parser) = (BaselineParser(), Gcode_parser())
+	for (number, line) in enumerate(lines, 1):
+		baseline.process_line(line)
+		parser.process_line(line)
+		if not all(math.isclose(old, new, abs_tol=1e-9) for (old, new) in zip(totals(baseline), totals(parser))):
+			raise SystemExit('totals differ from the baseline after line {} {!r}: {} != {}'.format(
+				number, line, totals(baseline), totals(parser)))
+	print('          same totals: extrusion {:.3f} mm, travel X {:.3f} Y {:.3f} Z {:.3f} mm'.format(*totals(parser)))
+
+
+def bench_scrape(data_folder, series, scrapers, duration, cache_ttl):
+	plugin = make_plugin(data_folder, scrape_cache_ttl=cache_ttl, path_series_max=series + 1)
+	for i in range(series):
+		label = 'local/folder/print-{:05d}.gcode'.format(i)
+		plugin.metrics.print_progress[label] = i % 100
+		plugin.metrics.print_time_elapsed[label] = i
+	plugin.get_temp_update(None, {'T0': (210.3, 215.0), 'B': (60.0, 60.0)})
+	plugin.print_progress_label = 'local/folder/print-00000.gcode'
+
+	latencies = []
+	lock = threading.Lock()
+	stop = time.monotonic() + duration
+
+	def scrape():
+		# what the /metrics route does, without Flask and the permission check
+		own = []
+		clock = time.perf_counter_ns
+		while time.monotonic() < stop:
+			before = clock()
+			plugin.gcode_worker.flush()
+			plugin.refresh_print_times()
+			plugin.metrics.render('text/plain', 'gzip')
+			own.append(clock() - before)
+		with lock:
+			latencies.extend(own)
+
+	threads = [threading.Thread(target=scrape) for _ in range(scrapers)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	(p50, p99) = percentiles(latencies)
+	(body, _) = plugin.metrics.render('text/plain', None)
+	print(
+		'scrape: {:>5} path series, {} scrapers, cache ttl {:.1f} s: {:.0f} scrapes/s, p50 {:.2f} ms p99 {:.2f} ms, '
+		'{} bytes'.format(series, scrapers, cache_ttl, len(latencies) / duration, p50 / 1e6, p99 / 1e6, len(body))
+	)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--stream', choices=sorted(STREAMS), default='mixed', help='synthetic stream to replay')
+	parser.add_argument('--file', help='recorded G-code file to replay instead of a synthetic stream')
+	parser.add_argument('--lines', type=int, default=200000, help='lines to replay')
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--scrapers', type=int, default=4, help='concurrent scraping threads')
+	parser.add_argument(
+		'--series', type=int, nargs='+', default=[10, 100, 1000], help='path labelled series counts to scrape'
+	)
+	parser.add_argument('--duration', type=float, default=2.0, help='seconds to scrape for per series count')
+	parser.add_argument('--skip-scrape', action='store_true')
+	parser.add_argument('--self-metrics', action='store_true', help='enable the self metrics while replaying')
+	parser.add_argument(
+		'--serial-rate', type=float, help='also send the stream to a printer acknowledging this many lines/s'
+	)
+	parser.add_argument('--serial-window', type=int, default=4, help='lines the simulated printer buffers')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARNING)
+	if args.file:
+		lines = read_file(args.file, args.lines)
+		print('replaying {} lines of {}'.format(len(lines), args.file))
+	else:
+		lines = STREAMS[args.stream](args.lines, random.Random(args.seed))
+		print('replaying {} lines of the {} stream'.format(len(lines), args.stream))
+
+	with tempfile.TemporaryDirectory() as data_folder:
+		bench_parser(lines)
+		bench_baseline(lines)
+		bench_hook(lines, data_folder, args.self_metrics)
+		if args.serial_rate:
+			bench_serial(lines, data_folder, args.serial_rate, args.serial_window)
+		if not args.skip_scrape:
+			for cache_ttl in (0.0, 1.0):
+				for series in args.series:
+					bench_scrape(data_folder, series, args.scrapers, args.duration, cache_ttl)
+	print('python {}, {} CPUs'.format(sys.version.split()[0], os.cpu_count()))
+
+
+if __name__ == '__main__':
+	main()
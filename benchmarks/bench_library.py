@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Benchmark of the process pool back-fill of the uploads library statistics.
+
+Writes synthetic G-code files to a temporary uploads folder and analyzes them with LibraryIndex.update()
+from a fresh index for every worker count, reporting files/s and the speedup over a single worker.
+
+	python benchmarks/bench_library.py --files 200 --lines 20000 --workers 1 2 4
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import STREAMS  # noqa: E402
+from octoprint_prometheus_exporter.library import LibraryIndex, default_workers  # noqa: E402
+
+
+def write_library(folder, files, lines, seed):
+	rng = random.Random(seed)
+	names = sorted(STREAMS)
+	size = 0
+	for i in range(files):
+		# subfolders and mixed sizes, like a real uploads folder
+		stream = STREAMS[names[i % len(names)]](rng.randint(lines // 2, lines * 3 // 2), rng)
+		path = os.path.join(folder, 'folder-{}'.format(i % 5), 'part-{:04d}.gcode'.format(i))
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, 'w') as f:
+			f.write('\n'.join(stream))
+		size += os.path.getsize(path)
+	return size
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--files', type=int, default=100, help='files in the synthetic library')
+	parser.add_argument('--lines', type=int, default=20000, help='mean lines per file')
+	parser.add_argument('--seed', type=int, default=1)
+	cpus = os.cpu_count() or 1
+	parser.add_argument(
+		'--workers', type=int, nargs='+', default=sorted(set([1, default_workers(), cpus])), help='worker counts to compare'
+	)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as folder:
+		uploads = os.path.join(folder, 'uploads')
+		size = write_library(uploads, args.files, args.lines, args.seed)
+		print('library: {} files, {:.1f} MiB'.format(args.files, size / 1048576.0))
+
+		baseline = None
+		for workers in args.workers:
+			index_path = os.path.join(folder, 'library-{}.json'.format(workers))
+			start = time.perf_counter()
+			analyzed = LibraryIndex(index_path).update(uploads, workers)
+			elapsed = time.perf_counter() - start
+			if baseline is None:
+				baseline = elapsed
+			print('{:>3} workers: {} files in {:.2f} s, {:.1f} files/s, {:.1f} MiB/s, speedup {:.2f}x'.format(
+				workers, analyzed, elapsed, analyzed / elapsed, size / 1048576.0 / elapsed, baseline / elapsed))
+
+			# an unchanged library is only scanned
+			start = time.perf_counter()
+			LibraryIndex(index_path).update(uploads, workers)
+			print('             rescan of the unchanged library {:.3f} s'.format(time.perf_counter() - start))
+	print('python {}, {} CPUs, {} workers by default'.format(sys.version.split()[0], cpus, default_workers()))
+
+
+if __name__ == '__main__':
+	main()
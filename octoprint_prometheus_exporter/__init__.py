@@ -1,192 +1,714 @@
 # coding=utf-8
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from threading import Timer
+from threading import Lock, Thread
+import os
 import time
+import flask
 import octoprint.plugin
+from octoprint.util import RepeatedTimer
 from octoprint.access.permissions import Permissions
 from octoprint.access import USER_GROUP
 from octoprint.util.version import get_octoprint_version_string
 from octoprint.util.platform import get_os
 from .metrics import Metrics
 from .gcodeparser import Gcode_parser
+from .gcodeworker import GcodeWorker
+from .hostsensors import HostSensors
+from .hostresources import HostResources
+from .gcodeanalyzer import GcodeAnalyzer
+from .library import LibraryIndex
+from .scheduler import LabelScheduler
+from .histograms import LayerTimes, MoveHistograms
+from .counters import CounterStore
+from .aggregation import FanInDirectory
+from .temperatures import TemperatureStats
+from .push import PushBuffer, Pusher
+from .moverates import MoveRates
+from .selfmetrics import SelfMetrics
+from .seriallink import SerialLink
+from .jobs import JobLog, JobStats, filament_grams
 
 
 class PrometheusExporterPlugin(octoprint.plugin.BlueprintPlugin,
 							   octoprint.plugin.StartupPlugin,
 							   octoprint.plugin.ProgressPlugin,
 							   octoprint.plugin.SettingsPlugin,
+							   octoprint.plugin.ShutdownPlugin,
 							   octoprint.plugin.EventHandlerPlugin):
 
 	def initialize(self):
 		# if the following returns None it makes no sense to create the
 		# timer and fail every second
-		self.metrics = Metrics(logger=self._logger)
+		printer_label = self._settings.get(['printer_label'])
+		self.fan_in = None
+		fan_in_folder = self._settings.get(['fan_in_folder'])
+		if fan_in_folder and not printer_label:
+			self._logger.warning('fan_in_folder needs a printer_label to tell the instances apart, not fanning in')
+		elif fan_in_folder:
+			self.fan_in = FanInDirectory(
+				fan_in_folder,
+				printer_label,
+				max_age=self._settings.get_float(['fan_in_max_age']),
+				logger=self._logger
+			)
+		fan_in_aggregate = self.fan_in is not None and self._settings.get_boolean(['fan_in_aggregate'])
+		self.metrics = Metrics(
+			logger=self._logger,
+			cache_ttl=self._settings.get_float(['scrape_cache_ttl']),
+			path_series_max=self._settings.get_int(['path_series_max']),
+			path_series_ttl=self._settings.get_float(['path_series_ttl']),
+			path_label_mode=self._settings.get(['path_label_mode']),
+			path_label_max_length=self._settings.get_int(['path_label_max_length']),
+			labels={'printer': printer_label} if printer_label else None,
+			fan_in=self.fan_in if fan_in_aggregate else None
+		)
+		# the other instances publish their metrics for the aggregating one
+		self.fan_in_timer = None
+		if self.fan_in is not None and not fan_in_aggregate:
+			self.fan_in_timer = RepeatedTimer(
+				self._settings.get_float(['fan_in_interval']),
+				self.publish_fan_in,
+				run_first=False
+			)
+			self.fan_in_timer.name = 'PrometheusExporterFanIn'
+		self.self_metrics = None
+		if self._settings.get_boolean(['self_metrics']):
+			self.self_metrics = SelfMetrics(sample_every=self._settings.get_int(['self_metrics_sample_every']))
+			self.metrics.registry.register(self.self_metrics)
+		self.serial_link = None
+		if self._settings.get_boolean(['serial_metrics']):
+			self.serial_link = SerialLink(
+				latency_buckets=self._settings.get(['serial_latency_buckets']),
+				max_in_flight=self._settings.get_int(['serial_max_in_flight'])
+			)
+			self.metrics.registry.register(self.serial_link)
+		self.metrics.temperature_stats = TemperatureStats(
+			window=self._settings.get_float(['temperature_window']),
+			deviation_buckets=self._settings.get(['temperature_deviation_buckets'])
+		)
+		self.metrics.registry.register(self.metrics.temperature_stats)
+		self.host_sensors = HostSensors(
+			logger=self._logger,
+			use_vcgencmd=self._settings.get_boolean(['host_sensors_vcgencmd'])
+		)
+		self.metrics.registry.register(self.host_sensors)
+		self.host_resources = None
+		if self._settings.get_boolean(['host_resources']):
+			self.host_resources = HostResources(logger=self._logger)
+			self.metrics.registry.register(self.host_resources)
 		self.parser = Gcode_parser()
-		self.last_extrusion_counter = 0
-		self.last_x_travel = 0
-		self.last_y_travel = 0
-		self.last_z_travel = 0
+		self.metrics.move_histograms = MoveHistograms(
+			feedrate_buckets=self._settings.get(['feedrate_buckets']),
+			segment_length_buckets=self._settings.get(['segment_length_buckets']),
+			extrusion_per_mm_buckets=self._settings.get(['extrusion_per_mm_buckets'])
+		)
+		self.metrics.layer_times = LayerTimes(self._settings.get(['layer_duration_buckets']))
+		self.metrics.registry.register(self.metrics.move_histograms)
+		self.metrics.registry.register(self.metrics.layer_times)
+		self.gcode_worker = GcodeWorker(
+			self.parser,
+			self.publish_gcode_metrics,
+			logger=self._logger,
+			max_size=self._settings.get_int(['gcode_queue_size']),
+			interval=self._settings.get_float(['gcode_batch_interval']),
+			flush_interval=self._settings.get_float(['metrics_flush_interval']),
+			overflow=self._settings.get(['gcode_queue_overflow']),
+			moves=self.metrics.move_histograms.copy(),
+			rates=MoveRates(
+				filament_diameter=self._settings.get_float(['filament_diameter']),
+				window=self._settings.get_int(['flow_window'])
+			),
+			layers=self.metrics.layer_times,
+			kinds=self.self_metrics.gcode_kinds if self.self_metrics is not None else None
+		)
+		self.metrics.gcode_queue_depth = self.gcode_worker.depth
+		self.metrics.gcode_queue_lag = self.gcode_worker.lag
+		self.gcode_analyzer = None
+		if self._settings.get_boolean(['gcode_analysis']):
+			self.gcode_analyzer = GcodeAnalyzer(
+				logger=self._logger,
+				cache_size=self._settings.get_int(['gcode_analysis_cache_size'])
+			)
+		self.library = LibraryIndex(os.path.join(self.get_plugin_data_folder(), 'library.json'), logger=self._logger)
+		self.library_thread = None
+		self.print_file_path = None
 		self.print_progress_label = ''
-		self.print_completion_timer = None
+		# guards print_progress_label and the series labelled with it
+		self.print_label_lock = Lock()
 		self.print_time_start = 0
+		# owns the delayed removal of labelled series and the post-print reset
+		self.label_scheduler = LabelScheduler(logger=self._logger)
+		self.label_retention = self._settings.get_float(['label_retention'])
+		self.temperature_retention = self._settings.get_float(['temperature_retention'])
+		# the printer's job timings only change about once a second, refreshing them from a timer keeps
+		# get_current_data() (a copy of the whole printer state) away from the G-code path
+		self.print_times_timer = RepeatedTimer(
+			self._settings.get_float(['print_times_refresh_interval']),
+			self.refresh_print_times,
+			run_first=False
+		)
+		self.print_times_timer.name = 'PrometheusExporterPrintTimes'
+		self.pusher = None
+		if self._settings.get(['push_url']):
+			push_mode = self._settings.get(['push_mode'])
+			self.pusher = Pusher(
+				self.metrics.exposed,
+				self._settings.get(['push_url']),
+				logger=self._logger,
+				mode=push_mode,
+				job=self._settings.get(['push_job']),
+				grouping={'printer': printer_label} if printer_label else None,
+				interval=self._settings.get_float(['push_interval']),
+				compress=self._settings.get_boolean(['push_gzip']),
+				# a Pushgateway only keeps the latest push, older ones are not worth buffering
+				buffer=PushBuffer(
+					size=self._settings.get_int(['push_buffer_size']),
+					spool_folder=os.path.join(self.get_plugin_data_folder(), 'push'),
+					spool_size=self._settings.get_int(['push_spool_size'])
+				) if push_mode == Pusher.MODE_IMPORT else PushBuffer(size=1),
+				backoff_max=self._settings.get_float(['push_backoff_max']),
+				username=self._settings.get(['push_username']),
+				password=self._settings.get(['push_password'])
+			)
+			self.metrics.registry.register(self.pusher)
+		self.job_log = None
+		self.job_peak_temperatures = {}
+		if self._settings.get_boolean(['job_log']):
+			self.job_log = JobLog(os.path.join(self.get_plugin_data_folder(), 'jobs.jsonl'), logger=self._logger)
+			self.job_stats = JobStats(
+				duration_buckets=self._settings.get(['job_duration_buckets']),
+				extrusion_buckets=self._settings.get(['job_extrusion_buckets'])
+			)
+			for record in self.job_log.records():
+				self.job_stats.observe(record)
+			self.metrics.registry.register(self.job_stats)
+		self.counter_store = CounterStore(os.path.join(self.get_plugin_data_folder(), 'counters.json'), logger=self._logger)
+		self.metrics.restore_counters(self.counter_store.load())
+		self.save_counters_timer = RepeatedTimer(
+			self._settings.get_float(['counters_save_interval']),
+			self.save_counters,
+			run_first=False
+		)
+		self.save_counters_timer.name = 'PrometheusExporterSaveCounters'
+
+	##~~ SettingsPlugin mixin
+	def get_settings_defaults(self):
+		return dict(
+			# maximum number of sent lines waiting for the background G-code accounting
+			gcode_queue_size=10000,
+			# what to do with sent lines when the queue is full: 'drop' (and count them) or 'block' the comm thread
+			gcode_queue_overflow=GcodeWorker.OVERFLOW_DROP,
+			# seconds between two batches of the background G-code accounting
+			gcode_batch_interval=0.5,
+			# seconds between two updates of the G-code based metrics, scrapes and finished prints always update them
+			metrics_flush_interval=5.0,
+			# seconds between two updates of the print time elapsed/estimate/left metrics
+			print_times_refresh_interval=1.0,
+			# seconds a serialized /metrics response is reused for, it is reused for longer while nothing changes
+			scrape_cache_ttl=1.0,
+			# read the Raspberry Pi core temperature with "sudo vcgencmd" when there is no cpu-thermal zone in sysfs
+			host_sensors_vcgencmd=False,
+			# export the host's CPU/memory usage, the OctoPrint process' usage and the Raspberry Pi throttling flags
+			host_resources=False,
+			# analyze uploaded and printed G-code files for the expected extrusion/travel/layer metrics
+			gcode_analysis=True,
+			# number of files whose analysis is kept
+			gcode_analysis_cache_size=64,
+			# processes used to back-fill the uploads library statistics, None uses one per CPU but one
+			library_workers=None,
+			# seconds the print/slice progress series of a finished job are kept for
+			label_retention=30.0,
+			# seconds a temperature identifier is kept for after its last report
+			temperature_retention=60.0,
+			# series kept per path labelled metric, the least recently updated ones are evicted first
+			path_series_max=50,
+			# seconds after which a path labelled series that was not updated is evicted, 0 disables that
+			path_series_ttl=86400.0,
+			# path label values: 'full' paths, paths 'truncate'd to path_label_max_length or a 'hash' of the path
+			path_label_mode=Metrics.PATH_LABEL_FULL,
+			path_label_max_length=64,
+			# upper bounds of the move histogram buckets: feedrate in mm/s, XY segment length in mm and
+			# filament extruded per mm of XY motion
+			feedrate_buckets=[5, 10, 20, 30, 40, 50, 60, 80, 100, 150, 200, 300],
+			segment_length_buckets=[0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100],
+			extrusion_per_mm_buckets=[0.01, 0.02, 0.03, 0.04, 0.05, 0.06, 0.08, 0.1, 0.15, 0.2],
+			# filament diameter in mm the volumetric flow is computed with
+			filament_diameter=1.75,
+			# number of recent moves the mean and peak flow and speed are taken over
+			flow_window=100,
+			# upper bounds of the layer duration histogram buckets in seconds
+			layer_duration_buckets=[5, 10, 20, 30, 60, 120, 300, 600, 1200, 1800, 3600],
+			# seconds between two saves of the lifetime counters, they are also saved after every print and on shutdown
+			counters_save_interval=300.0,
+			# value of the printer label added to every series, empty for none
+			printer_label='',
+			# folder the instances of a host publish their metrics to, empty to not fan in
+			fan_in_folder='',
+			# whether this instance exposes the metrics of the others in fan_in_folder
+			fan_in_aggregate=False,
+			# seconds between two publications to fan_in_folder
+			fan_in_interval=5.0,
+			# seconds after which the metrics of an instance that stopped publishing are not exposed anymore
+			fan_in_max_age=60.0,
+			# seconds the min/max/mean/stddev of the reported temperatures are taken over
+			temperature_window=15.0,
+			# upper bounds of the temperature deviation from target histogram buckets
+			temperature_deviation_buckets=[-10, -5, -2, -1, -0.5, 0.5, 1, 2, 5, 10],
+			# Pushgateway base URL or import endpoint to push the metrics to, empty to not push
+			push_url='',
+			# 'pushgateway' to replace the job's group with the latest metrics or 'import' to send every
+			# collection with timestamps, buffered until it was delivered
+			push_mode=Pusher.MODE_PUSHGATEWAY,
+			# job the metrics are pushed to a Pushgateway as
+			push_job='octoprint',
+			# seconds between two pushes
+			push_interval=15.0,
+			# gzip the pushed bodies, the endpoint has to accept Content-Encoding: gzip
+			push_gzip=False,
+			# import mode: collections kept in memory while they can not be delivered, older ones go to disk
+			push_buffer_size=20,
+			# import mode: collections kept on disk, the oldest are dropped beyond
+			push_spool_size=1000,
+			# longest wait in seconds between two attempts while pushing fails
+			push_backoff_max=300.0,
+			# basic auth credentials of the push endpoint
+			push_username='',
+			push_password='',
+			# export the exporter's own cost: hook execution time, G-code lines by parser result, scrape cost and threads
+			self_metrics=False,
+			# time one in this many hook calls
+			self_metrics_sample_every=100,
+			# export the lines and bytes sent to the printer, the time until it acknowledged them and its resend/busy replies
+			serial_metrics=True,
+			# upper bounds of the send to ok latency histogram buckets in seconds
+			serial_latency_buckets=[0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+			# sent lines waiting for their ok that are kept, the oldest are forgotten beyond
+			serial_max_in_flight=64,
+			# append a record of every finished job to jobs.jsonl and export the duration, extrusion, filament and cost
+			# by outcome
+			job_log=True,
+			# upper bounds of the job duration histogram buckets in seconds
+			job_duration_buckets=[600, 1800, 3600, 7200, 14400, 28800, 57600, 86400],
+			# upper bounds of the filament per job histogram buckets in mm
+			job_extrusion_buckets=[100, 500, 1000, 2500, 5000, 10000, 25000, 50000],
+			# filament density in g/cm³ the filament mass is computed with
+			filament_density=1.24,
+			# filament price per kg the cost of a job is computed with, 0 to not compute it
+			filament_cost_per_kg=0.0
+		)
+
+	def get_settings_restricted_paths(self):
+		# the push credentials are only readable by admins
+		return dict(admin=[['push_username'], ['push_password']])
 
 	def get_temp_update(self, comm, parsed_temps):
+		sampled = self.self_metrics is not None and self.self_metrics.sample('temperatures_received')
+		if sampled:
+			start = time.perf_counter()
+
 		for k, v in parsed_temps.items():
 			if isinstance(v, tuple) and len(v) == 2:
 				if not v[0] is None:
-					self.metrics.temps_actual.labels(k).set(v[0])
+					self.metrics.temps_actual[k] = v[0]
+					self.metrics.temperature_stats.observe(k, v[0], v[1])
+					peak = self.job_peak_temperatures.get(k)
+					if peak is None or v[0] > peak:
+						self.job_peak_temperatures[k] = v[0]
 				if not v[1] is None:
-					self.metrics.temps_target.labels(k).set(v[1])
+					self.metrics.temps_target[k] = v[1]
+				self.label_scheduler.schedule(
+					('temperature', k), self.temperature_retention, self.temperature_deregister_callback, k
+				)
+
+		if sampled:
+			self.self_metrics.observe('temperatures_received', time.perf_counter() - start)
 		return parsed_temps
 
+	def temperature_deregister_callback(self, identifier):
+		self.metrics.temps_actual.pop(identifier, None)
+		self.metrics.temps_target.pop(identifier, None)
+		self.metrics.temperature_stats.pop(identifier)
+
 	def on_after_startup(self):
-		self.metrics.octoprint_info.info({
+		self.gcode_worker.start()
+		self.label_scheduler.start()
+		self.print_times_timer.start()
+		self.save_counters_timer.start()
+		if self.fan_in_timer is not None:
+			self.fan_in_timer.start()
+		if self.pusher is not None:
+			self.pusher.start()
+		self.publish_library_totals()
+		self.metrics.octoprint_info = {
 			'octoprint_version': get_octoprint_version_string(),
 			'host': self._settings.get(['appearance', 'name']) or 'OctoPrint',
 			'platform': get_os(),
 			'app_start': str(int(time.time()))
-		})
+		}
+
+	##~~ ShutdownPlugin mixin
+	def on_shutdown(self):
+		self.print_times_timer.cancel()
+		self.save_counters_timer.cancel()
+		if self.fan_in_timer is not None:
+			self.fan_in_timer.cancel()
+			self.fan_in.withdraw()
+		if self.pusher is not None:
+			self.pusher.stop()
+		self.label_scheduler.stop()
+		# stopping flushes the last sent lines into the counters
+		self.gcode_worker.stop()
+		self.save_counters()
+		self.host_sensors.close()
+		if self.host_resources is not None:
+			self.host_resources.close()
+		if self.gcode_analyzer is not None:
+			self.gcode_analyzer.shutdown()
+
+	def save_counters(self):
+		try:
+			self.counter_store.save(self.metrics.lifetime_counters())
+		except Exception:
+			self._logger.exception('Failed to save the lifetime counters')
+
+	def publish_fan_in(self):
+		try:
+			self.fan_in.publish(self.metrics.exposed)
+		except Exception:
+			self._logger.exception('Failed to publish the metrics to {}'.format(self._settings.get(['fan_in_folder'])))
 
 	def print_complete_callback(self):
 		self.metrics.print_complete()
-		self.print_completion_timer = None
 
 	def print_deregister_callback(self, label):
-		if label != '':
-			self.metrics.print_progress.remove(label)
-			self.metrics.print_time_elapsed.remove(label)
-			self.metrics.print_time_est.remove(label)
-			self.metrics.print_time_left_est.remove(label)
-		self.print_progress_label = ''
+		with self.print_label_lock:
+			if label != '':
+				self.metrics.print_progress.pop(label, None)
+				self.metrics.print_time_elapsed.pop(label, None)
+				self.metrics.print_time_est.pop(label, None)
+				self.metrics.print_time_left_est.pop(label, None)
+			# a new print may have taken over in the meantime
+			if self.print_progress_label == label:
+				self.print_progress_label = ''
 
 	def slice_deregister_callback(self, label):
-		self.metrics.slice_progress.remove(label)
-
-	def print_complete(self):
-		self.metrics.printing_time_total.inc(time.time() - self.print_time_start)
-
-		# In 30 seconds, reset all the progress variables back to 0
+		self.metrics.slice_progress.pop(label, None)
+
+	def print_complete(self, outcome, payload):
+		# publish the exact totals of the print before they get reset
+		self.gcode_worker.flush()
+		self.metrics.layer_times.finish(time.monotonic())
+		end = time.time()
+		self.metrics.printing_time_total += end - self.print_time_start
+		self.save_counters()
+		if self.job_log is not None:
+			self.record_job(outcome, payload, end)
+
+		# After label_retention seconds (30 by default), reset all the progress variables back to 0
 		# At a default 10 second interval, this gives us plenty of room for Prometheus to capture the 100%
 		# complete gauge.
-
-		# TODO: Is this really a good idea?
-
-		self.print_completion_timer = Timer(30, self.print_complete_callback)
-		self.print_completion_timer.start()
-		Timer(30, lambda: self.print_deregister_callback(self.print_progress_label)).start()
+		label = self.print_progress_label
+		self.label_scheduler.schedule('print_complete', self.label_retention, self.print_complete_callback)
+		self.label_scheduler.schedule(('print', label), self.label_retention, self.print_deregister_callback, label)
+
+	def record_job(self, outcome, payload, end):
+		extrusion = self.metrics.extrusion_print
+		grams = filament_grams(
+			extrusion, self._settings.get_float(['filament_diameter']), self._settings.get_float(['filament_density'])
+		)
+		record = {
+			'path': payload.get('path'),
+			'origin': payload.get('origin'),
+			'outcome': outcome,
+			'start': round(self.print_time_start, 3),
+			'end': round(end, 3),
+			'duration': round(end - self.print_time_start, 3),
+			'extrusion': round(extrusion, 3),
+			'filament_g': round(grams, 3),
+			'x_travel': round(self.metrics.x_travel_print, 3),
+			'y_travel': round(self.metrics.y_travel_print, 3),
+			'z_travel': round(self.metrics.z_travel_print, 3),
+			'layers': self.metrics.layer_times.layer,
+			# a copy, the comm thread may add an identifier meanwhile
+			'peak_temperatures': dict((k, round(v, 1)) for (k, v) in dict(self.job_peak_temperatures).items())
+		}
+		cost_per_kg = self._settings.get_float(['filament_cost_per_kg'])
+		if cost_per_kg:
+			record['cost'] = round(grams / 1000.0 * cost_per_kg, 4)
+		try:
+			self.job_log.append(record)
+		except Exception:
+			self._logger.exception('Failed to append the job to the job log')
+		self.job_stats.observe(record)
 
 	def deactivateMetricsIfOffline(self, payload):
 		if payload['state_id'] == 'OFFLINE':
+			label = self.print_progress_label
+			self.label_scheduler.cancel('print_complete')
+			self.label_scheduler.cancel(('print', label))
 			self.print_complete_callback()
-			self.print_deregister_callback(self.print_progress_label)
-			#not really safe, totally not threadsafe, but I didn't found better alternative
-			try:
-				self.metrics.temps_actual._metrics.clear()
-				self.metrics.temps_target._metrics.clear()
-			except Exception as err:
-				self._logger.warning(err)
+			self.print_deregister_callback(label)
+			# the expiry is cancelled, so drop the statistics along with the gauges now
+			for identifier in set(self.metrics.temps_actual) | set(self.metrics.temps_target):
+				self.label_scheduler.cancel(('temperature', identifier))
+				self.temperature_deregister_callback(identifier)
+			if self.serial_link is not None:
+				self.serial_link.reset()
 
 	##~~ EventHandlerPlugin mixin
 	def on_event(self, event, payload):
 		if event == 'ClientOpened':
-			self.metrics.client_num.inc()
+			self.metrics.client_num += 1
 		if event == 'ClientClosed':
-			self.metrics.client_num.dec()
+			self.metrics.client_num -= 1
 		if event == 'PrinterStateChanged':
 			self.deactivateMetricsIfOffline(payload)
-			self.metrics.printer_state.info(payload)
+			self.metrics.printer_state = payload
 		if event == 'PrintStarted':
 			self.print_time_start = time.time()
-			self.metrics.started_print_counter.inc()
-			# If there's a completion timer running, kill it.
-			if self.print_completion_timer:
-				self.print_completion_timer.cancel()
-				self.print_completion_timer = None
-			# reset the extrusion counter
-			self.parser.reset()
-			self.last_extrusion_counter = 0
-			self.last_x_travel = 0
-			self.last_y_travel = 0
-			self.last_z_travel = 0
+			self.metrics.started_print_counter += 1
+			# If there's a completion reset pending, kill it.
+			self.label_scheduler.cancel('print_complete')
+			# reset the extrusion counter, layers and the move histograms
+			self.gcode_worker.reset()
+			# the delayed reset of the previous print was cancelled above, its totals must not carry over
+			self.metrics.reset_print()
+			self.job_peak_temperatures = {}
+			self.metrics.move_histograms.reset()
+			self.analyze_print(payload)
 		if event == 'PrintFailed':
-			self.metrics.failed_print_counter.inc()
-			self.print_complete()
+			self.metrics.failed_print_counter += 1
+			self.print_complete('failed', payload)
 		if event == 'PrintDone':
-			self.metrics.done_print_counter.inc()
-			self.print_complete()
+			self.metrics.done_print_counter += 1
+			self.print_complete('done', payload)
 		if event == 'PrintCancelled':
-			self.metrics.cancelled_print_counter.inc()
-			self.print_complete()
+			self.metrics.cancelled_print_counter += 1
+			self.print_complete('cancelled', payload)
+		if event == 'FileAdded':
+			self.analyze_upload(payload)
 		if event == 'CaptureDone':
-			self.metrics.timelapse_counter.inc()
+			self.metrics.timelapse_counter += 1
 		pass
 
+	def analyze_upload(self, payload):
+		if self.gcode_analyzer is None or payload.get('storage') != 'local' or 'gcode' not in payload.get('type', []):
+			return
+		self.gcode_analyzer.submit(self._file_manager.path_on_disk('local', payload['path']))
+
+	def analyze_print(self, payload):
+		self.metrics.set_expected(None)
+		self.print_file_path = None
+		if self.gcode_analyzer is None or payload.get('origin') != 'local':
+			return
+		path = self._file_manager.path_on_disk('local', payload['path'])
+		self.print_file_path = path
+		analysis = self.gcode_analyzer.get(path)
+		if analysis is not None:
+			self.metrics.set_expected(analysis)
+			return
+
+		def set_expected(analysis):
+			# the print may be over by the time a big file got analyzed
+			if self.print_file_path == path:
+				self.metrics.set_expected(analysis)
+		self.gcode_analyzer.submit(path, set_expected)
+
+	def backfill_library(self):
+		analyzed = self.library.update(
+			self._settings.global_get_basefolder('uploads'), self._settings.get_int(['library_workers'])
+		)
+		self._logger.info('Back-filled the uploads library statistics, analyzed {} files'.format(analyzed))
+		self.publish_library_totals()
+
+	def start_library_backfill(self):
+		"""Back-fills the uploads library statistics in the background, returns False if that is already running."""
+		if self.library_thread is not None and self.library_thread.is_alive():
+			return False
+		self.library_thread = Thread(target=self.backfill_library, name='PrometheusExporterLibraryBackfill')
+		self.library_thread.daemon = True
+		self.library_thread.start()
+		return True
+
+	def publish_library_totals(self):
+		if not self.library.paths():
+			return
+		prints = {}
+		for path in self.library.paths():
+			metadata = self._file_manager.get_metadata('local', path) or {}
+			successful = sum(1 for entry in metadata.get('history', []) if entry.get('success'))
+			if successful:
+				prints[path] = successful
+		self.metrics.library_totals = self.library.totals()
+		self.metrics.library_printed_totals = self.library.totals(prints)
+
 	def gcodephase_hook(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
 		if phase == "sent":
-			parse_result = self.parser.process_line(cmd)
-			if parse_result == "movement":
-				if self.parser.extrusion_counter > self.last_extrusion_counter:
-					# extrusion_total is monotonically increasing for the lifetime of the plugin
-					self.metrics.extrusion_print.inc(self.parser.extrusion_counter - self.last_extrusion_counter)
-					self.metrics.extrusion_total.inc(self.parser.extrusion_counter - self.last_extrusion_counter)
-					self.last_extrusion_counter = self.parser.extrusion_counter
-
-				# x_travel_print is modeled as a gauge so we can reset it after every print
-				self.metrics.x_travel_print.set(self.parser.x_travel)
-
-				if self.parser.x_travel > self.last_x_travel:
-					# x_travel_total is monotonically increasing for the lifetime of the plugin
-					self.metrics.x_travel_total.inc(self.parser.x_travel - self.last_x_travel)
-					self.last_x_travel = self.parser.x_travel
-
-				# y_travel_print is modeled as a gauge so we can reset it after every print
-				self.metrics.y_travel_print.set(self.parser.y_travel)
-
-				if self.parser.y_travel > self.last_y_travel:
-					# y_travel_total is monotonically increasing for the lifetime of the plugin
-					self.metrics.y_travel_total.inc(self.parser.y_travel - self.last_y_travel)
-					self.last_y_travel = self.parser.y_travel
-
-				# z_travel_print is modeled as a gauge so we can reset it after every print
-				self.metrics.z_travel_print.set(self.parser.z_travel)
-
-				if self.parser.z_travel > self.last_z_travel:
-					# z_travel_total is monotonically increasing for the lifetime of the plugin
-					self.metrics.z_travel_total.inc(self.parser.z_travel - self.last_z_travel)
-					self.last_z_travel = self.parser.z_travel
-			elif parse_result == "print_fan_speed":
-				v = getattr(self.parser, "print_fan_speed")
-				if v is not None:
-					self.metrics.print_fan_speed.set(v)
-			if self.print_progress_label != '':
-				data = self._printer.get_current_data()
-				#self._logger.info(data)
-				if data['progress']['printTime'] is not None:
-					self.metrics.print_time_elapsed.labels(self.print_progress_label).set(data['progress']['printTime'])
-				if data['progress']['printTimeLeft'] is not None:
-					self.metrics.print_time_left_est.labels(self.print_progress_label).set(data['progress']['printTimeLeft'])
-				if data['job']['estimatedPrintTime'] is not None:
-					self.metrics.print_time_est.labels(self.print_progress_label).set(data['job']['estimatedPrintTime'])
+			sampled = self.self_metrics is not None and self.self_metrics.sample('gcode_sent')
+			if sampled:
+				start = time.perf_counter()
+
+			# the accounting happens on the worker thread, keep the comm thread's send path short
+			if not self.gcode_worker.put(cmd):
+				self.metrics.gcode_queue_dropped += 1
+			if self.serial_link is not None:
+				self.serial_link.sent(cmd)
+
+			if sampled:
+				self.self_metrics.observe('gcode_sent', time.perf_counter() - start)
 
 		return None  # no change
 
+	def gcode_received_hook(self, comm_instance, line, *args, **kwargs):
+		if self.serial_link is not None:
+			sampled = self.self_metrics is not None and self.self_metrics.sample('gcode_received')
+			if sampled:
+				start = time.perf_counter()
+
+			self.serial_link.received(line)
+
+			if sampled:
+				self.self_metrics.observe('gcode_received', time.perf_counter() - start)
+		return line
+
+	def publish_gcode_metrics(self, totals, deltas, print_fan_speed, moves, rates):
+		(extrusion, x_travel, y_travel, z_travel, _) = totals
+		(extrusion_delta, x_delta, y_delta, z_delta, retracts_delta) = deltas
+
+		if extrusion_delta > 0:
+			# extrusion_total is monotonically increasing for the lifetime of the plugin
+			self.metrics.extrusion_print = extrusion
+			self.metrics.extrusion_total += extrusion_delta
+
+		# *_travel_print is modeled as a gauge so we can reset it after every print
+		# *_travel_total is monotonically increasing for the lifetime of the plugin
+		if x_delta > 0:
+			self.metrics.x_travel_print = x_travel
+			self.metrics.x_travel_total += x_delta
+
+		if y_delta > 0:
+			self.metrics.y_travel_print = y_travel
+			self.metrics.y_travel_total += y_delta
+
+		if z_delta > 0:
+			self.metrics.z_travel_print = z_travel
+			self.metrics.z_travel_total += z_delta
+
+		# the retract length is a firmware setting, so only the retracts are counted
+		self.metrics.firmware_retracts_total += retracts_delta
+
+		if print_fan_speed is not None:
+			self.metrics.print_fan_speed = print_fan_speed
+
+		self.metrics.move_histograms.merge(moves)
+		if rates is not None:
+			self.metrics.set_rates(rates)
+
+	def refresh_print_times(self):
+		label = self.print_progress_label
+		if label == '':
+			return
+		data = self._printer.get_current_data()
+		with self.print_label_lock:
+			# do not bring back the series of a label that was deregistered meanwhile
+			if label != self.print_progress_label:
+				return
+			if data['progress']['printTime'] is not None:
+				self.metrics.print_time_elapsed[label] = data['progress']['printTime']
+			if data['progress']['printTimeLeft'] is not None:
+				self.metrics.print_time_left_est[label] = data['progress']['printTimeLeft']
+			if data['job']['estimatedPrintTime'] is not None:
+				self.metrics.print_time_est[label] = data['job']['estimatedPrintTime']
+
 	##~~ ProgressPlugin mixin
 	def on_print_progress(self, storage, path, progress):
-		self.print_progress_label = path
-		self.metrics.print_progress.labels(path).set(progress)
-		pass
+		label = self.metrics.path_label(path)
+		# the same file may be printed again before the series of its last print expired
+		self.label_scheduler.cancel(('print', label))
+		with self.print_label_lock:
+			self.print_progress_label = label
+			self.metrics.print_progress[label] = progress
+		self.refresh_print_times()
 	def	on_slicing_progress(self, slicer, source_location, source_path, destination_location, destination_path, progress):
-		self.metrics.slice_progress.labels(source_path).set(progress)
+		label = self.metrics.path_label(source_path)
+		self.metrics.slice_progress[label] = progress
 		if progress >= 100:
-			Timer(30, lambda: self.slice_deregister_callback(source_path)).start()
-		pass
+			self.label_scheduler.schedule(('slice', label), self.label_retention, self.slice_deregister_callback, label)
+		else:
+			self.label_scheduler.cancel(('slice', label))
 
 	# ENDPOINT
 	@octoprint.plugin.BlueprintPlugin.route("/metrics")
 	@Permissions.PLUGIN_PROMETHEUS_EXPORTER_SCRAPE.require(403)
 	def metrics_endpoint(self):
-		return self.metrics.render()
+		start = time.perf_counter()
+		self.gcode_worker.flush()
+		self.refresh_print_times()
+		(body, headers) = self.metrics.render(
+			flask.request.headers.get('Accept'),
+			flask.request.headers.get('Accept-Encoding'),
+			flask.request.args.getlist('name[]')
+		)
+		if self.self_metrics is not None:
+			self.self_metrics.observe_scrape(time.perf_counter() - start, len(body))
+		return body, 200, headers
+
+	@octoprint.plugin.BlueprintPlugin.route("/library", methods=["GET"])
+	@Permissions.PLUGIN_PROMETHEUS_EXPORTER_SCRAPE.require(403)
+	def library_endpoint(self):
+		# ?path=a.gcode&path=b.gcode estimates what printing those files would cost
+		paths = flask.request.args.getlist('path')
+		if paths:
+			missing = [path for path in paths if self.library.get(path) is None]
+			totals = self.library.totals(dict((path, paths.count(path)) for path in paths))
+		else:
+			missing = []
+			totals = self.library.totals()
+		return flask.jsonify(
+			totals=totals._asdict(),
+			missing=missing,
+			running=self.library_thread is not None and self.library_thread.is_alive()
+		)
+
+	@octoprint.plugin.BlueprintPlugin.route("/jobs", methods=["GET"])
+	@Permissions.PLUGIN_PROMETHEUS_EXPORTER_SCRAPE.require(403)
+	def jobs_endpoint(self):
+		# ?before=<next of the previous page> pages back through the history, newest first
+		if self.job_log is None:
+			return flask.jsonify(jobs=[], next=None), 404
+		before = flask.request.args.get('before', None, type=int)
+		limit = min(max(flask.request.args.get('limit', 50, type=int), 1), 500)
+		(jobs, cursor) = self.job_log.page(before, limit)
+		return flask.jsonify(jobs=jobs, next=cursor)
+
+	@octoprint.plugin.BlueprintPlugin.route("/library/backfill", methods=["POST"])
+	@Permissions.ADMIN.require(403)
+	def library_backfill_endpoint(self):
+		if not self.start_library_backfill():
+			return flask.jsonify(running=True), 409
+		return flask.jsonify(running=True), 202
+
+	##~~ CLI hook
+	def get_cli_commands(self, cli_group, pass_octoprint_ctx, *args, **kwargs):
+		import click
+
+		@click.command('backfill')
+		@click.option(
+			'--workers', type=int, default=None, help='Processes to analyze files with, one per CPU but one by default.'
+		)
+		def backfill_command(workers):
+			"""Back-fill the extrusion/travel statistics of the uploads library."""
+			settings = cli_group.settings
+			library = LibraryIndex(os.path.join(settings.getBaseFolder('data'), 'prometheus_exporter', 'library.json'))
+			analyzed = library.update(settings.getBaseFolder('uploads'), workers)
+			totals = library.totals()
+			click.echo('Analyzed {} files, the library has {} files'.format(analyzed, totals.files))
+			for (field, value) in totals._asdict().items():
+				if field != 'files':
+					click.echo('{}: {:.2f}'.format(field, value))
+
+		return [backfill_command]
 
 	##~~ Softwareupdate hook
 	def get_update_information(self):
@@ -236,5 +758,7 @@ def __plugin_load__():
 		"octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
 		"octoprint.comm.protocol.temperatures.received": __plugin_implementation__.get_temp_update,
 		"octoprint.comm.protocol.gcode.sent": __plugin_implementation__.gcodephase_hook,
-		"octoprint.access.permissions": __plugin_implementation__.get_additional_permissions
+		"octoprint.comm.protocol.gcode.received": __plugin_implementation__.gcode_received_hook,
+		"octoprint.access.permissions": __plugin_implementation__.get_additional_permissions,
+		"octoprint.cli.commands": __plugin_implementation__.get_cli_commands
 	}
@@ -0,0 +1,123 @@
+"""Printer labels and fan-in of several instances"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from prometheus_client.metrics_core import Metric
+from prometheus_client.openmetrics.exposition import generate_latest
+from prometheus_client.openmetrics.parser import text_string_to_metric_families
+from .atomicfile import replace_file
+
+# fan-in files of the instances, named after their printer label
+FAN_IN_SUFFIX = '.om'
+
+
+def relabel(families, labels):
+	"""Returns copies of the families with labels added to every sample, labels a series already has win."""
+	relabelled = []
+	for family in families:
+		copy = Metric(family.name, family.documentation, family.type, family.unit)
+		copy.samples = [sample._replace(labels=dict(labels, **sample.labels)) for sample in family.samples]
+		relabelled.append(copy)
+	return relabelled
+
+
+def merge(families, others):
+	"""Returns the families with the samples of the same named families of others appended, families of
+	others that are new are added and ones of a different type are dropped."""
+	merged = OrderedDict((family.name, family) for family in families)
+	for family in others:
+		own = merged.get(family.name)
+		if own is None:
+			merged[family.name] = family
+		elif own.type == family.type:
+			# copied, the families of others are cached between scrapes
+			combined = Metric(own.name, own.documentation, own.type, own.unit)
+			combined.samples = own.samples + family.samples
+			merged[family.name] = combined
+	return list(merged.values())
+
+
+class ExposedRegistry:
+	"""What /metrics exposes of a registry: every series with labels added, and with a FanInDirectory the
+	families the other instances published merged in."""
+
+	def __init__(self, registry, labels=None, fan_in=None) -> None:
+		self._registry = registry
+		self._labels = labels
+		self._fan_in = fan_in
+
+	def collect(self):
+		families = list(self._registry.collect())
+		if self._labels:
+			families = relabel(families, self._labels)
+		if self._fan_in is not None:
+			families = merge(families, self._fan_in.families())
+		return families
+
+	def restricted_registry(self, names):
+		# only the own series, the other instances are scraped as a whole
+		return ExposedRegistry(self._registry.restricted_registry(names), self._labels)
+
+
+class FanInDirectory:
+	"""Folder the instances of one host publish their metrics to, so one of them can expose them all.
+
+	Every instance writes its exposition, in OpenMetrics so the types survive, to <name>.om every few
+	seconds, replacing it atomically. The aggregating instance parses the files of the others when they
+	changed and skips the ones older than max_age seconds, an instance that was stopped disappears instead
+	of exposing its last values forever. A tmpfs folder (like /dev/shm) keeps the writes off the SD card.
+	"""
+
+	def __init__(self, folder, name, max_age=60.0, logger=None) -> None:
+		self._folder = folder
+		self._name = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+		self._max_age = max_age
+		self._logger = logger
+		self._lock = threading.Lock()
+		# file name -> (mtime, size, families)
+		self._parsed = {}
+
+	def publish(self, registry):
+		"""Writes the exposition of registry for the aggregating instance."""
+		# only read while this instance runs, no need to sync it to disk every few seconds
+		replace_file(os.path.join(self._folder, self._name + FAN_IN_SUFFIX), generate_latest(registry), sync=False)
+
+	def withdraw(self):
+		"""Removes the published metrics, the instance is going away."""
+		try:
+			os.remove(os.path.join(self._folder, self._name + FAN_IN_SUFFIX))
+		except OSError:
+			pass
+
+	def families(self):
+		"""Returns the metric families published by the other instances."""
+		own = self._name + FAN_IN_SUFFIX
+		try:
+			names = sorted(name for name in os.listdir(self._folder) if name.endswith(FAN_IN_SUFFIX) and name != own)
+		except OSError:
+			return []
+
+		families = []
+		parsed = {}
+		oldest = time.time() - self._max_age
+		with self._lock:
+			for name in names:
+				path = os.path.join(self._folder, name)
+				try:
+					stat = os.stat(path)
+					if stat.st_mtime < oldest:
+						continue
+					entry = self._parsed.get(name)
+					if entry is None or entry[:2] != (stat.st_mtime, stat.st_size):
+						with open(path, 'rb') as f:
+							entry = (stat.st_mtime, stat.st_size, list(text_string_to_metric_families(f.read().decode('utf-8'))))
+				except Exception:
+					if self._logger is not None:
+						self._logger.exception('Failed to read the metrics of {}'.format(path))
+					continue
+				parsed[name] = entry
+				families.extend(entry[2])
+			self._parsed = parsed
+		return families
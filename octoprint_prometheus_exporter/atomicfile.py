@@ -0,0 +1,28 @@
+"""Atomic file replacement"""
+import os
+
+
+def replace_file(path, data, sync=True):
+	"""Replaces the file at path with data (bytes), so readers and a crash see either the old or the new file.
+
+	data goes to a temporary file that is renamed over path. With sync the temporary file is synced before
+	and the folder after the rename, which makes the new file survive a power loss too. Files that are only
+	read by a running process (like those on a tmpfs) do not need that.
+	"""
+	folder = os.path.dirname(path)
+	if folder and not os.path.isdir(folder):
+		os.makedirs(folder)
+	tmp = path + '.tmp'
+	with open(tmp, 'wb') as f:
+		f.write(data)
+		if sync:
+			f.flush()
+			os.fsync(f.fileno())
+	os.replace(tmp, path)
+	# the rename itself only survives a power loss once the folder is synced
+	if sync and folder and hasattr(os, 'O_DIRECTORY'):
+		fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
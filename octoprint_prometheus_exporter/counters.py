@@ -0,0 +1,52 @@
+"""Lifetime counters storage"""
+import json
+import threading
+from .atomicfile import replace_file
+
+
+class CounterStore:
+	"""Keeps the lifetime counters in a JSON file, so they survive restarts.
+
+	The file is replaced atomically (written to a temporary file, synced, then renamed over the old one), so
+	a crash or power loss leaves either the previous or the new counters, never a mix. Saving unchanged
+	counters does not touch the file, the plugin saves periodically and on shutdown rather than on every
+	update to keep the writes to SD cards down.
+	"""
+
+	VERSION = 1
+
+	def __init__(self, path, logger=None) -> None:
+		self._path = path
+		self._logger = logger
+		# serializes saves from the timer, print events and shutdown
+		self._lock = threading.Lock()
+		self._saved = None
+
+	def load(self):
+		"""Returns the saved counters, an empty dict if there are none or they can not be read."""
+		try:
+			with open(self._path) as f:
+				data = json.load(f)
+		except FileNotFoundError:
+			return {}
+		except (OSError, ValueError):
+			if self._logger is not None:
+				self._logger.exception('Failed to load the lifetime counters from {}'.format(self._path))
+			return {}
+		if data.get('version') != self.VERSION:
+			return {}
+		self._saved = data['counters']
+		return dict(self._saved)
+
+	def save(self, counters):
+		"""Writes the counters, returns False if they did not change since they were last loaded or saved."""
+		with self._lock:
+			if counters == self._saved:
+				return False
+			data = {
+				'version': self.VERSION,
+				'counters': counters
+			}
+			replace_file(self._path, json.dumps(data).encode('utf-8'))
+			self._saved = dict(counters)
+			return True
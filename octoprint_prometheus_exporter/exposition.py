@@ -0,0 +1,85 @@
+"""Cached /metrics responses"""
+import gzip
+import threading
+import time
+from prometheus_client.exposition import choose_encoder, gzip_accepted
+
+
+class _Snapshot:
+	"""Collected metric families that can be handed to the prometheus_client encoders as a registry."""
+
+	def __init__(self, families) -> None:
+		self._families = families
+
+	def collect(self):
+		return self._families
+
+
+class ExpositionCache:
+	"""Serialized /metrics responses shared between scrapes.
+
+	The registry is collected at most once per ttl seconds. The encoded bodies (plain text or
+	OpenMetrics, gzipped or not, each encoded on first use) are reused as long as a fresh collection
+	yields the same samples, so replicas scraping seconds apart or an idle printer do not re-serialize
+	the same values over and over. Families named in ignored (the cache's own hit/miss counters)
+	are left out of that comparison.
+	"""
+
+	def __init__(self, registry, ttl=1.0, ignored=(), clock=time.monotonic) -> None:
+		self._registry = registry
+		self._ttl = ttl
+		self._clock = clock
+		self._ignored = frozenset(ignored)
+		self._lock = threading.Lock()
+		self._expires = 0
+		self._snapshot = None
+		self._samples = None
+		self._bodies = {}
+		self.hits = 0
+		self.misses = 0
+
+	def render(self, accept, accept_encoding):
+		"""Returns the (body, headers) of a response for the given Accept and Accept-Encoding headers."""
+		(encoder, content_type) = choose_encoder(accept)
+		gzipped = gzip_accepted(accept_encoding)
+		key = (content_type, gzipped)
+
+		with self._lock:
+			now = self._clock()
+			if now >= self._expires:
+				families = list(self._registry.collect())
+				samples = [family.samples for family in families if family.name not in self._ignored]
+				if samples != self._samples:
+					self._snapshot = _Snapshot(families)
+					self._samples = samples
+					self._bodies = {}
+				self._expires = now + self._ttl
+
+			body = self._bodies.get(key)
+			if body is None:
+				self.misses += 1
+				body = encoder(self._snapshot)
+				if gzipped:
+					body = gzip.compress(body)
+				self._bodies[key] = body
+			else:
+				self.hits += 1
+
+		return body, self.headers(content_type, gzipped)
+
+	def headers(self, content_type, gzipped):
+		headers = {
+			'Content-Type': content_type,
+			'Vary': 'Accept, Accept-Encoding'
+		}
+		if gzipped:
+			headers['Content-Encoding'] = 'gzip'
+		return headers
+
+	def render_uncached(self, registry, accept, accept_encoding):
+		(encoder, content_type) = choose_encoder(accept)
+		gzipped = gzip_accepted(accept_encoding)
+		body = encoder(registry)
+		if gzipped:
+			body = gzip.compress(body)
+		return body, self.headers(content_type, gzipped)
@@ -0,0 +1,109 @@
+"""Offline G-code analysis"""
+import io
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from .gcodeparser import Gcode_parser
+
+
+GcodeAnalysis = namedtuple('GcodeAnalysis', ['extrusion', 'x_travel', 'y_travel', 'z_travel', 'layers', 'fan_changes'])
+
+# lines are read in chunks of about this many bytes
+CHUNK_SIZE = 1 << 20
+
+
+def analyze_file(path, chunk_size=CHUNK_SIZE):
+	"""Returns the GcodeAnalysis of a file, streaming it in chunks."""
+	with io.open(path, 'r', encoding='latin-1') as f:
+		return analyze_stream(f, chunk_size)
+
+
+def analyze_stream(f, chunk_size=CHUNK_SIZE):
+	"""Returns the GcodeAnalysis of the lines of a text file object."""
+	parser = Gcode_parser()
+	process_line = parser.process_line
+	fan_changes = 0
+	fan_speed = None
+
+	while True:
+		lines = f.readlines(chunk_size)
+		if not lines:
+			break
+		for line in lines:
+			if process_line(line) == "print_fan_speed" and parser.print_fan_speed != fan_speed:
+				fan_changes += 1
+				fan_speed = parser.print_fan_speed
+
+	return GcodeAnalysis(
+		extrusion=parser.extrusion_counter,
+		x_travel=parser.x_travel,
+		y_travel=parser.y_travel,
+		z_travel=parser.z_travel,
+		layers=parser.layer,
+		fan_changes=fan_changes
+	)
+
+
+class GcodeAnalyzer:
+	"""Runs whole G-code files through the parser ahead of printing them.
+
+	Files are streamed in chunks of about chunk_size bytes, so their size does not matter, on a single
+	background thread. The results are kept for the cache_size most recently used files, keyed by
+	path, mtime and size so a replaced file gets analyzed again.
+	"""
+
+	def __init__(self, logger, cache_size=64, chunk_size=CHUNK_SIZE) -> None:
+		self._logger = logger
+		self._cache_size = cache_size
+		self._chunk_size = chunk_size
+		self._cache = OrderedDict()
+		self._lock = threading.Lock()
+		self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='PrometheusExporterGcodeAnalyzer')
+
+	def cache_key(self, path):
+		stat = os.stat(path)
+		return (path, stat.st_mtime, stat.st_size)
+
+	def get(self, path):
+		"""Returns the cached analysis of a file, None if it was not analyzed in its current version."""
+		try:
+			key = self.cache_key(path)
+		except OSError:
+			return None
+		with self._lock:
+			analysis = self._cache.get(key)
+			if analysis is not None:
+				self._cache.move_to_end(key)
+			return analysis
+
+	def analyze(self, path):
+		"""Returns the analysis of a file, analyzing it if it is not cached."""
+		analysis = self.get(path)
+		if analysis is not None:
+			return analysis
+
+		key = self.cache_key(path)
+		analysis = analyze_file(path, self._chunk_size)
+
+		with self._lock:
+			self._cache[key] = analysis
+			self._cache.move_to_end(key)
+			while len(self._cache) > self._cache_size:
+				self._cache.popitem(last=False)
+		return analysis
+
+	def submit(self, path, callback=None):
+		"""Analyzes a file on the background thread, callback gets the analysis once it is available."""
+		def run():
+			try:
+				analysis = self.analyze(path)
+			except Exception:
+				self._logger.exception('Failed to analyze {}'.format(path))
+				return
+			if callback is not None:
+				callback(analysis)
+		return self._executor.submit(run)
+
+	def shutdown(self):
+		self._executor.shutdown(wait=False)
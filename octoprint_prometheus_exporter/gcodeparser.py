@@ -1,31 +1,80 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import math
 import re
 
 # https://community.octoprint.org/t/how-to-determine-filament-extruded/7828
 
-# stolen directly from filaswitch
-class Gcode_parser(object):
-    MOVE_RE = re.compile("^G0\s+|^G1\s+")
-    X_COORD_RE = re.compile(".*\s+X([-]*\d+\.*\d*)")
-    Y_COORD_RE = re.compile(".*\s+Y([-]*\d+\.*\d*)")
-    E_COORD_RE = re.compile(".*\s+E([-]*\d+\.*\d*)")
-    Z_COORD_RE = re.compile(".*\s+Z([-]*\d+\.*\d*)")
-    SPEED_VAL_RE = re.compile(".*\s+F(\d+\.*\d*)")
+MM_PER_INCH = 25.4
 
-    FAN_SET_RE = re.compile("^M106\s+")
-    FAN_SPEED_RE = re.compile(".*\s+S(\d+\.*\d*)")
 
-    FAN_OFF_RE = re.compile("^M107")
+def cos_variation(start, end):
+    """ returns how far cos goes up and down between two angles
+    """
+    if start > end:
+        (start, end) = (end, start)
+    total = 0
+    previous = math.cos(start)
+    # cos turns around at every multiple of pi
+    k = math.floor(start / math.pi) + 1
+    while k * math.pi < end:
+        value = 1.0 if k % 2 == 0 else -1.0
+        total += abs(value - previous)
+        previous = value
+        k += 1
+    return total + abs(math.cos(end) - previous)
 
-    COORDINATE_MODESWITCH_RE = re.compile("^(M82|M83|G90|G91)(?![0-9.])")
-    COORDINATE_RESET_RE = re.compile("^G92\s+")
+
+# stolen directly from filaswitch
+class Gcode_parser(object):
+    # coordinate mode switches as (absolute_e, absolute_moves), None leaves the mode untouched
+    COORDINATE_MODES = {
+        "M82": (True, None),
+        "M83": (False, None),
+        "G90": (True, True),
+        "G91": (False, False),
+    }
+
+    # arc planes as (first axis, second axis, linear axis, first center offset, second center offset)
+    PLANES = {
+        "G17": ("X", "Y", "Z", "I", "J"),
+        "G18": ("Z", "X", "Y", "K", "I"),
+        "G19": ("Y", "Z", "X", "J", "K"),
+    }
+
+    # parameters given in inches in G20 mode
+    LENGTH_PARAMETERS = frozenset("XYZEIJKRF")
+
+    # a letter and its number, to split words written without spaces between them (G1X5Y3), the
+    # uppercase E is the extrusion word so only a lowercase exponent is taken
+    WORD = re.compile(r"[A-Z][-+]?[0-9.]+(?:e[-+]?[0-9]+)?")
 
     def __init__(self):
+        # the command word of a line picks its handler, every other line is ignored
+        # without looking at its parameters
+        self.handlers = {
+            "G0": self.process_move,
+            "G1": self.process_move,
+            "G2": self.process_arc,
+            "G3": self.process_arc,
+            "G10": self.process_firmware_retract,
+            "G11": self.process_firmware_retract,
+            "G17": self.process_plane_select,
+            "G18": self.process_plane_select,
+            "G19": self.process_plane_select,
+            "G20": self.process_units,
+            "G21": self.process_units,
+            "M106": self.process_fan_set,
+            "M107": self.process_fan_off,
+            "M82": self.process_coordinate_modeswitch,
+            "M83": self.process_coordinate_modeswitch,
+            "G90": self.process_coordinate_modeswitch,
+            "G91": self.process_coordinate_modeswitch,
+            "G92": self.process_coordinate_reset,
+        }
         self.reset()
 
     def reset(self):
-        self.last_extrusion_move = None
         self.extrusion_counter = 0
         self.x_travel = 0
         self.x = None
@@ -38,107 +87,53 @@ class Gcode_parser(object):
         self.absolute_moves = True
         self.speed = None
         self.print_fan_speed = None
-
-    def is_extrusion_move(self, m):
-        """ args are a tuple (x,y,z,e,speed)
+        self.inches = False
+        self.plane = self.PLANES["G17"]
+        self.retracted = False
+        self.firmware_retracts = 0
+        # layers started so far, counted from the moves alone as OctoPrint sends no comments
+        self.layer = 0
+        self.layer_z = None
+        # XY length and extrusion of the last move
+        self.move_xy_length = 0
+        self.move_extrusion = 0
+
+    def tokenize(self, line):
+        """ returns the whitespace separated words of a line with its comment stripped
         """
-        if m and (m[0] is not None or m[1] is not None) and m[3] is not None and m[3] != 0:
-            return True
-        else:
-            return False
-
-    def parse_move_args(self, line):
-        """ returns a tuple (x,y,z,e,speed) or None
+        comment = line.find(";")
+        if comment != -1:
+            line = line[:comment]
+        return line.split()
+
+    def parse_args(self, words):
+        """ returns a dict of parameter letter -> value for the words following the command word,
+        words without a finite numeric value (float() also takes nan, inf and overflows to inf) are skipped
         """
-
-        m = self.MOVE_RE.match(line)
-        if m:
-            x = None
-            y = None
-            z = None
-            e = None
-            speed = None
-
-            m = self.X_COORD_RE.match(line)
-            if m:
-                x = float(m.groups()[0])
-
-            m = self.Y_COORD_RE.match(line)
-            if m:
-                y = float(m.groups()[0])
-
-            m = self.Z_COORD_RE.match(line)
-            if m:
-                z = float(m.groups()[0])
-
-            m = self.E_COORD_RE.match(line)
-            if m:
-                e = float(m.groups()[0])
-
-            m = self.SPEED_VAL_RE.match(line)
-            if m:
-                speed = float(m.groups()[0])
-
-            return x, y, z, e, speed
-
-        return None
-
-    def parse_fan_speed(self, line):
-        m = self.FAN_SET_RE.match(line)
-        if m:
-            m = self.FAN_SPEED_RE.match(line)
-            if m:
-                speed = float(m.groups()[0])
-            else:
-                speed = 255.0
-            return speed
-
-        m = self.FAN_OFF_RE.match(line)
-        if m:
-            return 0.0
-
-        return None
-
-    def parse_coordinate_modeswitch(self, line):
-        m = self.COORDINATE_MODESWITCH_RE.match(line)
-
-        if not m:
-            return None
-
-        gcode = m.group(1)
-        absolute_e = gcode in ("M82", "G90")
-        absolute_moves = None
-
-        if gcode.startswith("G"):
-            absolute_moves = gcode == "G90"
-
-        return (absolute_e, absolute_moves)
-
-    def parse_coordinate_reset(self, line):
-        m = self.COORDINATE_RESET_RE.match(line)
-
-        if not m:
-            return None
-
-        (x, y, z, e) = (self.x, self.y, self.z, self.e)
-
-        m = self.X_COORD_RE.match(line)
-        if m:
-            x = float(m.groups()[0])
-
-        m = self.Y_COORD_RE.match(line)
-        if m:
-            y = float(m.groups()[0])
-
-        m = self.Z_COORD_RE.match(line)
-        if m:
-            z = float(m.groups()[0])
-
-        m = self.E_COORD_RE.match(line)
-        if m:
-            e = float(m.groups()[0])
-
-        return (x, y, z, e)
+        args = {}
+        isfinite = math.isfinite
+        for word in words[1:]:
+            try:
+                value = float(word[1:])
+            except ValueError:
+                # only scanned when it does not parse, so spaced lines stay on the split() path
+                joined = self.WORD.findall(word)
+                if len(joined) > 1:
+                    args.update(self.parse_args([None] + joined))
+                continue
+            if isfinite(value):
+                args[word[0]] = value
+        return args
+
+    def to_mm(self, args):
+        """ returns the parameters with the lengths converted to mm if they were given in inches
+        """
+        if not self.inches:
+            return args
+        return dict(
+            (letter, value * MM_PER_INCH if letter in self.LENGTH_PARAMETERS else value)
+            for (letter, value) in args.items()
+        )
 
     def process_axis_movement(self, target_position, current_position, absolute):
         if target_position is None:
@@ -154,46 +149,191 @@ class Gcode_parser(object):
 
         return (relative_movement, new_position)
 
-    def process_line(self, line):
-        movement = self.parse_move_args(line)
-        if movement is not None:
-            (x, y, z, e, speed) = movement
-
-            (rel_e, new_e) = self.process_axis_movement(e, self.e, self.absolute_e)
-            (rel_x, new_x) = self.process_axis_movement(x, self.x, self.absolute_moves)
-            (rel_y, new_y) = self.process_axis_movement(y, self.y, self.absolute_moves)
-            (rel_z, new_z) = self.process_axis_movement(z, self.z, self.absolute_moves)
-
-            self.extrusion_counter += rel_e or 0
-            self.x_travel += rel_x or 0
-            self.y_travel += rel_y or 0
-            self.z_travel += rel_z or 0
-
-            (self.x, self.y, self.z, self.e) = (new_x, new_y, new_z, new_e)
-
-            if speed is not None:
-                self.speed = speed
-
-            return "movement"
-
-        fanspeed = self.parse_fan_speed(line)
-        if fanspeed is not None:
-            self.print_fan_speed = fanspeed
-            return "print_fan_speed"
-
-        coordinate_modes = self.parse_coordinate_modeswitch(line)
-        if coordinate_modes is not None:
-            (absolute_e, absolute_moves) = coordinate_modes
+    def axis_offset(self, target_position, current_position):
+        """ returns how far an axis moves, None if it moves to an absolute position from an unknown one
+        """
+        if target_position is None:
+            return 0
+        if not self.absolute_moves:
+            return target_position
+        if current_position is None:
+            return None
+        return target_position - current_position
 
-            if absolute_e is not None:
-                self.absolute_e = absolute_e
-            if absolute_moves is not None:
-                self.absolute_moves = absolute_moves
-            return "coordinate_modeswitch"
+    def arc_travel(self, offset_p, offset_q, center_p, center_q, radius, clockwise):
+        """ returns (length, first axis travel, second axis travel) of an arc in its plane, from the offsets
+        of its end and center to its start or the radius (negative for more than half a circle),
+        None if they do not describe an arc
+        """
+        if radius is not None:
+            chord = math.hypot(offset_p, offset_q)
+            if not chord:
+                return None
+            # the center is on the perpendicular bisector of the chord
+            height = math.sqrt(max((radius - chord / 2) * (radius + chord / 2), 0))
+            side = -1 if clockwise != (radius < 0) else 1
+            center_p = offset_p / 2 - side * height * offset_q / chord
+            center_q = offset_q / 2 + side * height * offset_p / chord
+
+        radius = math.hypot(center_p, center_q)
+        if not radius:
+            return None
+        # start and end relative to the center
+        (start_p, start_q) = (-center_p, -center_q)
+        (end_p, end_q) = (offset_p - center_p, offset_q - center_q)
+        angle = math.atan2(start_p * end_q - start_q * end_p, start_p * end_p + start_q * end_q)
+        if angle < 0:
+            angle += 2 * math.pi
+        if clockwise:
+            angle -= 2 * math.pi
+        elif angle == 0:
+            # ending where it started is a full circle
+            angle = 2 * math.pi
+
+        start_angle = math.atan2(start_q, start_p)
+        end_angle = start_angle + angle
+        return (
+            radius * abs(angle),
+            radius * cos_variation(start_angle, end_angle),
+            radius * cos_variation(start_angle - math.pi / 2, end_angle - math.pi / 2),
+        )
+
+    def process_move(self, command, args):
+        args = self.to_mm(args)
+        (rel_e, new_e) = self.process_axis_movement(args.get("E"), self.e, self.absolute_e)
+        (rel_x, new_x) = self.process_axis_movement(args.get("X"), self.x, self.absolute_moves)
+        (rel_y, new_y) = self.process_axis_movement(args.get("Y"), self.y, self.absolute_moves)
+        (rel_z, new_z) = self.process_axis_movement(args.get("Z"), self.z, self.absolute_moves)
+
+        self.extrusion_counter += rel_e or 0
+        self.x_travel += rel_x or 0
+        self.y_travel += rel_y or 0
+        self.z_travel += rel_z or 0
+        self.move_xy_length = math.hypot(rel_x or 0, rel_y or 0)
+        self.move_extrusion = rel_e or 0
+
+        (self.x, self.y, self.z, self.e) = (new_x, new_y, new_z, new_e)
+        self.track_layer(rel_z)
+
+        speed = args.get("F")
+        # a feedrate of 0 or less is not one the firmware moves at
+        if speed is not None and speed > 0:
+            self.speed = speed
+
+        return "movement"
+
+    def process_arc(self, command, args):
+        args = self.to_mm(args)
+        (rel_e, new_e) = self.process_axis_movement(args.get("E"), self.e, self.absolute_e)
+        start = {"X": self.x, "Y": self.y, "Z": self.z}
+        travel = {}
+        end = {}
+        for axis in start:
+            (travel[axis], end[axis]) = self.process_axis_movement(args.get(axis), start[axis], self.absolute_moves)
+
+        (p, q, _, i, j) = self.plane
+        offset_p = self.axis_offset(args.get(p), start[p])
+        offset_q = self.axis_offset(args.get(q), start[q])
+        arc = None
+        if offset_p is not None and offset_q is not None:
+            arc = self.arc_travel(offset_p, offset_q, args.get(i, 0), args.get(j, 0), args.get("R"), command == "G2")
+        if arc is not None:
+            (length, travel[p], travel[q]) = arc
+        else:
+            # an arc that cannot be placed counts as a straight move
+            length = math.hypot(travel[p] or 0, travel[q] or 0)
+
+        self.extrusion_counter += rel_e or 0
+        self.x_travel += travel["X"] or 0
+        self.y_travel += travel["Y"] or 0
+        self.z_travel += travel["Z"] or 0
+        self.move_xy_length = length if p == "X" else math.hypot(travel["X"] or 0, travel["Y"] or 0)
+        self.move_extrusion = rel_e or 0
+
+        (self.x, self.y, self.z, self.e) = (end["X"], end["Y"], end["Z"], new_e)
+        self.track_layer(travel["Z"])
+
+        speed = args.get("F")
+        # a feedrate of 0 or less is not one the firmware moves at
+        if speed is not None and speed > 0:
+            self.speed = speed
+
+        return "movement"
+
+    def track_layer(self, z_travel):
+        # a new layer starts with the first extruding move above the previous layer, moves that climb while
+        # extruding (the spiral of vase mode) stay in the layer they started in
+        if z_travel or not self.move_extrusion or not self.move_xy_length or self.z is None:
+            return
+        if self.layer_z is None or self.z > self.layer_z:
+            self.layer += 1
+            self.layer_z = self.z
+
+    def process_firmware_retract(self, command, args):
+        if command == "G10":
+            if "L" in args or "P" in args:
+                # G10 L/P sets work coordinates, tool offsets or temperatures
+                return None
+            # the firmware does not retract twice
+            if not self.retracted:
+                self.retracted = True
+                self.firmware_retracts += 1
+        else:
+            self.retracted = False
+        return "firmware_retract"
+
+    def process_plane_select(self, command, args):
+        self.plane = self.PLANES[command]
+        return "coordinate_modeswitch"
+
+    def process_units(self, command, args):
+        self.inches = command == "G20"
+        return "coordinate_modeswitch"
+
+    def process_fan_set(self, command, args):
+        self.print_fan_speed = args.get("S", 255.0)
+        return "print_fan_speed"
+
+    def process_fan_off(self, command, args):
+        self.print_fan_speed = 0.0
+        return "print_fan_speed"
+
+    def process_coordinate_modeswitch(self, command, args):
+        (absolute_e, absolute_moves) = self.COORDINATE_MODES[command]
+
+        if absolute_e is not None:
+            self.absolute_e = absolute_e
+        if absolute_moves is not None:
+            self.absolute_moves = absolute_moves
+        return "coordinate_modeswitch"
+
+    def process_coordinate_reset(self, command, args):
+        args = self.to_mm(args)
+        self.x = args.get("X", self.x)
+        self.y = args.get("Y", self.y)
+        self.z = args.get("Z", self.z)
+        self.e = args.get("E", self.e)
+        return "coordinate_reset"
 
-        coordinate_reset = self.parse_coordinate_reset(line)
-        if coordinate_reset is not None:
-            (self.x, self.y, self.z, self.e) = coordinate_reset
-            return "coordinate_reset"
+    def process_line(self, line):
+        """ returns the kind of the processed line ("movement", "print_fan_speed", "coordinate_modeswitch",
+        "coordinate_reset", "firmware_retract") or None if the line does not affect the tracked state
+        """
+        words = self.tokenize(line)
+        if not words:
+            return None
 
-        return None
+        handler = self.handlers.get(words[0])
+        if handler is None:
+            if words[0][1:].isdigit():
+                return None
+            # parameters following the command word without a space (G1X5)
+            joined = self.WORD.findall(words[0])
+            if len(joined) < 2 or not words[0].startswith(joined[0]):
+                return None
+            words = joined + words[1:]
+            handler = self.handlers.get(words[0])
+            if handler is None:
+                return None
+
+        return handler(words[0], self.parse_args(words))
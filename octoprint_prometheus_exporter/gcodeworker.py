@@ -0,0 +1,162 @@
+"""Background G-code accounting"""
+import threading
+import time
+from collections import deque
+
+
+class GcodeWorker:
+	"""Runs the sent G-code lines through the parser on its own thread.
+
+	The comm thread only appends the raw line to a bounded queue, the worker drains it in batches
+	into the parser's running totals. Only a flush (every flush_interval seconds, or when asked to)
+	hands the (extrusion, x, y, z, firmware retracts) totals, the deltas they grew by since the last flush, the fan
+	speed (if it was changed since the last flush), the MoveHistograms observed since the last
+	flush (if moves was given) and the MoveRates snapshot (if rates was given and a move was
+	observed since the last flush) to the publish callback. Layer changes go to layers (a LayerTimes)
+	right away, with the time their line was sent. kinds (a dict of parser result -> count) counts
+	every line by what the parser made of it.
+	"""
+
+	OVERFLOW_DROP = 'drop'
+	OVERFLOW_BLOCK = 'block'
+
+	def __init__(
+		self, parser, publish, logger, max_size=10000, interval=0.5, flush_interval=5.0,
+		overflow=OVERFLOW_DROP, moves=None, rates=None, layers=None, kinds=None
+	) -> None:
+		self._parser = parser
+		self._moves = moves
+		self._rates = rates
+		self._layers = layers
+		self._kinds = kinds
+		self._publish = publish
+		self._logger = logger
+		self._max_size = max_size
+		self._interval = interval
+		self._flush_interval = flush_interval
+		self._block = overflow == self.OVERFLOW_BLOCK
+		self._queue = deque()
+		# serializes every access to the parser and the last published totals
+		self._lock = threading.Lock()
+		self._fan_changed = False
+		self._drained = threading.Event()
+		self._stopped = threading.Event()
+		self._thread = None
+		self._last_totals = (0, 0, 0, 0, 0)
+
+	def start(self):
+		self._thread = threading.Thread(target=self._run, name='PrometheusExporterGcodeWorker')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+		self.flush()
+
+	def put(self, line):
+		"""Queues a sent line, returns False if it was dropped because the queue is full."""
+		queue = self._queue
+		if len(queue) >= self._max_size:
+			if not self._block:
+				return False
+			while len(queue) >= self._max_size and not self._stopped.is_set():
+				self._drained.clear()
+				if len(queue) >= self._max_size:
+					self._drained.wait(self._interval)
+		queue.append((time.monotonic(), line))
+		return True
+
+	def depth(self):
+		return len(self._queue)
+
+	def lag(self):
+		"""Seconds the oldest queued line is waiting for."""
+		try:
+			return time.monotonic() - self._queue[0][0]
+		except IndexError:
+			return 0.0
+
+	def drain(self):
+		with self._lock:
+			self._drain()
+		self._drained.set()
+
+	def flush(self):
+		"""Processes the lines still queued and publishes the totals."""
+		with self._lock:
+			self._drain()
+			self._flush()
+		self._drained.set()
+
+	def reset(self):
+		"""Flushes the lines still queued, then starts the parser over for a new print."""
+		with self._lock:
+			self._drain()
+			self._flush()
+			self._parser.reset()
+			if self._rates is not None:
+				self._rates.reset()
+			if self._layers is not None:
+				self._layers.reset()
+			self._last_totals = (0, 0, 0, 0, 0)
+
+	def _drain(self):
+		queue = self._queue
+		parser = self._parser
+		moves = self._moves
+		rates = self._rates
+		layers = self._layers
+		kinds = self._kinds
+		while True:
+			try:
+				(sent, line) = queue.popleft()
+			except IndexError:
+				break
+			try:
+				kind = parser.process_line(line)
+			except Exception:
+				# skip the line, the ones after it still count
+				self._logger.exception('Failed to process the sent G-code line {!r}'.format(line))
+				continue
+			if kinds is not None:
+				kinds[kind] = kinds.get(kind, 0) + 1
+			if kind == "movement":
+				if moves is not None:
+					moves.observe(parser)
+				if rates is not None:
+					rates.observe(parser)
+				if layers is not None and parser.layer != layers.layer:
+					layers.observe(parser.layer, sent)
+			elif kind == "print_fan_speed":
+				self._fan_changed = True
+
+	def _flush(self):
+		parser = self._parser
+		totals = (parser.extrusion_counter, parser.x_travel, parser.y_travel, parser.z_travel, parser.firmware_retracts)
+		deltas = tuple(max(total - last, 0) for (total, last) in zip(totals, self._last_totals))
+		self._last_totals = totals
+		print_fan_speed = parser.print_fan_speed if self._fan_changed else None
+		self._fan_changed = False
+		rates = self._rates.snapshot() if self._rates is not None else None
+		try:
+			self._publish(totals, deltas, print_fan_speed, self._moves, rates)
+		except Exception:
+			self._logger.exception('Failed to publish G-code metrics')
+		if self._moves is not None:
+			self._moves.reset()
+
+	def _run(self):
+		next_flush = time.monotonic() + self._flush_interval
+		while not self._stopped.wait(self._interval):
+			# a line the parser chokes on must not end the accounting, or block the comm thread in put()
+			try:
+				if time.monotonic() >= next_flush:
+					next_flush = time.monotonic() + self._flush_interval
+					self.flush()
+				else:
+					self.drain()
+			except Exception:
+				self._logger.exception('Failed to process sent G-code lines')
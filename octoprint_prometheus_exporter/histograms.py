@@ -0,0 +1,148 @@
+"""G-code motion histograms"""
+import threading
+import time
+from bisect import bisect_left
+from prometheus_client.core import GaugeMetricFamily, HistogramMetricFamily
+from prometheus_client.utils import floatToGoString
+
+
+class BucketCounter:
+	"""Plain per-bucket counts of a histogram, bounds are the sorted upper bounds without +Inf."""
+
+	def __init__(self, bounds) -> None:
+		self.bounds = sorted(float(bound) for bound in bounds)
+		self.reset()
+
+	def reset(self):
+		# one more for +Inf
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.sum = 0.0
+
+	def observe(self, value):
+		# bucket upper bounds are inclusive, as in prometheus_client
+		self.counts[bisect_left(self.bounds, value)] += 1
+		self.sum += value
+
+	def merge(self, other):
+		for (i, count) in enumerate(other.counts):
+			self.counts[i] += count
+		self.sum += other.sum
+
+	def buckets(self):
+		"""Returns the cumulative (upper bound, count) buckets as HistogramMetricFamily takes them."""
+		buckets = []
+		cumulative = 0
+		for (bound, count) in zip(self.bounds + [float('inf')], self.counts):
+			cumulative += count
+			buckets.append((floatToGoString(bound), cumulative))
+		return buckets
+
+	def family(self, name, documentation):
+		return HistogramMetricFamily(name, documentation, buckets=self.buckets(), sum_value=self.sum)
+
+
+class MoveHistograms:
+	"""Commanded feedrate, XY segment length and extrusion per XY mm of the G0/G1 moves.
+
+	The worker observes every move into its own instance without any locking and merges it into the
+	exported one on flush, only merging and collecting take the lock.
+	"""
+
+	def __init__(self, feedrate_buckets, segment_length_buckets, extrusion_per_mm_buckets) -> None:
+		self._lock = threading.Lock()
+		self.feedrate = BucketCounter(feedrate_buckets)
+		self.segment_length = BucketCounter(segment_length_buckets)
+		self.extrusion_per_mm = BucketCounter(extrusion_per_mm_buckets)
+
+	def copy(self):
+		"""Returns an empty instance with the same buckets."""
+		return MoveHistograms(self.feedrate.bounds, self.segment_length.bounds, self.extrusion_per_mm.bounds)
+
+	def observe(self, parser):
+		"""Observes the move the parser processed last, moves without XY motion are skipped."""
+		length = parser.move_xy_length
+		if not length:
+			return
+		self.segment_length.observe(length)
+		if parser.speed is not None:
+			# F is in mm/min
+			self.feedrate.observe(parser.speed / 60.0)
+		if parser.move_extrusion:
+			self.extrusion_per_mm.observe(parser.move_extrusion / length)
+
+	def merge(self, other):
+		with self._lock:
+			self.feedrate.merge(other.feedrate)
+			self.segment_length.merge(other.segment_length)
+			self.extrusion_per_mm.merge(other.extrusion_per_mm)
+
+	def reset(self):
+		with self._lock:
+			self.feedrate.reset()
+			self.segment_length.reset()
+			self.extrusion_per_mm.reset()
+
+	def collect(self):
+		with self._lock:
+			return [
+				self.feedrate.family('octoprint_move_feedrate', 'Commanded feedrate of the XY moves of this print in mm/s'),
+				self.segment_length.family('octoprint_move_segment_length', 'XY length of the moves of this print in mm'),
+				self.extrusion_per_mm.family(
+					'octoprint_move_extrusion_per_mm',
+					'Filament extruded per mm of XY motion of the extruding moves of this print'
+				),
+			]
+
+
+class LayerTimes:
+	"""Current layer of the print, when it started and the durations of the finished layers.
+
+	Layer changes are rare, so unlike MoveHistograms the worker observes them into the exported instance.
+	Times are time.monotonic() values, the worker passes the time a line was sent rather than processed.
+	"""
+
+	def __init__(self, duration_buckets) -> None:
+		self._lock = threading.Lock()
+		self.durations = BucketCounter(duration_buckets)
+		self.layer = 0
+		self.started = None
+
+	def observe(self, layer, timestamp):
+		"""Starts layer at timestamp, finishing the current one."""
+		with self._lock:
+			if self.started is not None:
+				self.durations.observe(max(timestamp - self.started, 0))
+			self.layer = layer
+			self.started = timestamp
+
+	def finish(self, timestamp):
+		"""Finishes the current layer, the print is over."""
+		with self._lock:
+			if self.started is not None:
+				self.durations.observe(max(timestamp - self.started, 0))
+			self.started = None
+
+	def reset(self):
+		with self._lock:
+			self.durations.reset()
+			self.layer = 0
+			self.started = None
+
+	def elapsed(self):
+		"""Seconds the current layer is running for, 0 if there is none."""
+		started = self.started
+		return time.monotonic() - started if started is not None else 0
+
+	def collect(self):
+		with self._lock:
+			layer = self.layer
+			durations = self.durations.family(
+				'octoprint_layer_duration_seconds', 'Time it took to send the finished layers of this print'
+			)
+		return [
+			GaugeMetricFamily('octoprint_print_layer', 'Layer of this print being sent', value=layer),
+			GaugeMetricFamily(
+				'octoprint_print_layer_elapsed', 'Seconds the current layer is being sent for', value=self.elapsed()
+			),
+			durations
+		]
@@ -0,0 +1,152 @@
+"""Host and OctoPrint process resource usage"""
+import os
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+class HostResources:
+	"""Collector of the host's CPU and memory usage, the OctoPrint process' own usage and the Raspberry Pi
+	throttling flags.
+
+	The files are opened once and re-read with a single os.pread when scraped, only the fields that are
+	exported get converted. proc_root and sys_root point to the /proc and /sys trees to read.
+	"""
+
+	CPU_MODES = ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal')
+	MEMORY_FIELDS = {
+		b'MemTotal:': 'total',
+		b'MemFree:': 'free',
+		b'MemAvailable:': 'available',
+		b'Buffers:': 'buffers',
+		b'Cached:': 'cached',
+		b'SwapTotal:': 'swap_total',
+		b'SwapFree:': 'swap_free',
+	}
+	STATUS_FIELDS = {
+		b'VmHWM:': 'resident_max',
+		b'voluntary_ctxt_switches:': 'voluntary',
+		b'nonvoluntary_ctxt_switches:': 'nonvoluntary',
+	}
+	# bit -> flag of the firmware's get_throttled value, the same bits vcgencmd get_throttled reports
+	THROTTLED_FLAGS = (
+		(0, 'under_voltage'),
+		(1, 'arm_frequency_capped'),
+		(2, 'throttled'),
+		(3, 'soft_temperature_limit'),
+		(16, 'under_voltage_occurred'),
+		(17, 'arm_frequency_capped_occurred'),
+		(18, 'throttled_occurred'),
+		(19, 'soft_temperature_limit_occurred'),
+	)
+	THROTTLED_PATH = 'devices/platform/soc/soc:firmware/get_throttled'
+
+	def __init__(self, logger, proc_root='/proc', sys_root='/sys') -> None:
+		self._logger = logger
+		self._ticks = float(os.sysconf('SC_CLK_TCK'))
+		self._page_size = os.sysconf('SC_PAGE_SIZE')
+		self._stat = self.open(os.path.join(proc_root, 'stat'))
+		self._meminfo = self.open(os.path.join(proc_root, 'meminfo'))
+		self._self_stat = self.open(os.path.join(proc_root, 'self', 'stat'))
+		self._self_status = self.open(os.path.join(proc_root, 'self', 'status'))
+		self._throttled = self.open(os.path.join(sys_root, self.THROTTLED_PATH))
+
+	def open(self, path):
+		try:
+			return os.open(path, os.O_RDONLY)
+		except OSError:
+			return None
+
+	def read(self, fd, size):
+		if fd is None:
+			return None
+		try:
+			return os.pread(fd, size, 0)
+		except OSError:
+			return None
+
+	def close(self):
+		for fd in (self._stat, self._meminfo, self._self_stat, self._self_status, self._throttled):
+			if fd is not None:
+				os.close(fd)
+		self._stat = self._meminfo = self._self_stat = self._self_status = self._throttled = None
+
+	def read_fields(self, fd, size, fields):
+		"""Returns name -> value of the "Key: value [kB]" lines named in fields."""
+		data = self.read(fd, size)
+		values = {}
+		if data is None:
+			return values
+		remaining = len(fields)
+		for line in data.split(b'\n'):
+			words = line.split()
+			if words and words[0] in fields:
+				value = int(words[1])
+				values[fields[words[0]]] = value * 1024 if len(words) > 2 and words[2] == b'kB' else value
+				remaining -= 1
+				if remaining == 0:
+					break
+		return values
+
+	def collect_host(self):
+		# only the aggregated first "cpu" line is needed, the per-cpu and interrupt lines can be long
+		data = self.read(self._stat, 256)
+		if data is not None and data.startswith(b'cpu '):
+			family = CounterMetricFamily('octoprint_host_cpu_seconds', 'Host CPU time spent per mode', labels=['mode'])
+			for (mode, ticks) in zip(self.CPU_MODES, data[:data.find(b'\n')].split()[1:]):
+				family.add_metric([mode], int(ticks) / self._ticks)
+			yield family
+
+		memory = self.read_fields(self._meminfo, 4096, self.MEMORY_FIELDS)
+		if memory:
+			family = GaugeMetricFamily('octoprint_host_memory_bytes', 'Host memory', labels=['type'])
+			for (memory_type, value) in memory.items():
+				family.add_metric([memory_type], value)
+			yield family
+
+		data = self.read(self._throttled, 32)
+		if data is not None:
+			try:
+				throttled = int(data, 16)
+			except ValueError:
+				return
+			family = GaugeMetricFamily('octoprint_host_throttled', 'Raspberry Pi firmware throttling flags', labels=['flag'])
+			for (bit, flag) in self.THROTTLED_FLAGS:
+				family.add_metric([flag], (throttled >> bit) & 1)
+			yield family
+
+	def collect_process(self):
+		data = self.read(self._self_stat, 1024)
+		if data is not None:
+			# the command name may contain spaces, the fields after it are fixed, starting with the state (field 3)
+			fields = data[data.rfind(b')') + 2:].split()
+			family = CounterMetricFamily('octoprint_process_cpu_seconds', 'OctoPrint process CPU time', labels=['mode'])
+			family.add_metric(['user'], int(fields[11]) / self._ticks)
+			family.add_metric(['system'], int(fields[12]) / self._ticks)
+			yield family
+			yield GaugeMetricFamily('octoprint_process_threads', 'OctoPrint process threads', value=int(fields[17]))
+			yield GaugeMetricFamily(
+				'octoprint_process_virtual_memory_bytes', 'OctoPrint process virtual memory', value=int(fields[20])
+			)
+			yield GaugeMetricFamily(
+				'octoprint_process_resident_memory_bytes',
+				'OctoPrint process resident memory',
+				value=int(fields[21]) * self._page_size
+			)
+
+		status = self.read_fields(self._self_status, 4096, self.STATUS_FIELDS)
+		if 'resident_max' in status:
+			yield GaugeMetricFamily(
+				'octoprint_process_resident_memory_max_bytes',
+				'OctoPrint process peak resident memory',
+				value=status['resident_max']
+			)
+		if 'voluntary' in status:
+			family = CounterMetricFamily(
+				'octoprint_process_context_switches', 'OctoPrint process context switches', labels=['type']
+			)
+			family.add_metric(['voluntary'], status['voluntary'])
+			family.add_metric(['nonvoluntary'], status.get('nonvoluntary', 0))
+			yield family
+
+	def collect(self):
+		yield from self.collect_host()
+		yield from self.collect_process()
@@ -0,0 +1,111 @@
+"""Host temperature sensors"""
+import glob
+import os
+from prometheus_client.core import GaugeMetricFamily
+
+
+class HostSensors:
+	"""Collector of the host's thermal sensors.
+
+	Every /sys/class/thermal/thermal_zone*/temp and /sys/class/hwmon/hwmon*/temp*_input file found at
+	construction time is kept open and re-read with os.pread when scraped, so reading a sensor is a
+	single syscall instead of a fork+exec. root points to the directory holding thermal/ and hwmon/,
+	use_vcgencmd enables the old "sudo vcgencmd measure_temp" call when no cpu-thermal zone exists.
+	"""
+
+	# the Raspberry Pi's SoC zone, it reports the same value as vcgencmd measure_temp
+	RASPBERRY_CORE_ZONE = 'cpu-thermal'
+	VCGENCMD = '/usr/bin/vcgencmd'
+
+	def __init__(self, logger, root='/sys/class', use_vcgencmd=False) -> None:
+		self._logger = logger
+		self._use_vcgencmd = use_vcgencmd
+		# (sensor, type, fd)
+		self._sensors = []
+		self._raspberry_core_fd = None
+		self.discover(root)
+
+		if self._raspberry_core_fd is None and use_vcgencmd and self.get_vcgencmd_temperature() is None:
+			self._use_vcgencmd = False
+		if not self._sensors and not self._use_vcgencmd:
+			self._logger.info('Host temperature sensors are not supported on this system')
+
+	def discover(self, root):
+		for zone in sorted(glob.glob(os.path.join(root, 'thermal', 'thermal_zone*'))):
+			zone_type = self.read_text(os.path.join(zone, 'type')) or os.path.basename(zone)
+			fd = self.open(os.path.join(zone, 'temp'))
+			if fd is not None:
+				self._sensors.append((os.path.basename(zone), zone_type, fd))
+				if zone_type == self.RASPBERRY_CORE_ZONE and self._raspberry_core_fd is None:
+					self._raspberry_core_fd = fd
+
+		for hwmon in sorted(glob.glob(os.path.join(root, 'hwmon', 'hwmon*'))):
+			name = self.read_text(os.path.join(hwmon, 'name')) or os.path.basename(hwmon)
+			for temp_input in sorted(glob.glob(os.path.join(hwmon, 'temp*_input'))):
+				channel = os.path.basename(temp_input)[:-len('_input')]
+				label = self.read_text(os.path.join(hwmon, channel + '_label'))
+				fd = self.open(temp_input)
+				if fd is not None:
+					sensor = os.path.basename(hwmon) + '/' + channel
+					self._sensors.append((sensor, name + ' ' + label if label else name, fd))
+
+	def open(self, path):
+		try:
+			return os.open(path, os.O_RDONLY)
+		except OSError:
+			return None
+
+	def read_text(self, path):
+		try:
+			with open(path) as f:
+				return f.read().strip()
+		except OSError:
+			return None
+
+	def read_temperature(self, fd):
+		"""Returns the millidegree value of a sensor in degrees Celsius, None if it can not be read right now."""
+		try:
+			return int(os.pread(fd, 16, 0)) / 1000.0
+		except (OSError, ValueError):
+			return None
+
+	def get_vcgencmd_temperature(self):
+		# You need to add pi users to sudoers so it can execute the vcgencmd command
+		#
+		# root@octopi:/etc/sudoers.d# cat /etc/sudoers.d/octoprint-vcgencmd
+		# pi ALL=NOPASSWD: /usr/bin/vcgencmd
+		# root@octopi:/etc/sudoers.d#
+		if not os.path.isfile(self.VCGENCMD):
+			return None
+		temp = os.popen('sudo ' + self.VCGENCMD + ' measure_temp').readline()
+		if not temp.startswith('temp='):
+			self._logger.error('Failed to execute "sudo ' + self.VCGENCMD + '"')
+			self._logger.error('Raspberry core temperature will not be reported')
+			return None
+		temp = temp.replace('temp=', '').replace("'C", '')
+		return float(temp)
+
+	def close(self):
+		for (_, _, fd) in self._sensors:
+			os.close(fd)
+		self._sensors = []
+		self._raspberry_core_fd = None
+
+	def collect(self):
+		family = GaugeMetricFamily('octoprint_host_temperature', 'Host temperature sensors', labels=['sensor', 'type'])
+		for (sensor, sensor_type, fd) in self._sensors:
+			temperature = self.read_temperature(fd)
+			if temperature is not None:
+				family.add_metric([sensor, sensor_type], temperature)
+		yield family
+
+		if self._raspberry_core_fd is not None:
+			temperature = self.read_temperature(self._raspberry_core_fd)
+		elif self._use_vcgencmd:
+			temperature = self.get_vcgencmd_temperature()
+		else:
+			return
+		if temperature is not None:
+			yield GaugeMetricFamily(
+				'octoprint_raspberry_core_temperature', 'Core temperature of Raspberry Pi', value=temperature
+			)
@@ -0,0 +1,155 @@
+"""Per-job records"""
+import json
+import math
+import os
+import threading
+from prometheus_client.core import CounterMetricFamily, HistogramMetricFamily
+from .histograms import BucketCounter
+
+# every outcome is exported from the start, so the series of the job metrics are fixed
+OUTCOMES = ('done', 'failed', 'cancelled')
+
+
+def filament_grams(extrusion, diameter, density):
+	"""Mass in g of extrusion mm of filament of diameter mm and density g/cm³."""
+	return math.pi * (diameter / 2.0) ** 2 * extrusion / 1000.0 * density
+
+
+class JobLog:
+	"""Append-only file of the finished jobs, one compact JSON record per line.
+
+	A record is appended (and synced) once per job, nothing is ever rewritten, so a crash can at most leave
+	the last line incomplete, which readers skip and the next append terminates. Reading pages backwards
+	from the end in blocks, newest first, the cursor of a page is the offset of its oldest record in the
+	file, so paging through the history never holds more than a page and a block in memory.
+	"""
+
+	BLOCK_SIZE = 8192
+
+	def __init__(self, path, logger=None) -> None:
+		self._path = path
+		self._logger = logger
+		# serializes appends from the print events
+		self._lock = threading.Lock()
+
+	def append(self, record):
+		line = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+		with self._lock:
+			folder = os.path.dirname(self._path)
+			if folder and not os.path.isdir(folder):
+				os.makedirs(folder)
+			with open(self._path, 'ab+') as f:
+				# terminate a line a crash left incomplete
+				if f.seek(0, os.SEEK_END) > 0:
+					f.seek(-1, os.SEEK_END)
+					if f.read(1) != b'\n':
+						line = b'\n' + line
+				f.write(line)
+				f.flush()
+				os.fsync(f.fileno())
+
+	def records(self):
+		"""Yields every record oldest first, reading the file as it goes."""
+		try:
+			f = open(self._path, 'rb')
+		except FileNotFoundError:
+			return
+		with f:
+			for line in f:
+				if line.endswith(b'\n'):
+					record = self.decode(line)
+					if record is not None:
+						yield record
+
+	def page(self, before=None, limit=50):
+		"""Returns up to limit records starting before offset before (the end of the file if None) newest
+		first, each with its offset, and the cursor of the next page, None if there are no older records."""
+		records = []
+		try:
+			f = open(self._path, 'rb')
+		except FileNotFoundError:
+			return (records, None)
+		with f:
+			end = f.seek(0, os.SEEK_END)
+			if before is not None:
+				end = min(max(before, 0), end)
+			for (offset, line) in self.reversed_lines(f, end):
+				record = self.decode(line)
+				if record is None:
+					continue
+				record['offset'] = offset
+				records.append(record)
+				if len(records) >= limit:
+					break
+		cursor = records[-1]['offset'] if len(records) >= limit and records[-1]['offset'] > 0 else None
+		return (records, cursor)
+
+	def reversed_lines(self, f, end):
+		"""Yields (offset, line) of the complete lines before end, last first."""
+		position = end
+		# the start of the block read last, up to its first newline
+		remainder = b''
+		tail = True
+		while position > 0:
+			size = min(self.BLOCK_SIZE, position)
+			position -= size
+			f.seek(position)
+			chunk = f.read(size) + remainder
+			lines = chunk.split(b'\n')
+			remainder = lines[0]
+			offset = position + len(chunk)
+			for line in reversed(lines[1:]):
+				offset -= len(line)
+				# after the last newline before end there is nothing, or a line still being written
+				if not tail and line:
+					yield (offset, line)
+				tail = False
+				offset -= 1
+		if remainder and not tail:
+			yield (0, remainder)
+
+	def decode(self, line):
+		try:
+			return json.loads(line.decode('utf-8'))
+		except ValueError:
+			if self._logger is not None:
+				self._logger.warning('Skipping a malformed record of {}'.format(self._path))
+			return None
+
+
+class JobStats:
+	"""Duration and extrusion histograms and filament mass and cost counters of the finished jobs, by outcome."""
+
+	def __init__(self, duration_buckets, extrusion_buckets) -> None:
+		self._lock = threading.Lock()
+		self._durations = dict((outcome, BucketCounter(duration_buckets)) for outcome in OUTCOMES)
+		self._extrusions = dict((outcome, BucketCounter(extrusion_buckets)) for outcome in OUTCOMES)
+		self._grams = dict((outcome, 0.0) for outcome in OUTCOMES)
+		self._costs = dict((outcome, 0.0) for outcome in OUTCOMES)
+
+	def observe(self, record):
+		outcome = record.get('outcome')
+		if outcome not in self._durations:
+			return
+		with self._lock:
+			self._durations[outcome].observe(record.get('duration', 0.0))
+			self._extrusions[outcome].observe(record.get('extrusion', 0.0))
+			self._grams[outcome] += record.get('filament_g', 0.0)
+			self._costs[outcome] += record.get('cost', 0.0)
+
+	def collect(self):
+		durations = HistogramMetricFamily(
+			'octoprint_job_duration_seconds', 'Durations of the finished jobs', labels=['outcome']
+		)
+		extrusions = HistogramMetricFamily(
+			'octoprint_job_extrusion', 'Filament extruded per finished job in mm', labels=['outcome']
+		)
+		grams = CounterMetricFamily('octoprint_job_filament_grams', 'Filament used by the finished jobs', labels=['outcome'])
+		costs = CounterMetricFamily('octoprint_job_cost', 'Filament cost of the finished jobs', labels=['outcome'])
+		with self._lock:
+			for outcome in OUTCOMES:
+				durations.add_metric([outcome], self._durations[outcome].buckets(), self._durations[outcome].sum)
+				extrusions.add_metric([outcome], self._extrusions[outcome].buckets(), self._extrusions[outcome].sum)
+				grams.add_metric([outcome], self._grams[outcome])
+				costs.add_metric([outcome], self._costs[outcome])
+		return [durations, extrusions, grams, costs]
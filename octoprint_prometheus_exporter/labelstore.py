@@ -0,0 +1,66 @@
+"""Bounded storage of labelled series"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LabelStore:
+	"""Label value -> value mapping of a labelled gauge, bounded in size and age.
+
+	Once more than max_size labels are stored the least recently set ones are evicted, labels that were not
+	set for ttl seconds (0 disables that) are evicted when the store is read. evicted counts both, so a
+	label leak shows up as a growing counter instead of a growing scrape. Only the methods the plugin uses
+	on the plain dicts are provided.
+	"""
+
+	def __init__(self, max_size=50, ttl=0, clock=time.monotonic) -> None:
+		self._max_size = max_size
+		self._ttl = ttl
+		self._clock = clock
+		self._lock = threading.Lock()
+		# label value -> (value, last set)
+		self._values = OrderedDict()
+		self.evicted = 0
+
+	def __setitem__(self, label, value):
+		with self._lock:
+			self._values[label] = (value, self._clock())
+			self._values.move_to_end(label)
+			while len(self._values) > self._max_size:
+				self._values.popitem(last=False)
+				self.evicted += 1
+
+	def __getitem__(self, label):
+		return self._values[label][0]
+
+	def __contains__(self, label):
+		return label in self._values
+
+	def __len__(self):
+		return len(self._values)
+
+	def get(self, label, default=None):
+		entry = self._values.get(label)
+		return entry[0] if entry is not None else default
+
+	def pop(self, label, default=None):
+		with self._lock:
+			entry = self._values.pop(label, None)
+		return entry[0] if entry is not None else default
+
+	def clear(self):
+		with self._lock:
+			self._values.clear()
+
+	def items(self):
+		with self._lock:
+			if self._ttl:
+				expired = self._clock() - self._ttl
+				# least recently set first, stop at the first one that is still fresh
+				while self._values:
+					label = next(iter(self._values))
+					if self._values[label][1] > expired:
+						break
+					del self._values[label]
+					self.evicted += 1
+			return [(label, value) for (label, (value, _)) in self._values.items()]
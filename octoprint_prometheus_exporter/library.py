@@ -0,0 +1,140 @@
+"""Extrusion/travel statistics of the whole uploads library"""
+import json
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .atomicfile import replace_file
+from .gcodeanalyzer import GcodeAnalysis, analyze_file
+
+
+LibraryTotals = namedtuple('LibraryTotals', ['files'] + list(GcodeAnalysis._fields))
+
+GCODE_EXTENSIONS = ('.gcode', '.gco', '.g')
+
+
+def default_workers():
+	"""Returns the analysis processes to use when not configured, one per CPU but one, so a back-fill during a
+	print leaves a core to OctoPrint's comm thread."""
+	return max((os.cpu_count() or 1) - 1, 1)
+
+
+class LibraryIndex:
+	"""On-disk index of the GcodeAnalysis of every G-code file below a folder.
+
+	update() walks the folder, analyzes the new and changed files in a process pool and drops the entries
+	of removed files. Unchanged files (same mtime and size) are skipped, so only the first run over a big
+	library is expensive. The index is a JSON file that is replaced atomically, every save_every analyzed
+	files and at the end, so an interrupted run keeps what it got done.
+	"""
+
+	# bumped whenever the analysis changes, so outdated indexes get rebuilt
+	VERSION = 3
+
+	def __init__(self, path, logger=None, save_every=50) -> None:
+		self._path = path
+		self._logger = logger
+		self._save_every = save_every
+		# serializes updates, an update and a lookup can run concurrently
+		self._lock = threading.Lock()
+		# relative path -> (mtime, size, GcodeAnalysis)
+		self._files = self.load()
+
+	def load(self):
+		try:
+			with open(self._path) as f:
+				data = json.load(f)
+		except (OSError, ValueError):
+			return {}
+		if data.get('version') != self.VERSION:
+			return {}
+		return dict(
+			(path, (entry[0], entry[1], GcodeAnalysis(*entry[2:])))
+			for (path, entry) in data['files'].items()
+		)
+
+	def save(self, files):
+		data = {
+			'version': self.VERSION,
+			'files': dict((path, [mtime, size] + list(analysis)) for (path, (mtime, size, analysis)) in files.items())
+		}
+		replace_file(self._path, json.dumps(data).encode('utf-8'))
+
+	def scan(self, folder):
+		"""Returns relative path -> (absolute path, mtime, size) of the G-code files below folder."""
+		found = {}
+		for (root, _, names) in os.walk(folder):
+			for name in names:
+				if not name.lower().endswith(GCODE_EXTENSIONS):
+					continue
+				path = os.path.join(root, name)
+				try:
+					stat = os.stat(path)
+				except OSError:
+					continue
+				found[os.path.relpath(path, folder).replace(os.sep, '/')] = (path, stat.st_mtime, stat.st_size)
+		return found
+
+	def update(self, folder, workers=None):
+		"""Brings the index up to date with folder in workers processes (default_workers() if None), returns the
+		number of analyzed files."""
+		if workers is None:
+			workers = default_workers()
+		with self._lock:
+			found = self.scan(folder)
+			files = dict((path, entry) for (path, entry) in self._files.items() if path in found)
+			changed = [
+				(path, abs_path, mtime, size) for (path, (abs_path, mtime, size)) in found.items()
+				if path not in files or files[path][:2] != (mtime, size)
+			]
+			# biggest first, so a single huge file does not end up running alone at the end
+			changed.sort(key=lambda entry: entry[3], reverse=True)
+
+			analyzed = 0
+			if changed:
+				# spawned workers do not inherit the locks held by the server's other threads
+				context = multiprocessing.get_context('spawn')
+				with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+					futures = dict(
+						(executor.submit(analyze_file, abs_path), (path, mtime, size))
+						for (path, abs_path, mtime, size) in changed
+					)
+					for future in as_completed(futures):
+						(path, mtime, size) = futures[future]
+						try:
+							files[path] = (mtime, size, future.result())
+						except Exception:
+							if self._logger is not None:
+								self._logger.exception('Failed to analyze {}'.format(path))
+							continue
+						analyzed += 1
+						if analyzed % self._save_every == 0:
+							self.save(files)
+							self._files = dict(files)
+
+			self.save(files)
+			self._files = files
+			return analyzed
+
+	def get(self, path):
+		entry = self._files.get(path)
+		return entry[2] if entry is not None else None
+
+	def paths(self):
+		return list(self._files.keys())
+
+	def totals(self, weights=None):
+		"""Returns the LibraryTotals of the indexed files, weights maps a path to how many times it counts
+		(for example how many times it was printed), unlisted paths count once if weights is None, else not at all.
+		"""
+		sums = [0] * len(GcodeAnalysis._fields)
+		count = 0
+		for (path, (_, _, analysis)) in list(self._files.items()):
+			weight = 1 if weights is None else weights.get(path, 0)
+			if not weight:
+				continue
+			count += weight
+			for (i, value) in enumerate(analysis):
+				sums[i] += weight * value
+		return LibraryTotals(count, *sums)
@@ -1,86 +1,312 @@
 """Prometheus metrics class"""
-import os
-from prometheus_client import Counter, Info, Gauge, make_wsgi_app, CollectorRegistry
-from octoprint.util import RepeatedTimer
+import hashlib
+import time
+from prometheus_client import CollectorRegistry
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, InfoMetricFamily
+from .aggregation import ExposedRegistry
+from .exposition import ExpositionCache
+from .labelstore import LabelStore
 
 
 class Metrics:
+    """Holds the exported values as plain attributes and renders them only when scraped.
 
-    registry = CollectorRegistry(auto_describe=True)
+    The hooks write the attributes directly, labelled gauges are dicts of label value -> value
+    (LabelStores bounded to path_series_max series for the ones labelled by file path), infos are
+    dicts of label name -> label value and gcode_queue_depth/gcode_queue_lag are callables
+    evaluated on scrape. labels (like the printer label) are added to every exposed series, fan_in is
+    the FanInDirectory whose other instances' metrics get exposed along with these.
+    """
 
-    def __init__(self, logger) -> None:
+    PATH_LABEL_FULL = 'full'
+    PATH_LABEL_TRUNCATE = 'truncate'
+    PATH_LABEL_HASH = 'hash'
+
+    # counters kept across restarts
+    LIFETIME_COUNTERS = (
+        'started_print_counter', 'failed_print_counter', 'done_print_counter', 'cancelled_print_counter',
+        'timelapse_counter', 'printing_time_total', 'extrusion_total', 'firmware_retracts_total',
+        'x_travel_total', 'y_travel_total', 'z_travel_total',
+    )
+
+    def __init__(self, logger, cache_ttl=1.0, path_series_max=50, path_series_ttl=0,
+                 path_label_mode=PATH_LABEL_FULL, path_label_max_length=64, labels=None, fan_in=None) -> None:
         self._logger = logger
-        if self.get_raspberry_core_temperature() is not None:
-            self.raspberry_core_temp = Gauge('octoprint_raspberry_core_temperature', 'Core temperature of Raspberry Pi', registry=self.registry)
-            self.timer = RepeatedTimer(1.0, self.report_raspberry_core_temperature)
-            self.timer.start()
-        else:
-            self._logger.info('Raspberry core temperature is not supported on this system')
-
-    def report_raspberry_core_temperature(self):
-        temperature = self.get_raspberry_core_temperature()
-        if temperature is not None:
-            self.raspberry_core_temp.set(temperature)
-
-    def get_raspberry_core_temperature(self):
-        # You need to add pi users to sudoers so it can execute the vcgencmd command
-        #
-        # root@octopi:/etc/sudoers.d# cat /etc/sudoers.d/octoprint-vcgencmd
-        # pi ALL=NOPASSWD: /usr/bin/vcgencmd
-        # root@octopi:/etc/sudoers.d#
-        if not os.path.isfile('/usr/bin/vcgencmd'):
-            return None
-        temp = os.popen('sudo /usr/bin/vcgencmd measure_temp').readline()
-        if not temp.startswith('temp='):
-            self._logger.error('Failed to execute "sudo /usr/bin/vcgencmd"')
-            self._logger.error('Raspberry core temperature will not be reported')
-            return None
-        temp = temp.replace('temp=','').replace("'C",'')
-        return float(temp)
+        self.path_label_mode = path_label_mode
+        self.path_label_max_length = path_label_max_length
+        self.registry = CollectorRegistry(auto_describe=True)
+        self.exposed = ExposedRegistry(self.registry, labels, fan_in)
+        self.created = time.time()
+        # the lifetime counters may have been created before this start, see restore_counters()
+        self.lifetime_created = self.created
+        self.cache = ExpositionCache(
+            self.exposed,
+            ttl=cache_ttl,
+            # change on every scrape, they alone would never let a body be reused
+            ignored=('octoprint_scrape_cache_hits', 'octoprint_scrape_cache_misses',
+                     'octoprint_exporter_scrape_duration_seconds', 'octoprint_exporter_scrape_size_bytes')
+        )
+
+        # Temperatures
+        self.temps_actual = {}
+        self.temps_target = {}
+        # TemperatureStats of the reports, a collector of its own
+        self.temperature_stats = None
+
+        # Metadata
+        self.client_num = 0
+        self.octoprint_info = {}
+        self.printer_state = {}
+
+        # Statistics
+        self.started_print_counter = 0
+        self.failed_print_counter = 0
+        self.done_print_counter = 0
+        self.cancelled_print_counter = 0
+        self.timelapse_counter = 0
+        self.slice_progress = LabelStore(path_series_max, path_series_ttl)
+
+        # Print information
+        self.print_progress = LabelStore(path_series_max, path_series_ttl)
+        self.print_time_elapsed = LabelStore(path_series_max, path_series_ttl)
+        self.print_time_est = LabelStore(path_series_max, path_series_ttl)
+        self.print_time_left_est = LabelStore(path_series_max, path_series_ttl)
+        self.print_fan_speed = 0
+        self.printing_time_total = 0
+
+        # Extrusion
+        self.extrusion_total = 0
+        self.extrusion_print = 0
+        self.firmware_retracts_total = 0
+
+        # Movements
+        self.x_travel_total = 0
+        self.x_travel_print = 0
+        self.y_travel_total = 0
+        self.y_travel_print = 0
+        self.z_travel_total = 0
+        self.z_travel_print = 0
+
+        # Expected by the analysis of the printed file
+        self.extrusion_expected = 0
+        self.x_travel_expected = 0
+        self.y_travel_expected = 0
+        self.z_travel_expected = 0
+        self.layers_expected = 0
+        self.fan_changes_expected = 0
+
+        # Uploads library, LibraryTotals of all files and weighted by how many times they were printed
+        self.library_totals = None
+        self.library_printed_totals = None
+
+        # MoveHistograms and LayerTimes of this print, collectors of their own
+        self.move_histograms = None
+        self.layer_times = None
+
+        # Commanded rates of the last move and the window of recent moves
+        self.flow_rate = 0
+        self.flow_rate_mean = 0
+        self.flow_rate_peak = 0
+        self.xy_speed = 0
+        self.xy_speed_mean = 0
+        self.xy_speed_peak = 0
+
+        # G-code processing
+        self.gcode_queue_depth = lambda: 0
+        self.gcode_queue_lag = lambda: 0
+        self.gcode_queue_dropped = 0
+
+        self.registry.register(self)
+
+    def path_label(self, path):
+        """Returns the label value of a file path, shortened or hashed depending on path_label_mode."""
+        if self.path_label_mode == self.PATH_LABEL_HASH:
+            return hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+        if self.path_label_mode == self.PATH_LABEL_TRUNCATE and len(path) > self.path_label_max_length:
+            # the end of a path (the file name) tells more than its start
+            return '...' + path[-(self.path_label_max_length - 3):]
+        return path
+
+    def reset_print(self):
+        """Zeroes the extrusion and travel of the current print."""
+        self.extrusion_print = 0
+        self.x_travel_print = 0
+        self.y_travel_print = 0
+        self.z_travel_print = 0
 
     def print_complete(self):
-        self.extrusion_print.set(0)
-        self.x_travel_print.set(0)
-        self.y_travel_print.set(0)
-        self.z_travel_print.set(0)   
-
-    # Temperatures
-    temps_actual = Gauge('octoprint_temperatures_actual', 'Reported temperatures', ['identifier'], registry=registry)
-    temps_target = Gauge('octoprint_temperatures_target', 'Targeted temperatures', ['identifier'], registry=registry)
-
-    # Metadata
-    client_num = Gauge('octoprint_client_num', 'The number of connected clients', registry=registry)
-    octoprint_info = Info('octoprint_infos', 'Octoprint host informations', registry=registry)
-    printer_state = Info('octoprint_printer_state', 'Printer connection info', registry=registry)
-
-    # Statistics
-    started_print_counter = Counter('octoprint_started_prints', 'Started print jobs', registry=registry)
-    failed_print_counter = Counter('octoprint_failed_prints', 'Failed print jobs', registry=registry)
-    done_print_counter = Counter('octoprint_done_prints', 'Done print jobs', registry=registry)
-    cancelled_print_counter = Counter('octoprint_cancelled_prints', 'Cancelled print jobs', registry=registry)
-    timelapse_counter = Counter('octoprint_captured_timelapses', 'Timelapse captured', registry=registry)
-    slice_progress = Gauge('octoprint_slice_progress', 'Slice progress', ['path'], registry=registry)
-
-
-    # Print information
-    print_progress = Gauge('octoprint_print_progress', 'Print progress', ['path'], registry=registry)
-    print_time_elapsed = Gauge('octoprint_print_time_elapsed', 'Print time elapsed', ['path'], registry=registry)
-    print_time_est = Gauge('octoprint_print_time_est', 'Print time estimate', ['path'], registry=registry)
-    print_time_left_est = Gauge('octoprint_print_time_left_estimate', 'Print time left estimate', ['path'], registry=registry)
-    print_fan_speed = Gauge('octoprint_print_fan_speed', 'Fan speed', registry=registry)
-    printing_time_total = Counter('octoprint_printing_time_total', 'Printing time total', registry=registry)
-    
-    # Extrusion
-    extrusion_total = Counter('octoprint_extrusion_total', 'Filament extruded total', registry=registry)
-    extrusion_print = Gauge('octoprint_extrusion_print', 'Filament extruded this print', registry=registry)
-
-    # Movements
-    x_travel_total = Counter('octoprint_x_travel_total', 'X axis travel total', registry=registry)
-    x_travel_print = Gauge('octoprint_x_travel_print', 'X axis travel in this print', registry=registry)
-    y_travel_total = Counter('octoprint_y_travel_total', 'Y axis travel total', registry=registry)
-    y_travel_print = Gauge('octoprint_y_travel_print', 'Y axis travel in this print', registry=registry)
-    z_travel_total = Counter('octoprint_z_travel_total', 'Z axis travel total', registry=registry)
-    z_travel_print = Gauge('octoprint_z_travel_print', 'Z axis travel in this print', registry=registry)
-
-    def render(self):
-        return make_wsgi_app(registry=self.registry)
+        self.reset_print()
+        self.set_rates(None)
+        self.set_expected(None)
+
+    def lifetime_counters(self):
+        """Returns the lifetime counters and when they were created."""
+        counters = dict((name, getattr(self, name)) for name in self.LIFETIME_COUNTERS)
+        counters['created'] = self.lifetime_created
+        return counters
+
+    def restore_counters(self, counters):
+        """Continues the lifetime counters from the values returned by lifetime_counters()."""
+        for name in self.LIFETIME_COUNTERS:
+            if name in counters:
+                setattr(self, name, counters[name])
+        self.lifetime_created = counters.get('created', self.lifetime_created)
+
+    def set_rates(self, rates):
+        """Sets the rates from a MoveRates snapshot, None resets them."""
+        (self.flow_rate, self.flow_rate_mean, self.flow_rate_peak,
+         self.xy_speed, self.xy_speed_mean, self.xy_speed_peak) = rates or (0, 0, 0, 0, 0, 0)
+
+    def set_expected(self, analysis):
+        """Sets the expected values of the current print from a GcodeAnalysis, None resets them."""
+        self.extrusion_expected = analysis.extrusion if analysis else 0
+        self.x_travel_expected = analysis.x_travel if analysis else 0
+        self.y_travel_expected = analysis.y_travel if analysis else 0
+        self.z_travel_expected = analysis.z_travel if analysis else 0
+        self.layers_expected = analysis.layers if analysis else 0
+        self.fan_changes_expected = analysis.fan_changes if analysis else 0
+
+    def gauge(self, name, documentation, value):
+        return GaugeMetricFamily(name, documentation, value=value)
+
+    def labelled_gauge(self, name, documentation, label, values):
+        family = GaugeMetricFamily(name, documentation, labels=[label])
+        # copy first, the hooks may add labels while we are rendering
+        for (label_value, value) in list(values.items()):
+            family.add_metric([label_value], value)
+        return family
+
+    def counter(self, name, documentation, value):
+        return CounterMetricFamily(name, documentation, value=value, created=self.created)
+
+    def lifetime_counter(self, name, documentation, value):
+        return CounterMetricFamily(name, documentation, value=value, created=self.lifetime_created)
+
+    def info(self, name, documentation, value):
+        return InfoMetricFamily(name, documentation, value=dict(value))
+
+    def library_gauges(self):
+        scopes = (('all', self.library_totals), ('printed', self.library_printed_totals))
+        for (field, name, documentation) in (
+                ('files', 'octoprint_library_files', 'G-code files in the uploads library'),
+                ('extrusion', 'octoprint_library_extrusion', 'Filament extruded by the uploads library'),
+                ('x_travel', 'octoprint_library_x_travel', 'X axis travel of the uploads library'),
+                ('y_travel', 'octoprint_library_y_travel', 'Y axis travel of the uploads library'),
+                ('z_travel', 'octoprint_library_z_travel', 'Z axis travel of the uploads library'),
+                ('layers', 'octoprint_library_layers', 'Layers of the uploads library')):
+            family = GaugeMetricFamily(name, documentation, labels=['scope'])
+            for (scope, totals) in scopes:
+                if totals is not None:
+                    family.add_metric([scope], getattr(totals, field))
+            yield family
+
+    def describe(self):
+        # the registry learns the family names /metrics?name[]= can select from this, the library gauges
+        # are only collected once there are totals
+        families = list(self.collect())
+        if self.library_totals is None:
+            families.extend(self.library_gauges())
+        return families
+
+    def collect(self):
+        # Temperatures
+        yield self.labelled_gauge('octoprint_temperatures_actual', 'Reported temperatures', 'identifier',
+                                  self.temps_actual)
+        yield self.labelled_gauge('octoprint_temperatures_target', 'Targeted temperatures', 'identifier',
+                                  self.temps_target)
+
+        # Metadata
+        yield self.gauge('octoprint_client_num', 'The number of connected clients', self.client_num)
+        yield self.info('octoprint_infos', 'Octoprint host informations', self.octoprint_info)
+        yield self.info('octoprint_printer_state', 'Printer connection info', self.printer_state)
+
+        # Statistics
+        yield self.lifetime_counter('octoprint_started_prints', 'Started print jobs', self.started_print_counter)
+        yield self.lifetime_counter('octoprint_failed_prints', 'Failed print jobs', self.failed_print_counter)
+        yield self.lifetime_counter('octoprint_done_prints', 'Done print jobs', self.done_print_counter)
+        yield self.lifetime_counter('octoprint_cancelled_prints', 'Cancelled print jobs', self.cancelled_print_counter)
+        yield self.lifetime_counter('octoprint_captured_timelapses', 'Timelapse captured', self.timelapse_counter)
+        yield self.labelled_gauge('octoprint_slice_progress', 'Slice progress', 'path', self.slice_progress)
+
+        # Print information
+        yield self.labelled_gauge('octoprint_print_progress', 'Print progress', 'path', self.print_progress)
+        yield self.labelled_gauge('octoprint_print_time_elapsed', 'Print time elapsed', 'path', self.print_time_elapsed)
+        yield self.labelled_gauge('octoprint_print_time_est', 'Print time estimate', 'path', self.print_time_est)
+        yield self.labelled_gauge('octoprint_print_time_left_estimate', 'Print time left estimate', 'path',
+                                  self.print_time_left_est)
+        yield self.gauge('octoprint_print_fan_speed', 'Fan speed', self.print_fan_speed)
+        yield self.lifetime_counter('octoprint_printing_time_total', 'Printing time total', self.printing_time_total)
+
+        # Extrusion
+        yield self.lifetime_counter('octoprint_extrusion_total', 'Filament extruded total', self.extrusion_total)
+        yield self.gauge('octoprint_extrusion_print', 'Filament extruded this print', self.extrusion_print)
+        yield self.lifetime_counter('octoprint_firmware_retracts', 'Firmware retracts (G10) total',
+                                    self.firmware_retracts_total)
+
+        # Movements
+        yield self.lifetime_counter('octoprint_x_travel_total', 'X axis travel total', self.x_travel_total)
+        yield self.gauge('octoprint_x_travel_print', 'X axis travel in this print', self.x_travel_print)
+        yield self.lifetime_counter('octoprint_y_travel_total', 'Y axis travel total', self.y_travel_total)
+        yield self.gauge('octoprint_y_travel_print', 'Y axis travel in this print', self.y_travel_print)
+        yield self.lifetime_counter('octoprint_z_travel_total', 'Z axis travel total', self.z_travel_total)
+        yield self.gauge('octoprint_z_travel_print', 'Z axis travel in this print', self.z_travel_print)
+
+        # Moves
+        yield self.gauge('octoprint_volumetric_flow', 'Commanded volumetric flow of the last move in mm³/s',
+                         self.flow_rate)
+        yield self.gauge('octoprint_volumetric_flow_mean', 'Commanded volumetric flow of the recent moves in mm³/s',
+                         self.flow_rate_mean)
+        yield self.gauge('octoprint_volumetric_flow_peak',
+                         'Highest commanded volumetric flow of the recent moves in mm³/s',
+                         self.flow_rate_peak)
+        yield self.gauge('octoprint_xy_speed', 'Commanded XY speed of the last move in mm/s', self.xy_speed)
+        yield self.gauge('octoprint_xy_speed_mean', 'Commanded XY speed of the recent moves in mm/s',
+                         self.xy_speed_mean)
+        yield self.gauge('octoprint_xy_speed_peak', 'Highest commanded XY speed of the recent moves in mm/s',
+                         self.xy_speed_peak)
+
+        # Expected
+        yield self.gauge('octoprint_extrusion_expected', 'Filament to extrude in this print', self.extrusion_expected)
+        yield self.gauge('octoprint_extrusion_progress', 'Filament extruded this print in percent of the expected',
+                         100.0 * self.extrusion_print / self.extrusion_expected if self.extrusion_expected else 0)
+        yield self.gauge('octoprint_x_travel_expected', 'X axis travel expected in this print', self.x_travel_expected)
+        yield self.gauge('octoprint_y_travel_expected', 'Y axis travel expected in this print', self.y_travel_expected)
+        yield self.gauge('octoprint_z_travel_expected', 'Z axis travel expected in this print', self.z_travel_expected)
+        yield self.gauge('octoprint_layers_expected', 'Layers in this print', self.layers_expected)
+        yield self.gauge('octoprint_fan_changes_expected', 'Fan speed changes in this print', self.fan_changes_expected)
+
+        # Library
+        if self.library_totals is not None:
+            yield from self.library_gauges()
+
+        # G-code processing
+        yield self.gauge('octoprint_gcode_queue_depth', 'Sent G-code lines waiting to be processed',
+                         self.gcode_queue_depth())
+        yield self.gauge('octoprint_gcode_queue_lag_seconds',
+                         'Age of the oldest sent G-code line waiting to be processed',
+                         self.gcode_queue_lag())
+        yield self.counter('octoprint_gcode_queue_dropped', 'Sent G-code lines dropped because the queue was full',
+                           self.gcode_queue_dropped)
+
+        # Path labelled series evicted from their LabelStores
+        family = CounterMetricFamily('octoprint_evicted_series',
+                                     'Path labelled series evicted because there were too many or they were too old',
+                                     labels=['family'], created=self.created)
+        for (name, store) in (('octoprint_slice_progress', self.slice_progress),
+                              ('octoprint_print_progress', self.print_progress),
+                              ('octoprint_print_time_elapsed', self.print_time_elapsed),
+                              ('octoprint_print_time_est', self.print_time_est),
+                              ('octoprint_print_time_left_estimate', self.print_time_left_est)):
+            family.add_metric([name], store.evicted)
+        yield family
+
+        # Scrapes
+        yield self.counter('octoprint_scrape_cache_hits', 'Scrapes served from the cached exposition', self.cache.hits)
+        yield self.counter('octoprint_scrape_cache_misses', 'Scrapes that had to serialize the metrics',
+                           self.cache.misses)
+
+    def render(self, accept=None, accept_encoding=None, names=None):
+        """Returns the (body, headers) of a /metrics response, names restricts it to the given series."""
+        if names:
+            return self.cache.render_uncached(self.exposed.restricted_registry(names), accept, accept_encoding)
+        return self.cache.render(accept, accept_encoding)
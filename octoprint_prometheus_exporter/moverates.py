@@ -0,0 +1,61 @@
+"""Commanded volumetric flow and XY speed"""
+import math
+
+
+class MoveRates:
+	"""Commanded volumetric flow (mm³/s) and XY speed (mm/s) of the last window G0/G1 moves.
+
+	Every move with XY motion and a known feedrate takes one slot of a fixed size ring buffer, so observing
+	is a few stores and does not allocate. The window mean is weighted by the commanded duration of the
+	moves (the volume over the time they take), not by their count. Not thread safe, the worker only uses it
+	under its lock.
+	"""
+
+	def __init__(self, filament_diameter=1.75, window=100) -> None:
+		self._area = math.pi * (filament_diameter / 2.0) ** 2
+		self._window = max(int(window), 1)
+		self.reset()
+
+	def reset(self):
+		window = self._window
+		self._durations = [0.0] * window
+		self._volumes = [0.0] * window
+		self._lengths = [0.0] * window
+		self._flows = [0.0] * window
+		self._speeds = [0.0] * window
+		self._index = 0
+		self._observed = False
+
+	def observe(self, parser):
+		"""Observes the move the parser processed last, moves without XY motion or feedrate are skipped."""
+		length = parser.move_xy_length
+		if not length or not parser.speed:
+			return
+		# F is in mm/min
+		speed = parser.speed / 60.0
+		duration = length / speed
+		volume = parser.move_extrusion * self._area
+
+		i = self._index
+		self._durations[i] = duration
+		self._volumes[i] = volume
+		self._lengths[i] = length
+		self._flows[i] = volume / duration
+		self._speeds[i] = speed
+		self._index = (i + 1) % self._window
+		self._observed = True
+
+	def snapshot(self):
+		"""Returns (flow, mean flow, peak flow, speed, mean speed, peak speed), the first of each being
+		the last move's, or None if no move was observed since the last snapshot.
+		"""
+		if not self._observed:
+			return None
+		self._observed = False
+
+		last = self._index - 1
+		duration = sum(self._durations)
+		return (
+			self._flows[last], sum(self._volumes) / duration, max(self._flows),
+			self._speeds[last], sum(self._lengths) / duration, max(self._speeds),
+		)
@@ -0,0 +1,241 @@
+"""Pushing metrics to a Pushgateway or an import endpoint"""
+import base64
+import gzip
+import os
+import random
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import deque
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.metrics_core import Metric
+
+# spooled bodies, named so they sort oldest first
+SPOOL_SUFFIX = '.prom'
+
+
+def grouping_path(name, value):
+	"""Returns the /<name>/<value> of a Pushgateway URL, values that are empty or contain a slash in the
+	base64 form the Pushgateway decodes, others URL quoted."""
+	if value == '' or '/' in value:
+		return '/{}@base64/{}'.format(name, base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii') or '=')
+	return '/{}/{}'.format(name, urllib.parse.quote(value, safe=''))
+
+
+class _Timestamped:
+	"""The families of a registry with every sample stamped with the collection time."""
+
+	def __init__(self, registry, timestamp) -> None:
+		self._registry = registry
+		self._timestamp = timestamp
+
+	def collect(self):
+		for family in self._registry.collect():
+			copy = Metric(family.name, family.documentation, family.type, family.unit)
+			copy.samples = [sample._replace(timestamp=self._timestamp) for sample in family.samples]
+			yield copy
+
+
+class PushBuffer:
+	"""Bounded FIFO of bodies waiting to be pushed.
+
+	Up to size bodies are kept in memory, older ones are spilled to files in spool_folder (if given) which
+	also outlive a restart. Beyond spool_size spooled bodies the oldest are dropped and counted in dropped.
+	"""
+
+	def __init__(self, size=20, spool_folder=None, spool_size=1000) -> None:
+		self._size = size
+		self._spool_folder = spool_folder
+		self._spool_size = spool_size
+		self._memory = deque()
+		self._spooled = deque(self.spooled_files())
+		self._sequence = 0
+		self.dropped = 0
+
+	def spooled_files(self):
+		if self._spool_folder is None or not os.path.isdir(self._spool_folder):
+			return []
+		return sorted(name for name in os.listdir(self._spool_folder) if name.endswith(SPOOL_SUFFIX))
+
+	def __len__(self):
+		return len(self._spooled) + len(self._memory)
+
+	def append(self, body):
+		self._memory.append(body)
+		while len(self._memory) > self._size:
+			self.spool(self._memory.popleft())
+
+	def spool(self, body):
+		if self._spool_folder is None:
+			self.dropped += 1
+			return
+		if not os.path.isdir(self._spool_folder):
+			os.makedirs(self._spool_folder)
+		self._sequence += 1
+		name = '{:020d}-{:06d}{}'.format(time.time_ns(), self._sequence % 1000000, SPOOL_SUFFIX)
+		with open(os.path.join(self._spool_folder, name), 'wb') as f:
+			f.write(body)
+		self._spooled.append(name)
+		while len(self._spooled) > self._spool_size:
+			self.remove(self._spooled.popleft())
+			self.dropped += 1
+
+	def remove(self, name):
+		try:
+			os.remove(os.path.join(self._spool_folder, name))
+		except OSError:
+			pass
+
+	def peek(self):
+		"""Returns the oldest body, None if there is none."""
+		while self._spooled:
+			try:
+				with open(os.path.join(self._spool_folder, self._spooled[0]), 'rb') as f:
+					return f.read()
+			except OSError:
+				# removed from outside
+				self._spooled.popleft()
+		return self._memory[0] if self._memory else None
+
+	def pop(self):
+		"""Removes the oldest body."""
+		if self._spooled:
+			self.remove(self._spooled.popleft())
+		elif self._memory:
+			self._memory.popleft()
+
+	def spill(self):
+		"""Moves the bodies in memory to the spool folder, if there is one."""
+		if self._spool_folder is None:
+			return
+		while self._memory:
+			self.spool(self._memory.popleft())
+
+	def clear(self):
+		while self:
+			self.pop()
+
+
+class Pusher:
+	"""Pushes the exposition of a registry every interval seconds from its own thread.
+
+	In pushgateway mode the body replaces the group of job (and the printer label) on a Pushgateway, only the
+	latest collection is worth sending, so one that could not be pushed is replaced by the next. In import mode
+	(for endpoints taking timestamped text exposition, like VictoriaMetrics' /api/v1/import/prometheus)
+	every collection is stamped and buffered in a PushBuffer until it was delivered, oldest first. After a
+	failure the next attempt is delayed exponentially (with jitter) up to backoff_max seconds.
+	"""
+
+	MODE_PUSHGATEWAY = 'pushgateway'
+	MODE_IMPORT = 'import'
+
+	def __init__(
+		self, registry, url, logger, mode=MODE_PUSHGATEWAY, job='octoprint', grouping=None, interval=15.0,
+		compress=False, buffer=None, backoff_max=300.0, timeout=10.0, username=None, password=None
+	) -> None:
+		self._registry = registry
+		self._logger = logger
+		self._mode = mode
+		self._interval = interval
+		self._compress = compress
+		self._buffer = buffer if buffer is not None else PushBuffer()
+		self._backoff_max = backoff_max
+		self._timeout = timeout
+		self._url = url
+		self._method = 'POST'
+		if mode == self.MODE_PUSHGATEWAY:
+			self._url = url.rstrip('/') + '/metrics' + grouping_path('job', job)
+			for (name, value) in (grouping or {}).items():
+				self._url += grouping_path(name, value)
+			self._method = 'PUT'
+		self._headers = {'Content-Type': CONTENT_TYPE_LATEST}
+		if compress:
+			self._headers['Content-Encoding'] = 'gzip'
+		if username:
+			credentials = '{}:{}'.format(username, password or '').encode('utf-8')
+			self._headers['Authorization'] = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+		self._failures = 0
+		self._stopped = threading.Event()
+		self._thread = None
+		self.pushed = 0
+		self.failed = 0
+
+	def start(self):
+		self._thread = threading.Thread(target=self._run, name='PrometheusExporterPusher')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	def collect(self):
+		yield CounterMetricFamily('octoprint_push', 'Bodies pushed', value=self.pushed)
+		yield CounterMetricFamily('octoprint_push_failures', 'Failed push attempts', value=self.failed)
+		yield CounterMetricFamily(
+			'octoprint_push_dropped', 'Bodies dropped because the push buffer was full', value=self._buffer.dropped
+		)
+		yield GaugeMetricFamily('octoprint_push_pending', 'Bodies waiting to be pushed', value=len(self._buffer))
+
+	def snapshot(self):
+		"""Collects the registry into a body and queues it."""
+		if self._mode == self.MODE_IMPORT:
+			body = generate_latest(_Timestamped(self._registry, time.time()))
+		else:
+			body = generate_latest(self._registry)
+			self._buffer.clear()
+		if self._compress:
+			body = gzip.compress(body)
+		self._buffer.append(body)
+
+	def send(self, body):
+		request = urllib.request.Request(self._url, data=body, headers=self._headers, method=self._method)
+		with urllib.request.urlopen(request, timeout=self._timeout) as response:
+			response.read()
+
+	def push(self):
+		"""Sends the queued bodies oldest first, returns False once one could not be sent."""
+		while True:
+			body = self._buffer.peek()
+			if body is None:
+				return True
+			try:
+				self.send(body)
+			except Exception as e:
+				self.failed += 1
+				self._logger.warning('Failed to push the metrics to {}: {}'.format(self._url, e))
+				return False
+			self._buffer.pop()
+			self.pushed += 1
+
+	def backoff(self):
+		"""Returns the seconds to wait before retrying after the current run of failures."""
+		backoff = min(self._interval * 2 ** self._failures, self._backoff_max)
+		# spread out, so instances that lost the same network do not retry in lockstep
+		return backoff * random.uniform(0.5, 1.0)
+
+	def _run(self):
+		next_snapshot = next_attempt = time.monotonic()
+		while True:
+			now = time.monotonic()
+			if now >= next_snapshot:
+				try:
+					self.snapshot()
+				except Exception:
+					self._logger.exception('Failed to collect the metrics to push')
+				next_snapshot = now + self._interval
+			if now >= next_attempt:
+				if self.push():
+					self._failures = 0
+					next_attempt = next_snapshot
+				else:
+					self._failures += 1
+					next_attempt = now + self.backoff()
+			if self._stopped.wait(max(min(next_snapshot, next_attempt) - time.monotonic(), 0)):
+				# keep what was not delivered for the next start
+				self._buffer.spill()
+				return
@@ -0,0 +1,95 @@
+"""Delayed label expiry"""
+import heapq
+import itertools
+import threading
+import time
+
+
+class LabelScheduler:
+	"""Runs delayed callbacks, keyed so a label's expiry can be pushed back or cancelled, on a single thread.
+
+	Every key has at most one pending callback. Scheduling an already pending key moves its deadline, pushing
+	it back is O(1) as the heap entry is only re-queued once its old deadline is reached, so keys refreshed
+	on every update (like temperature identifiers) stay cheap. clock is the time source, tests can pass a fake
+	one and call run_pending() instead of starting the thread.
+	"""
+
+	def __init__(self, logger, clock=time.monotonic) -> None:
+		self._logger = logger
+		self._clock = clock
+		self._condition = threading.Condition()
+		# key -> (deadline, callback, args)
+		self._pending = {}
+		# (deadline, sequence, key), may hold outdated deadlines of rescheduled or cancelled keys
+		self._heap = []
+		self._sequence = itertools.count()
+		self._stopped = False
+		self._thread = None
+
+	def start(self):
+		self._thread = threading.Thread(target=self._run, name='PrometheusExporterLabelScheduler')
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		with self._condition:
+			self._stopped = True
+			self._condition.notify()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	def schedule(self, key, delay, callback, *args):
+		"""Runs callback(*args) in delay seconds, replacing the pending callback of key."""
+		deadline = self._clock() + delay
+		with self._condition:
+			pending = self._pending.get(key)
+			self._pending[key] = (deadline, callback, args)
+			if pending is None or deadline < pending[0]:
+				heapq.heappush(self._heap, (deadline, next(self._sequence), key))
+				if self._heap[0][2] == key:
+					self._condition.notify()
+
+	def cancel(self, key):
+		with self._condition:
+			self._pending.pop(key, None)
+
+	def is_pending(self, key):
+		with self._condition:
+			return key in self._pending
+
+	def run_pending(self):
+		"""Runs the callbacks that are due, returns the seconds until the next one or None if there is none."""
+		due = []
+		with self._condition:
+			now = self._clock()
+			while self._heap and self._heap[0][0] <= now:
+				(deadline, _, key) = heapq.heappop(self._heap)
+				pending = self._pending.get(key)
+				if pending is None:
+					continue
+				if pending[0] > now:
+					# pushed back since, wait for the new deadline
+					heapq.heappush(self._heap, (pending[0], next(self._sequence), key))
+					continue
+				del self._pending[key]
+				due.append(pending)
+			delay = self._heap[0][0] - now if self._heap else None
+
+		for (_, callback, args) in due:
+			try:
+				callback(*args)
+			except Exception:
+				self._logger.exception('Failed to run scheduled callback {}'.format(callback))
+		return delay
+
+	def _run(self):
+		while True:
+			self.run_pending()
+			with self._condition:
+				if self._stopped:
+					return
+				# checked under the lock, so a callback scheduled meanwhile is not missed
+				delay = self._heap[0][0] - self._clock() if self._heap else None
+				if delay is None or delay > 0:
+					self._condition.wait(delay)
@@ -0,0 +1,85 @@
+"""The exporter's own cost"""
+import threading
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+from .histograms import BucketCounter
+
+# threads of the plugin are named with this prefix
+THREAD_PREFIX = 'PrometheusExporter'
+
+HOOK_DURATION_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3, 1e-2)
+SCRAPE_DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# every kind Gcode_parser.process_line returns, None for lines it does not recognize
+GCODE_KINDS = (
+	"movement", "print_fan_speed", "coordinate_modeswitch", "coordinate_reset", "firmware_retract", None
+)
+
+
+class SelfMetrics:
+	"""Execution time of the hooks, G-code lines by parser result, scrape cost and the plugin's threads.
+
+	Only every sample_every-th call of a hook is timed, the others cost a counter increment. Each hook is
+	only called from one thread (the comm thread), so the call counters need no lock. gcode_kinds is filled
+	by the G-code worker, which counts every line.
+	"""
+
+	def __init__(self, sample_every=100) -> None:
+		self._sample_every = max(int(sample_every), 1)
+		self._lock = threading.Lock()
+		self._calls = {}
+		self._hook_durations = {}
+		self._scrape_durations = BucketCounter(SCRAPE_DURATION_BUCKETS)
+		self._scrape_size = 0
+		self.gcode_kinds = dict((kind, 0) for kind in GCODE_KINDS)
+
+	def sample(self, hook):
+		"""Counts a call of hook, returns whether this one should be timed."""
+		calls = self._calls.get(hook, 0) + 1
+		self._calls[hook] = calls
+		return calls % self._sample_every == 0
+
+	def observe(self, hook, duration):
+		with self._lock:
+			durations = self._hook_durations.get(hook)
+			if durations is None:
+				durations = self._hook_durations[hook] = BucketCounter(HOOK_DURATION_BUCKETS)
+			durations.observe(duration)
+
+	def observe_scrape(self, duration, size):
+		with self._lock:
+			self._scrape_durations.observe(duration)
+			self._scrape_size = size
+
+	def collect(self):
+		calls = CounterMetricFamily('octoprint_exporter_hook_calls', 'Calls of the hooks of the exporter', labels=['hook'])
+		hook_durations = HistogramMetricFamily(
+			'octoprint_exporter_hook_duration_seconds',
+			'Execution time of a sample of the hook calls, 1 in {}'.format(self._sample_every),
+			labels=['hook']
+		)
+		lines = CounterMetricFamily('octoprint_exporter_gcode_lines', 'Sent G-code lines by parser result', labels=['kind'])
+		with self._lock:
+			for (hook, count) in list(self._calls.items()):
+				calls.add_metric([hook], count)
+			for (hook, durations) in self._hook_durations.items():
+				hook_durations.add_metric([hook], durations.buckets(), durations.sum)
+			scrape_durations = self._scrape_durations.family(
+				'octoprint_exporter_scrape_duration_seconds', 'Time it took to render /metrics'
+			)
+			scrape_size = self._scrape_size
+		for (kind, count) in list(self.gcode_kinds.items()):
+			lines.add_metric([kind or 'unrecognized'], count)
+
+		yield calls
+		yield hook_durations
+		yield lines
+		yield scrape_durations
+		yield GaugeMetricFamily(
+			'octoprint_exporter_scrape_size_bytes', 'Size of the last /metrics response', value=scrape_size
+		)
+		threads = threading.enumerate()
+		yield GaugeMetricFamily(
+			'octoprint_exporter_threads', 'Running threads of the exporter',
+			value=sum(1 for thread in threads if thread.name.startswith(THREAD_PREFIX))
+		)
+		yield GaugeMetricFamily('octoprint_python_threads', 'Running threads of the OctoPrint process', value=len(threads))
@@ -0,0 +1,108 @@
+"""Serial link throughput and send/ok latency"""
+import threading
+import time
+from collections import deque
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from .histograms import BucketCounter
+
+
+class SerialLink:
+	"""Lines and bytes sent to the printer, the time until each was acknowledged and the resend/busy replies.
+
+	The firmware acknowledges the lines with one "ok" each, in the order they were sent, so the send times
+	wait in a FIFO that every ok pops the oldest of. The FIFO is bounded by max_in_flight, if oks get lost
+	(or were never sent, like by a firmware that does not acknowledge some commands) the oldest send times
+	fall out instead of piling up. A resend request invalidates the matching: the lines after the one that
+	got corrupted are sent again, so the FIFO is emptied and matching starts over with the next send.
+
+	sent() runs on OctoPrint's send thread and received() on its monitoring thread, deque appends and pops
+	are atomic, only observing a latency takes the lock collect() takes. Firmwares with ADVANCED_OK report
+	the free planner and command buffer slots in their oks, these are exported as they come.
+	"""
+
+	def __init__(
+		self, latency_buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+		max_in_flight=64, clock=time.monotonic
+	) -> None:
+		self._clock = clock
+		self._lock = threading.Lock()
+		self._in_flight = deque(maxlen=max_in_flight)
+		self._latencies = BucketCounter(latency_buckets)
+		self.lines = 0
+		self.bytes = 0
+		self.acks = 0
+		self.unmatched = 0
+		self.resends = 0
+		self.busy = 0
+		self.planner_free = None
+		self.buffer_free = None
+
+	def sent(self, line):
+		self.lines += 1
+		# the line numbers and checksums OctoPrint adds are not part of the line the hook gets
+		self.bytes += len(line) + 1
+		self._in_flight.append(self._clock())
+
+	def received(self, line):
+		if line.startswith('ok'):
+			self.acks += 1
+			try:
+				sent = self._in_flight.popleft()
+			except IndexError:
+				self.unmatched += 1
+			else:
+				latency = self._clock() - sent
+				with self._lock:
+					self._latencies.observe(latency)
+			if len(line) > 2:
+				self.advanced_ok(line)
+		elif line.startswith('Resend') or line.startswith('rs '):
+			self.resends += 1
+			self._in_flight.clear()
+		elif 'busy:' in line:
+			self.busy += 1
+
+	def advanced_ok(self, line):
+		# ok N<line> P<planner slots> B<command buffer slots>
+		for word in line.split():
+			if len(word) > 1 and word[1:].isdigit():
+				if word[0] == 'P':
+					self.planner_free = int(word[1:])
+				elif word[0] == 'B':
+					self.buffer_free = int(word[1:])
+
+	def reset(self):
+		"""Forgets the lines in flight, the connection to the printer was closed."""
+		self._in_flight.clear()
+		self.planner_free = None
+		self.buffer_free = None
+
+	def collect(self):
+		yield CounterMetricFamily('octoprint_serial_lines_sent', 'Lines sent to the printer', value=self.lines)
+		yield CounterMetricFamily(
+			'octoprint_serial_bytes_sent',
+			'Bytes of the lines sent to the printer, without line numbers and checksums',
+			value=self.bytes
+		)
+		yield CounterMetricFamily('octoprint_serial_acks', 'ok replies of the printer', value=self.acks)
+		yield CounterMetricFamily(
+			'octoprint_serial_acks_unmatched', 'ok replies without a line in flight', value=self.unmatched
+		)
+		yield CounterMetricFamily('octoprint_serial_resends', 'Resend requests of the printer', value=self.resends)
+		yield CounterMetricFamily('octoprint_serial_busy', 'busy replies of the printer', value=self.busy)
+		yield GaugeMetricFamily(
+			'octoprint_serial_in_flight', 'Lines sent and not acknowledged yet', value=len(self._in_flight)
+		)
+		with self._lock:
+			latencies = self._latencies.family(
+				'octoprint_serial_ack_latency_seconds', 'Time from sending a line until the printer acknowledged it'
+			)
+		yield latencies
+		# always yielded, without a sample until reported, so the registry knows them from the start
+		for (name, documentation, value) in (
+				('octoprint_serial_planner_free', 'Free planner buffer slots the printer last reported', self.planner_free),
+				('octoprint_serial_command_buffer_free', 'Free command buffer slots the printer last reported', self.buffer_free)):
+			family = GaugeMetricFamily(name, documentation, labels=[])
+			if value is not None:
+				family.add_metric([], value)
+			yield family
@@ -0,0 +1,118 @@
+"""Windowed temperature statistics"""
+import math
+import threading
+import time
+from prometheus_client.core import GaugeMetricFamily, HistogramMetricFamily
+from .histograms import BucketCounter
+
+
+class TemperatureWindow:
+	"""Count, mean, spread, min and max of the reports of one identifier over the last window seconds.
+
+	The window is split into slots, every report updates the current slot in place (Welford's algorithm),
+	so a report is O(1) and the memory is fixed. Reading combines the slots of the window, it slides by
+	one slot length.
+	"""
+
+	def __init__(self, window=15.0, slots=5) -> None:
+		self._slot_length = window / slots
+		# [slot number, count, mean, sum of squared differences from the mean, min, max]
+		self._slots = [[None, 0, 0.0, 0.0, 0.0, 0.0] for _ in range(slots)]
+
+	def observe(self, value, now):
+		number = int(now // self._slot_length)
+		slot = self._slots[number % len(self._slots)]
+		if slot[0] != number:
+			slot[:] = [number, 1, value, 0.0, value, value]
+			return
+		slot[1] += 1
+		delta = value - slot[2]
+		slot[2] += delta / slot[1]
+		slot[3] += delta * (value - slot[2])
+		if value < slot[4]:
+			slot[4] = value
+		elif value > slot[5]:
+			slot[5] = value
+
+	def stats(self, now):
+		"""Returns (count, mean, stddev, min, max) of the window, None if there was no report in it."""
+		oldest = int(now // self._slot_length) - len(self._slots)
+		count = 0
+		mean = m2 = 0.0
+		low = high = None
+		for (number, slot_count, slot_mean, slot_m2, slot_min, slot_max) in self._slots:
+			if number is None or number <= oldest:
+				continue
+			# combines the slots as in Chan et al.'s parallel variance
+			total = count + slot_count
+			delta = slot_mean - mean
+			mean += delta * slot_count / total
+			m2 += slot_m2 + delta * delta * count * slot_count / total
+			count = total
+			low = slot_min if low is None else min(low, slot_min)
+			high = slot_max if high is None else max(high, slot_max)
+		if not count:
+			return None
+		return (count, mean, math.sqrt(m2 / count), low, high)
+
+
+class TemperatureStats:
+	"""Windowed statistics of the reported temperatures and a histogram of their deviation from the target.
+
+	Only reports with a target above 0 (a heater that is on) go into the deviation histogram, which counts
+	for as long as the identifier is reported.
+	"""
+
+	def __init__(
+		self, window=15.0, deviation_buckets=(-10, -5, -2, -1, -0.5, 0.5, 1, 2, 5, 10), clock=time.monotonic
+	) -> None:
+		self._window = window
+		self._deviation_buckets = deviation_buckets
+		self._clock = clock
+		self._lock = threading.Lock()
+		self._windows = {}
+		self._deviations = {}
+
+	def observe(self, identifier, actual, target):
+		with self._lock:
+			window = self._windows.get(identifier)
+			if window is None:
+				window = self._windows[identifier] = TemperatureWindow(self._window)
+			window.observe(actual, self._clock())
+			if target:
+				deviations = self._deviations.get(identifier)
+				if deviations is None:
+					deviations = self._deviations[identifier] = BucketCounter(self._deviation_buckets)
+				deviations.observe(actual - target)
+
+	def pop(self, identifier):
+		with self._lock:
+			self._windows.pop(identifier, None)
+			self._deviations.pop(identifier, None)
+
+	def collect(self):
+		families = [
+			GaugeMetricFamily(name, documentation, labels=['identifier'])
+			for (name, documentation) in (
+				('octoprint_temperatures_actual_min', 'Lowest reported temperature of the window'),
+				('octoprint_temperatures_actual_max', 'Highest reported temperature of the window'),
+				('octoprint_temperatures_actual_mean', 'Mean reported temperature of the window'),
+				('octoprint_temperatures_actual_stddev', 'Standard deviation of the reported temperatures of the window'),
+			)
+		]
+		deviation = HistogramMetricFamily(
+			'octoprint_temperature_deviation', 'Reported minus targeted temperature of the heated reports',
+			labels=['identifier']
+		)
+		now = self._clock()
+		with self._lock:
+			for (identifier, window) in self._windows.items():
+				stats = window.stats(now)
+				if stats is None:
+					continue
+				(_, mean, stddev, low, high) = stats
+				for (family, value) in zip(families, (low, high, mean, stddev)):
+					family.add_metric([identifier], value)
+			for (identifier, deviations) in self._deviations.items():
+				deviation.add_metric([identifier], deviations.buckets(), deviations.sum)
+		return families + [deviation]
@@ -0,0 +1,64 @@
+import logging
+
+import pytest
+
+
+class StubSettings:
+	"""Plugin settings backed by a dict of the defaults."""
+
+	def __init__(self, values) -> None:
+		self._values = values
+
+	def get(self, path):
+		return self._values.get(path[0])
+
+	get_int = get_float = get_boolean = get
+
+
+class StubPrinter:
+	def get_current_data(self):
+		return {
+			'progress': {'printTime': None, 'printTimeLeft': None},
+			'job': {'estimatedPrintTime': None}
+		}
+
+
+class FakeClock:
+	def __init__(self) -> None:
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+
+@pytest.fixture
+def clock():
+	"""A clock standing still until the test advances its now."""
+	return FakeClock()
+
+
+@pytest.fixture
+def make_plugin(tmp_path):
+	"""Returns a factory of initialized plugins with the given settings overriding the defaults, stubbed
+	printer and the data folder in tmp_path. Their threads are stopped after the test."""
+	octoprint_prometheus_exporter = pytest.importorskip('octoprint_prometheus_exporter')
+	plugins = []
+
+	def make(**settings):
+		plugin = octoprint_prometheus_exporter.PrometheusExporterPlugin()
+		plugin._logger = logging.getLogger('test')
+		plugin._printer = StubPrinter()
+		plugin._identifier = 'prometheus_exporter'
+		plugin._plugin_version = 'test'
+		plugin._data_folder = str(tmp_path)
+		values = plugin.get_settings_defaults()
+		values.update(settings)
+		plugin._settings = StubSettings(values)
+		plugin.initialize()
+		plugins.append(plugin)
+		return plugin
+
+	yield make
+	for plugin in plugins:
+		plugin.label_scheduler.stop()
+		plugin.gcode_worker.stop()
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+from prometheus_client.parser import text_string_to_metric_families
+
+from octoprint_prometheus_exporter.aggregation import FAN_IN_SUFFIX
+
+
+@pytest.fixture
+def instances(make_plugin, tmp_path):
+	"""Two publishing instances and the one aggregating them, sharing a fan-in folder."""
+	folder = tmp_path / 'fan-in'
+	folder.mkdir()
+
+	def make(label, aggregate=False):
+		return make_plugin(printer_label=label, fan_in_folder=str(folder), fan_in_aggregate=aggregate, scrape_cache_ttl=0)
+
+	return (make('left'), make('right'), make('main', aggregate=True), folder)
+
+
+def samples(plugin, name):
+	"""Returns {printer label: value} of the samples of name the plugin exposes."""
+	(body, _) = plugin.metrics.render(None, None)
+	values = {}
+	for family in text_string_to_metric_families(body.decode('utf-8')):
+		for sample in family.samples:
+			if sample.name == name:
+				values[sample.labels.get('printer')] = sample.value
+	return values
+
+
+def test_every_instance_is_exposed_with_its_label(instances):
+	(left, right, main, _) = instances
+	left.metrics.client_num = 1
+	right.metrics.client_num = 2
+	main.metrics.client_num = 3
+	left.publish_fan_in()
+	right.publish_fan_in()
+
+	assert samples(main, 'octoprint_client_num') == {'left': 1, 'right': 2, 'main': 3}
+
+
+def test_families_of_the_instances_are_merged(instances):
+	(left, right, main, _) = instances
+	left.publish_fan_in()
+	right.publish_fan_in()
+
+	(body, _) = main.metrics.render(None, None)
+	assert body.count(b'# TYPE octoprint_client_num gauge\n') == 1
+	assert body.count(b'# TYPE octoprint_extrusion_total counter\n') == 1
+
+
+def test_stale_and_withdrawn_instances_drop_out(instances):
+	(left, right, main, folder) = instances
+	left.publish_fan_in()
+	right.publish_fan_in()
+	assert set(samples(main, 'octoprint_client_num')) == {'left', 'right', 'main'}
+
+	# older than fan_in_max_age
+	stale = os.path.getmtime(str(folder / ('left' + FAN_IN_SUFFIX))) - 3600
+	os.utime(str(folder / ('left' + FAN_IN_SUFFIX)), (stale, stale))
+	assert set(samples(main, 'octoprint_client_num')) == {'right', 'main'}
+
+	right.fan_in.withdraw()
+	assert set(samples(main, 'octoprint_client_num')) == {'main'}
+
+
+def test_rewritten_files_are_parsed_again(instances):
+	(left, _, main, _) = instances
+	left.metrics.client_num = 1
+	left.publish_fan_in()
+	assert samples(main, 'octoprint_client_num')['left'] == 1
+	parsed = main.fan_in._parsed['left' + FAN_IN_SUFFIX]
+
+	# unchanged, the parsed families are reused
+	samples(main, 'octoprint_client_num')
+	assert main.fan_in._parsed['left' + FAN_IN_SUFFIX] is parsed
+
+	left.metrics.client_num = 12345
+	# a longer value, so even within the mtime resolution the size tells the rewrite apart
+	left.publish_fan_in()
+	assert samples(main, 'octoprint_client_num')['left'] == 12345
+	assert main.fan_in._parsed['left' + FAN_IN_SUFFIX] is not parsed
@@ -0,0 +1,59 @@
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+
+from octoprint_prometheus_exporter.counters import CounterStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# saves ever growing counters, big enough for a save to take a while, until it gets killed
+WRITER = """
+import sys
+sys.path.insert(0, {root!r})
+from octoprint_prometheus_exporter.counters import CounterStore
+store = CounterStore({path!r})
+n = 0
+while True:
+	n += 1
+	store.save(dict(('counter_{{}}'.format(i), n) for i in range(2000)))
+	if n == 1:
+		print('saved', flush=True)
+"""
+
+
+def test_save_and_load(tmp_path):
+	store = CounterStore(str(tmp_path / 'data' / 'counters.json'))
+	assert store.load() == {}
+	assert store.save({'extrusion_total': 1.5})
+	assert not store.save({'extrusion_total': 1.5})
+	assert CounterStore(str(tmp_path / 'data' / 'counters.json')).load() == {'extrusion_total': 1.5}
+
+
+def test_killed_writer_leaves_a_complete_file(tmp_path, caplog):
+	path = str(tmp_path / 'counters.json')
+	rng = random.Random(1)
+	last = 0
+	for _ in range(10):
+		writer = subprocess.Popen(
+			[sys.executable, '-c', WRITER.format(root=ROOT, path=path)],
+			stdout=subprocess.PIPE
+		)
+		try:
+			assert writer.stdout.readline() == b'saved\n'
+			time.sleep(rng.uniform(0, 0.05))
+		finally:
+			writer.kill()
+			writer.wait()
+			writer.stdout.close()
+
+		with caplog.at_level(logging.ERROR):
+			counters = CounterStore(path, logging.getLogger('test')).load()
+		assert not caplog.records
+		# every save writes the same value to all counters, a mix of two saves would show
+		assert len(counters) == 2000
+		assert len(set(counters.values())) == 1
+		last = counters['counter_0']
+	assert last >= 1
@@ -0,0 +1,106 @@
+import gzip
+
+import pytest
+from prometheus_client import CollectorRegistry
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.openmetrics.exposition import CONTENT_TYPE_LATEST as OPENMETRICS
+
+from octoprint_prometheus_exporter.exposition import ExpositionCache
+
+
+class Collector:
+	"""A gauge of value and a counter of the collections, which is left out of the comparison."""
+
+	def __init__(self) -> None:
+		self.value = 1.0
+		self.collections = 0
+
+	def collect(self):
+		self.collections += 1
+		yield GaugeMetricFamily('test_value', 'Value', value=self.value)
+		yield CounterMetricFamily('test_collections', 'Collections', value=self.collections)
+
+
+@pytest.fixture
+def collector():
+	return Collector()
+
+
+@pytest.fixture
+def cache(collector, clock):
+	registry = CollectorRegistry(auto_describe=False)
+	registry.register(collector)
+	return ExpositionCache(registry, ttl=1.0, ignored=('test_collections',), clock=clock)
+
+
+def test_collects_once_per_ttl(cache, collector, clock):
+	(body, _) = cache.render(None, None)
+	assert b'test_value 1.0' in body
+	collector.value = 2.0
+
+	clock.now += 0.9
+	(body, _) = cache.render(None, None)
+	assert b'test_value 1.0' in body
+	assert collector.collections == 1
+
+	clock.now += 0.1
+	(body, _) = cache.render(None, None)
+	assert b'test_value 2.0' in body
+	assert collector.collections == 2
+
+
+def test_unchanged_samples_reuse_the_body(cache, collector, clock):
+	(first, _) = cache.render(None, None)
+	assert (cache.hits, cache.misses) == (0, 1)
+
+	cache.render(None, None)
+	assert (cache.hits, cache.misses) == (1, 1)
+
+	# collected again, the ignored counter changed but the value did not
+	clock.now += 5
+	(body, _) = cache.render(None, None)
+	assert collector.collections == 2
+	assert body is first
+	assert (cache.hits, cache.misses) == (2, 1)
+
+	collector.value = 3.0
+	clock.now += 5
+	(body, _) = cache.render(None, None)
+	assert b'test_value 3.0' in body
+	assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_every_variant_is_encoded_once(cache):
+	variants = [(None, None), (None, 'gzip'), (OPENMETRICS, None), (OPENMETRICS, 'gzip, deflate')]
+	bodies = {}
+	for (accept, accept_encoding) in variants:
+		bodies[(accept, accept_encoding)] = cache.render(accept, accept_encoding)
+	assert cache.misses == 4
+	for (accept, accept_encoding) in variants:
+		assert cache.render(accept, accept_encoding)[0] is bodies[(accept, accept_encoding)][0]
+	assert (cache.hits, cache.misses) == (4, 4)
+
+	(text, headers) = bodies[(None, None)]
+	assert headers['Content-Type'].startswith('text/plain')
+	assert 'Content-Encoding' not in headers
+	(gzipped, headers) = bodies[(None, 'gzip')]
+	assert headers['Content-Encoding'] == 'gzip'
+	assert gzip.decompress(gzipped) == text
+
+	(openmetrics, headers) = bodies[(OPENMETRICS, None)]
+	assert headers['Content-Type'].startswith('application/openmetrics-text')
+	assert openmetrics.endswith(b'# EOF\n')
+	(gzipped, headers) = bodies[(OPENMETRICS, 'gzip, deflate')]
+	assert headers['Content-Encoding'] == 'gzip'
+	assert headers['Vary'] == 'Accept, Accept-Encoding'
+	assert gzip.decompress(gzipped) == openmetrics
+
+
+def test_zero_ttl_collects_every_scrape(collector, clock):
+	registry = CollectorRegistry(auto_describe=False)
+	registry.register(collector)
+	cache = ExpositionCache(registry, ttl=0, clock=clock)
+	cache.render(None, None)
+	collector.value = 4.0
+	(body, _) = cache.render(None, None)
+	assert b'test_value 4.0' in body
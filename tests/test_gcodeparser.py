@@ -0,0 +1,135 @@
+import io
+import math
+
+import pytest
+
+from octoprint_prometheus_exporter.gcodeanalyzer import analyze_stream
+from octoprint_prometheus_exporter.gcodeparser import Gcode_parser
+
+
+def run(lines):
+	parser = Gcode_parser()
+	for line in lines:
+		parser.process_line(line)
+	return parser
+
+
+@pytest.mark.parametrize('value', ['inf', '-inf', 'nan', 'NaN', 'Infinity', '1e400'])
+def test_non_finite_values_are_skipped(value):
+	parser = run(['G90', 'M82', 'G1 X0 Y0 E0', 'G1 X{0} Y10 E{0}'.format(value), 'G1 X5 Y10 E1'])
+	assert (parser.x_travel, parser.y_travel, parser.extrusion_counter) == (5.0, 10.0, 1.0)
+
+
+@pytest.mark.parametrize('line', ['G2 X1 Y1 Inan J0', 'G3 X1 Y1 I0 Jinf', 'G2 X1 Y1 Rnan', 'G2 X1e400 Y1 I1 J0'])
+def test_non_finite_arcs_do_not_raise(line):
+	parser = run(['G90', 'G1 X0 Y0', line])
+	assert math.isfinite(parser.x_travel) and math.isfinite(parser.y_travel)
+
+
+def arc(setup, line):
+	"""Returns (XY length, X, Y and Z travel) of the arc line after the setup lines."""
+	parser = run(setup)
+	before = (parser.x_travel, parser.y_travel, parser.z_travel)
+	parser.process_line(line)
+	return (parser.move_xy_length,) + tuple(
+		after - start for (after, start) in zip((parser.x_travel, parser.y_travel, parser.z_travel), before)
+	)
+
+
+R = 10.0
+QUARTER = (math.pi * R / 2, R, R, 0)
+THREE_QUARTERS = (3 * math.pi * R / 2, 3 * R, 3 * R, 0)
+FULL = (2 * math.pi * R, 4 * R, 4 * R, 0)
+START = ['G21', 'G90', 'G17', 'G0 X10 Y0 Z0']
+
+
+@pytest.mark.parametrize('setup, line, expected', [
+	# center offsets, counterclockwise from (10, 0) around the origin
+	(START, 'G3 X0 Y10 I-10 J0', QUARTER),
+	(START, 'G3 X0 Y-10 I-10 J0', THREE_QUARTERS),
+	(START, 'G3 X10 Y0 I-10 J0', FULL),
+	# clockwise the other way round
+	(START, 'G2 X0 Y-10 I-10 J0', QUARTER),
+	(START, 'G2 X0 Y10 I-10 J0', THREE_QUARTERS),
+	(START, 'G2 X10 Y0 I-10 J0', FULL),
+	# radius, negative for more than half a circle
+	(START, 'G3 X0 Y10 R10', QUARTER),
+	(START, 'G3 X0 Y10 R-10', THREE_QUARTERS),
+	(START, 'G2 X0 Y-10 R10', QUARTER),
+	(START, 'G2 X0 Y-10 R-10', THREE_QUARTERS),
+	# relative coordinates
+	(START + ['G91'], 'G3 X-10 Y10 I-10 J0', QUARTER),
+	(START + ['G91'], 'G3 X-10 Y10 R-10', THREE_QUARTERS),
+	# inches
+	(['G20', 'G90', 'G0 X1 Y0 Z0'], 'G3 X0 Y1 I-1 J0', tuple(value * 2.54 for value in QUARTER)),
+	(['G20', 'G90', 'G0 X1 Y0 Z0'], 'G2 X1 Y0 I-1 J0', tuple(value * 2.54 for value in FULL)),
+])
+def test_arc_lengths(setup, line, expected):
+	assert arc(setup, line) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('line, expected', [
+	# G18 arcs run in the Z-X plane with K and I offsets
+	('G2 X0 Z10 I-10 K0', (R, 0, R)),
+	('G3 X0 Z10 I-10 K0', (3 * R, 0, 3 * R)),
+	('G3 X10 Z0 I-10 K0', (4 * R, 0, 4 * R)),
+	('G2 X0 Z10 R10', (R, 0, R)),
+	('G2 X0 Z10 R-10', (3 * R, 0, 3 * R)),
+])
+def test_arcs_in_the_zx_plane(line, expected):
+	(_, x, y, z) = arc(['G21', 'G90', 'G18', 'G0 X10 Y0 Z0'], line)
+	assert (x, y, z) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('line', ['G1 X5 Y3 E0.5 F1200', 'G1 X5Y3E0.5F1200', 'G1X5 Y3E0.5 F1200', 'G1X5Y3E.5F1200'])
+def test_words_do_not_need_spaces(line):
+	parser = run(['G90', 'M82', 'G1 X0 Y0 E0', line])
+	assert (parser.x_travel, parser.y_travel, parser.extrusion_counter, parser.speed) == (5.0, 3.0, 0.5, 1200.0)
+
+
+@pytest.mark.parametrize('line', ['m117 G1 X5 Y3', 'M117 G1X5Y3', 'xG1X5Y3'])
+def test_joined_words_are_only_split_from_the_start(line):
+	parser = run(['G90', 'G1 X0 Y0', line])
+	assert (parser.x_travel, parser.y_travel) == (0, 0)
+
+
+@pytest.mark.parametrize('value', ['0', '-3', '-0.5'])
+def test_non_positive_feedrates_are_ignored(value):
+	parser = run(['G1 X0 Y0 F1800', 'G1 X5 Y0 F{}'.format(value), 'G2 X0 Y0 I-2.5 J0 F{}'.format(value)])
+	assert parser.speed == 1800.0
+
+
+def sliced(layers, spiral=0):
+	"""Lines of a sliced file with Cura's layer comments, a Z hop per layer and a vase mode spiral of spiral
+	turns after the layers."""
+	lines = ['G90', 'M82', 'G92 E0']
+	e = 0.0
+	for layer in range(layers):
+		z = 0.2 * (layer + 1)
+		lines += [';LAYER:{}'.format(layer), 'G0 F9000 Z{:.1f}'.format(z), 'G0 X0 Y0']
+		for (x, y) in ((10, 0), (10, 10), (0, 10), (0, 0)):
+			e += 0.3
+			lines.append('G1 X{} Y{} E{:.1f} ; perimeter'.format(x, y, e))
+		# Z hop over the part
+		lines += ['G1 E{:.1f}'.format(e - 0.8), 'G0 Z{:.1f}'.format(z + 0.4), 'G0 X5 Y5', 'G0 Z{:.1f}'.format(z)]
+		lines.append('G1 E{:.1f}'.format(e))
+	z = 0.2 * layers
+	for turn in range(spiral):
+		lines.append(';LAYER:{}'.format(layers + turn))
+		for (x, y) in ((10, 0), (10, 10), (0, 10), (0, 0)):
+			(z, e) = (z + 0.05, e + 0.3)
+			lines.append('G1 X{} Y{} Z{:.2f} E{:.1f}'.format(x, y, z, e))
+	return lines
+
+
+def sent(lines):
+	"""The lines as OctoPrint sends them, comments stripped and the empty ones skipped."""
+	return [line.split(';', 1)[0].strip() for line in lines if line.split(';', 1)[0].strip()]
+
+
+@pytest.mark.parametrize('layers, spiral, expected', [(5, 0, 5), (3, 20, 3)])
+def test_layers_are_counted_from_the_moves(layers, spiral, expected):
+	lines = sliced(layers, spiral)
+	assert run(sent(lines)).layer == expected
+	# the analysis of the file, comments and all, expects as many
+	assert analyze_stream(io.StringIO('\n'.join(lines) + '\n')).layers == expected
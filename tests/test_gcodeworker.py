@@ -0,0 +1,32 @@
+import logging
+import threading
+
+from octoprint_prometheus_exporter.gcodeparser import Gcode_parser
+from octoprint_prometheus_exporter.gcodeworker import GcodeWorker
+
+
+class FailingParser(Gcode_parser):
+	def process_line(self, line):
+		if line == 'boom':
+			raise ValueError(line)
+		return super().process_line(line)
+
+
+def test_a_failing_line_does_not_stop_the_worker():
+	published = []
+	worker = GcodeWorker(
+		FailingParser(), lambda totals, *args: published.append(totals), logging.getLogger('test'),
+		max_size=2, interval=0.01, overflow=GcodeWorker.OVERFLOW_BLOCK
+	)
+	lines = ['G90', 'M82', 'G1 X0 Y0 E0', 'boom', 'G1 X10 Y0 E1', 'boom', 'G1 X10 Y5 E2']
+	worker.start()
+	# put() blocks while the queue is full, so the sender only gets through if the worker keeps draining
+	sender = threading.Thread(target=lambda: [worker.put(line) for line in lines], daemon=True)
+	sender.start()
+	sender.join(5)
+	try:
+		assert not sender.is_alive()
+		assert worker._thread.is_alive()
+	finally:
+		worker.stop()
+	assert published[-1][:3] == (2.0, 10.0, 5.0)
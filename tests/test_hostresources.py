@@ -0,0 +1,60 @@
+import logging
+import os
+
+import pytest
+
+from octoprint_prometheus_exporter.hostresources import HostResources
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+TICKS = float(os.sysconf('SC_CLK_TCK'))
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+@pytest.fixture
+def samples():
+	"""Returns the (name, labels) -> value of the samples collected from the fixture trees."""
+	def collect(proc_root=os.path.join(FIXTURES, 'proc'), sys_root=os.path.join(FIXTURES, 'sys')):
+		resources = HostResources(logging.getLogger('test'), proc_root=proc_root, sys_root=sys_root)
+		try:
+			return dict(
+				((sample.name, tuple(sorted(sample.labels.items()))), sample.value)
+				for family in resources.collect() for sample in family.samples
+			)
+		finally:
+			resources.close()
+	return collect
+
+
+def test_host_cpu_and_memory(samples):
+	values = samples()
+	assert values[('octoprint_host_cpu_seconds_total', (('mode', 'user'),))] == pytest.approx(10132153 / TICKS)
+	assert values[('octoprint_host_cpu_seconds_total', (('mode', 'steal'),))] == 0
+	assert values[('octoprint_host_memory_bytes', (('type', 'available'),))] == 2935284 * 1024
+	assert values[('octoprint_host_memory_bytes', (('type', 'swap_free'),))] == 102396 * 1024
+	assert len([key for key in values if key[0] == 'octoprint_host_memory_bytes']) == 7
+
+
+def test_throttled_flags(samples):
+	values = samples()
+	flags = dict((key[1][0][1], value) for (key, value) in values.items() if key[0] == 'octoprint_host_throttled')
+	assert flags == {
+		'under_voltage': 1, 'arm_frequency_capped': 0, 'throttled': 1, 'soft_temperature_limit': 0,
+		'under_voltage_occurred': 1, 'arm_frequency_capped_occurred': 0, 'throttled_occurred': 1,
+		'soft_temperature_limit_occurred': 0,
+	}
+
+
+def test_process_with_parentheses_in_its_name(samples):
+	values = samples()
+	assert values[('octoprint_process_cpu_seconds_total', (('mode', 'user'),))] == pytest.approx(5123 / TICKS)
+	assert values[('octoprint_process_cpu_seconds_total', (('mode', 'system'),))] == pytest.approx(987 / TICKS)
+	assert values[('octoprint_process_threads', ())] == 17
+	assert values[('octoprint_process_virtual_memory_bytes', ())] == 412545024
+	assert values[('octoprint_process_resident_memory_bytes', ())] == 21034 * PAGE_SIZE
+	assert values[('octoprint_process_resident_memory_max_bytes', ())] == 90112 * 1024
+	assert values[('octoprint_process_context_switches_total', (('type', 'voluntary'),))] == 15023
+	assert values[('octoprint_process_context_switches_total', (('type', 'nonvoluntary'),))] == 331
+
+
+def test_missing_files_export_nothing(samples, tmp_path):
+	assert samples(proc_root=str(tmp_path), sys_root=str(tmp_path)) == {}
@@ -0,0 +1,95 @@
+import logging
+
+import pytest
+
+from octoprint_prometheus_exporter.hostsensors import HostSensors
+
+
+def write(path, text):
+	path.parent.mkdir(parents=True, exist_ok=True)
+	path.write_text(text)
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+	"""A /sys/class tree with a Raspberry Pi SoC zone, a zone without a type and a hwmon chip."""
+	write(tmp_path / 'thermal' / 'thermal_zone0' / 'type', 'cpu-thermal\n')
+	write(tmp_path / 'thermal' / 'thermal_zone0' / 'temp', '48312\n')
+	write(tmp_path / 'thermal' / 'thermal_zone1' / 'temp', '39000\n')
+	write(tmp_path / 'hwmon' / 'hwmon0' / 'name', 'nct6775\n')
+	write(tmp_path / 'hwmon' / 'hwmon0' / 'temp1_input', '35500\n')
+	write(tmp_path / 'hwmon' / 'hwmon0' / 'temp1_label', 'SYSTIN\n')
+	write(tmp_path / 'hwmon' / 'hwmon0' / 'temp2_input', '41000\n')
+	return tmp_path
+
+
+@pytest.fixture
+def vcgencmd_calls(monkeypatch):
+	calls = []
+
+	def get_vcgencmd_temperature(self):
+		calls.append(self)
+		return 51.5
+
+	monkeypatch.setattr(HostSensors, 'get_vcgencmd_temperature', get_vcgencmd_temperature)
+	return calls
+
+
+def collect(root, **kwargs):
+	sensors = HostSensors(logging.getLogger('test'), root=str(root), **kwargs)
+	try:
+		return dict(
+			((sample.name, tuple(sorted(sample.labels.items()))), sample.value)
+			for family in sensors.collect() for sample in family.samples
+		)
+	finally:
+		sensors.close()
+
+
+def test_zones_and_hwmon_channels(sysfs):
+	values = collect(sysfs)
+	temperatures = dict(
+		(dict(labels)['sensor'], (dict(labels)['type'], value))
+		for ((name, labels), value) in values.items() if name == 'octoprint_host_temperature'
+	)
+	assert temperatures == {
+		'thermal_zone0': ('cpu-thermal', 48.312),
+		# no type file, named after the zone
+		'thermal_zone1': ('thermal_zone1', 39.0),
+		'hwmon0/temp1': ('nct6775 SYSTIN', 35.5),
+		'hwmon0/temp2': ('nct6775', 41.0),
+	}
+
+
+def test_raspberry_core_from_the_cpu_thermal_zone(sysfs, vcgencmd_calls):
+	values = collect(sysfs, use_vcgencmd=True)
+	assert values[('octoprint_raspberry_core_temperature', ())] == 48.312
+	assert vcgencmd_calls == []
+
+
+def test_unreadable_and_missing_files_are_skipped(sysfs):
+	# missing
+	(sysfs / 'thermal' / 'thermal_zone1' / 'temp').unlink()
+	# not a number
+	write(sysfs / 'hwmon' / 'hwmon0' / 'temp2_input', 'N/A\n')
+	values = collect(sysfs)
+	sensors = set(dict(labels)['sensor'] for (name, labels) in values if name == 'octoprint_host_temperature')
+	assert sensors == {'thermal_zone0', 'hwmon0/temp1'}
+
+
+def test_vcgencmd_only_without_a_cpu_thermal_zone(sysfs, vcgencmd_calls):
+	write(sysfs / 'thermal' / 'thermal_zone0' / 'type', 'soc-thermal\n')
+
+	values = collect(sysfs)
+	assert ('octoprint_raspberry_core_temperature', ()) not in values
+	assert vcgencmd_calls == []
+
+	values = collect(sysfs, use_vcgencmd=True)
+	assert values[('octoprint_raspberry_core_temperature', ())] == 51.5
+	# probed once on construction, then once per scrape
+	assert len(vcgencmd_calls) == 2
+
+
+def test_no_sensors(tmp_path, vcgencmd_calls):
+	assert collect(tmp_path) == {}
+	assert vcgencmd_calls == []
@@ -0,0 +1,61 @@
+import os
+
+from octoprint_prometheus_exporter.jobs import JobLog
+
+PAYLOAD = {'path': 'part.gcode', 'origin': 'sdcard'}
+
+
+def send(plugin, lines):
+	for line in lines:
+		plugin.gcodephase_hook(None, 'sent', line, None, None)
+
+
+def print_job(plugin, lines, event='PrintDone'):
+	plugin.on_event('PrintStarted', PAYLOAD)
+	# the first move only positions, the parser does not know where the head was
+	send(plugin, ['G90', 'M82', 'G92 E0', 'G0 X0 Y0'] + lines)
+	plugin.on_event(event, PAYLOAD)
+
+
+def test_back_to_back_prints_do_not_carry_over(make_plugin, tmp_path):
+	plugin = make_plugin()
+	# the second print starts well within label_retention of the first one
+	print_job(plugin, ['G1 X10 Y0 E10'])
+	print_job(plugin, ['G1 X0 Y2 E1'], event='PrintCancelled')
+
+	records = list(JobLog(os.path.join(str(tmp_path), 'jobs.jsonl')).records())
+	assert [record['outcome'] for record in records] == ['done', 'cancelled']
+	assert [record['extrusion'] for record in records] == [10.0, 1.0]
+	assert [record['x_travel'] for record in records] == [10.0, 0]
+	assert [record['y_travel'] for record in records] == [0, 2.0]
+	assert records[0]['filament_g'] > records[1]['filament_g']
+	assert plugin.metrics.extrusion_print == 1.0
+	assert plugin.metrics.extrusion_total == 11.0
+
+
+def test_page_cursor_walks_the_history_newest_first(tmp_path):
+	log = JobLog(str(tmp_path / 'jobs.jsonl'))
+	log.BLOCK_SIZE = 64
+	for n in range(100):
+		log.append({'n': n, 'path': 'x' * (n % 40)})
+
+	seen = []
+	cursor = None
+	while True:
+		(page, cursor) = log.page(cursor, 7)
+		seen.extend(record['n'] for record in page)
+		if cursor is None:
+			break
+	assert seen == list(range(99, -1, -1))
+
+
+def test_incomplete_last_line_is_skipped_and_terminated(tmp_path):
+	path = tmp_path / 'jobs.jsonl'
+	log = JobLog(str(path))
+	log.append({'n': 0})
+	with open(str(path), 'ab') as f:
+		f.write(b'{"n":1,"cut')
+	assert [record['n'] for record in log.page()[0]] == [0]
+
+	log.append({'n': 2})
+	assert [record['n'] for record in log.records()] == [0, 2]
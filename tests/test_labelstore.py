@@ -0,0 +1,72 @@
+import pytest
+
+from octoprint_prometheus_exporter.labelstore import LabelStore
+
+
+@pytest.fixture
+def store(clock):
+	return LabelStore(max_size=3, ttl=60, clock=clock)
+
+
+def test_least_recently_set_is_evicted_at_capacity(store):
+	for label in ('a', 'b', 'c'):
+		store[label] = 1.0
+	# setting a again makes b the least recently set
+	store['a'] = 2.0
+	store['d'] = 3.0
+	assert dict(store.items()) == {'c': 1.0, 'a': 2.0, 'd': 3.0}
+	assert 'b' not in store
+	assert store.evicted == 1
+
+	store['e'] = 4.0
+	store['f'] = 5.0
+	assert [label for (label, _) in store.items()] == ['d', 'e', 'f']
+	assert store.evicted == 3
+
+
+def test_labels_not_set_for_ttl_expire_when_read(store, clock):
+	store['a'] = 1.0
+	clock.now += 30
+	store['b'] = 2.0
+	clock.now += 29.9
+	assert dict(store.items()) == {'a': 1.0, 'b': 2.0}
+
+	clock.now += 0.1
+	assert dict(store.items()) == {'b': 2.0}
+	assert store.evicted == 1
+
+	# setting it again keeps it fresh
+	store['b'] = 3.0
+	clock.now += 59
+	assert dict(store.items()) == {'b': 3.0}
+	clock.now += 1
+	assert store.items() == []
+	assert store.evicted == 2
+
+
+def test_zero_ttl_never_expires(clock):
+	store = LabelStore(max_size=3, ttl=0, clock=clock)
+	store['a'] = 1.0
+	clock.now += 10 ** 6
+	assert store.items() == [('a', 1.0)]
+	assert store.evicted == 0
+
+
+def test_removed_labels_are_not_evictions(store):
+	store['a'] = 1.0
+	store['b'] = 2.0
+	assert store.pop('a') == 1.0
+	assert store.pop('a', 'gone') == 'gone'
+	store.clear()
+	assert len(store) == 0
+	assert store.evicted == 0
+
+
+def test_evictions_are_exported_by_family(make_plugin):
+	plugin = make_plugin(path_series_max=2, scrape_cache_ttl=0)
+	for path in ('a.gcode', 'b.gcode', 'c.gcode'):
+		plugin.metrics.print_progress[path] = 50.0
+
+	(body, _) = plugin.metrics.render(None, None)
+	assert b'octoprint_evicted_series_total{family="octoprint_print_progress"} 1.0' in body
+	assert b'octoprint_evicted_series_total{family="octoprint_slice_progress"} 0.0' in body
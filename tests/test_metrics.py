@@ -0,0 +1,40 @@
+import pytest
+
+from octoprint_prometheus_exporter.library import LibraryTotals
+
+NAMES = [
+	'octoprint_move_feedrate_bucket',
+	'octoprint_move_segment_length_count',
+	'octoprint_print_layer',
+	'octoprint_print_layer_elapsed',
+	'octoprint_layer_duration_seconds_sum',
+	'octoprint_temperatures_actual_min',
+	# negative buckets, so no _sum and _count
+	'octoprint_temperature_deviation_bucket',
+	'octoprint_library_files',
+	'octoprint_extrusion_total',
+]
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_name_selects_the_family(make_plugin, name):
+	plugin = make_plugin()
+	plugin.get_temp_update(None, {'T0': (210.0, 215.0)})
+	# only collected once the library was back-filled, which is after the registration
+	plugin.metrics.library_totals = LibraryTotals(*([1] * len(LibraryTotals._fields)))
+
+	(body, _) = plugin.metrics.render(None, None, [name])
+	assert body.startswith(b'# HELP ')
+	assert '\n{}'.format(name).encode() in body
+
+
+def test_offline_drops_the_temperature_statistics(make_plugin):
+	plugin = make_plugin(scrape_cache_ttl=0)
+	plugin.get_temp_update(None, {'T0': (210.0, 215.0)})
+	(body, _) = plugin.metrics.render(None, None)
+	assert b'octoprint_temperature_deviation_bucket{identifier="T0"' in body
+
+	plugin.on_event('PrinterStateChanged', {'state_id': 'OFFLINE', 'state_string': 'Offline'})
+
+	(body, _) = plugin.metrics.render(None, None)
+	assert b'identifier="T0"' not in body
@@ -0,0 +1,53 @@
+import base64
+import http.server
+import logging
+import threading
+
+import pytest
+from prometheus_client import CollectorRegistry, Gauge
+
+from octoprint_prometheus_exporter.push import Pusher, grouping_path
+
+
+@pytest.mark.parametrize('value, path', [
+	('mk3', '/printer/mk3'),
+	('Prusa MK3', '/printer/Prusa%20MK3'),
+	('a&b?c', '/printer/a%26b%3Fc'),
+	('', '/printer@base64/='),
+	('shelf/1', '/printer@base64/' + base64.urlsafe_b64encode(b'shelf/1').decode()),
+])
+def test_grouping_path(value, path):
+	assert grouping_path('printer', value) == path
+
+
+@pytest.fixture
+def gateway():
+	"""A server recording the (method, path) of the requests it gets."""
+	requests = []
+
+	class Handler(http.server.BaseHTTPRequestHandler):
+		def do_PUT(self):
+			self.rfile.read(int(self.headers['Content-Length']))
+			requests.append((self.command, self.path))
+			self.send_response(200)
+			self.end_headers()
+
+		def log_message(self, *args):
+			pass
+
+	server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	yield ('http://127.0.0.1:{}/'.format(server.server_port), requests)
+	server.shutdown()
+
+
+def test_push_with_a_label_needing_escapes(gateway):
+	(url, requests) = gateway
+	registry = CollectorRegistry()
+	Gauge('up', 'Up', registry=registry).set(1)
+	pusher = Pusher(registry, url, logging.getLogger('test'), grouping={'printer': 'Prusa MK3/2'})
+	pusher.snapshot()
+
+	assert pusher.push()
+	assert requests == [('PUT', '/metrics/job/octoprint/printer@base64/UHJ1c2EgTUszLzI=')]
@@ -0,0 +1,96 @@
+import logging
+
+import pytest
+
+from octoprint_prometheus_exporter.scheduler import LabelScheduler
+
+
+@pytest.fixture
+def scheduler(clock):
+	return LabelScheduler(logging.getLogger('test'), clock=clock)
+
+
+def test_runs_when_due(scheduler, clock):
+	ran = []
+	scheduler.schedule('a', 30, ran.append, 'a')
+	assert scheduler.run_pending() == 30
+	clock.now += 29.9
+	scheduler.run_pending()
+	assert ran == []
+	clock.now += 0.1
+	assert scheduler.run_pending() is None
+	assert ran == ['a']
+	assert not scheduler.is_pending('a')
+
+
+def test_rescheduling_replaces_the_deadline(scheduler, clock):
+	ran = []
+	scheduler.schedule('a', 10, ran.append, 1)
+	clock.now += 5
+	# pushed back, and with new arguments
+	scheduler.schedule('a', 10, ran.append, 2)
+	clock.now += 5
+	assert scheduler.run_pending() == pytest.approx(5)
+	assert ran == []
+	clock.now += 5
+	scheduler.run_pending()
+	assert ran == [2]
+
+	# brought forward
+	scheduler.schedule('b', 60, ran.append, 3)
+	scheduler.schedule('b', 1, ran.append, 4)
+	clock.now += 1
+	scheduler.run_pending()
+	assert ran == [2, 4]
+	clock.now += 60
+	scheduler.run_pending()
+	assert ran == [2, 4]
+
+
+def test_cancel(scheduler, clock):
+	ran = []
+	scheduler.schedule('a', 1, ran.append, 'a')
+	scheduler.cancel('a')
+	scheduler.cancel('unknown')
+	clock.now += 2
+	scheduler.run_pending()
+	assert ran == []
+
+
+def test_callbacks_run_in_deadline_order_and_a_failure_does_not_stop_the_others(scheduler, clock, caplog):
+	ran = []
+
+	def fail():
+		raise RuntimeError('boom')
+
+	scheduler.schedule('c', 3, ran.append, 'c')
+	scheduler.schedule('fail', 2, fail)
+	scheduler.schedule('a', 1, ran.append, 'a')
+	clock.now += 3
+	with caplog.at_level(logging.ERROR):
+		scheduler.run_pending()
+	assert ran == ['a', 'c']
+	assert 'Failed to run scheduled callback' in caplog.text
+
+
+def test_many_refreshes_keep_one_heap_entry(scheduler, clock):
+	for _ in range(1000):
+		clock.now += 0.5
+		scheduler.schedule(('temperature', 'T0'), 60, lambda: None)
+	assert len(scheduler._heap) == 1
+
+
+def test_temperature_expires_after_retention(make_plugin, clock):
+	plugin = make_plugin(temperature_retention=60.0)
+	plugin.label_scheduler = LabelScheduler(logging.getLogger('test'), clock=clock)
+
+	plugin.get_temp_update(None, {'T0': (210.0, 215.0), 'B': (60.0, 60.0)})
+	clock.now += 50
+	plugin.get_temp_update(None, {'T0': (211.0, 215.0)})
+	clock.now += 10
+	plugin.label_scheduler.run_pending()
+	assert plugin.metrics.temps_actual == {'T0': 211.0}
+	assert plugin.metrics.temps_target == {'T0': 215.0}
+	clock.now += 50
+	plugin.label_scheduler.run_pending()
+	assert plugin.metrics.temps_actual == {}
@@ -0,0 +1,61 @@
+from octoprint_prometheus_exporter.seriallink import SerialLink
+
+
+class FakeClock:
+	def __init__(self) -> None:
+		self.now = 0.0
+
+	def __call__(self):
+		return self.now
+
+
+def latencies(link):
+	return (sum(link._latencies.counts), link._latencies.sum)
+
+
+def test_oks_match_the_lines_in_order():
+	clock = FakeClock()
+	link = SerialLink(max_in_flight=8, clock=clock)
+	# a printer acknowledging one line every 10 ms, the host keeps two lines in flight
+	link.sent('G1 X0')
+	link.sent('G1 X1')
+	for i in range(2, 100):
+		clock.now += 0.01
+		link.received('ok')
+		link.sent('G1 X{}'.format(i))
+	assert (link.lines, link.acks, link.unmatched) == (100, 98, 0)
+	(count, total) = latencies(link)
+	assert count == 98
+	# the first line waited one ack, every other one two
+	assert abs(total - (0.01 + 97 * 0.02)) < 1e-9
+	assert len(link._in_flight) == 2
+
+
+def test_resend_busy_and_unmatched():
+	link = SerialLink(max_in_flight=3, clock=FakeClock())
+	link.received('ok')
+	for i in range(5):
+		link.sent('G1 X{}'.format(i))
+	# only the last max_in_flight sends are kept
+	assert len(link._in_flight) == 3
+	link.received('echo:busy: processing')
+	link.received('Resend: 4')
+	link.received('ok')
+	assert (link.unmatched, link.resends, link.busy) == (2, 1, 1)
+	assert link.bytes == 5 * len('G1 X0\n')
+
+
+def test_advanced_ok_and_registered_buffer_gauges():
+	from prometheus_client import CollectorRegistry, generate_latest
+
+	link = SerialLink(clock=FakeClock())
+	registry = CollectorRegistry(auto_describe=True)
+	registry.register(link)
+	link.sent('G1 X1')
+	link.received('ok N10 P15 B3')
+	assert (link.planner_free, link.buffer_free) == (15, 3)
+
+	body = generate_latest(registry.restricted_registry(['octoprint_serial_planner_free']))
+	assert b'octoprint_serial_planner_free 15.0' in body
+	link.reset()
+	assert b'\noctoprint_serial_command_buffer_free ' not in generate_latest(registry)